@@ -0,0 +1,256 @@
+"""Synthetic-scale benchmarks for the module_detection pipeline stages.
+
+Generates domtblout files (KOs drawn by their genome occurrence counts in
+ko_occurrences.txt, several overlapping HMM hits per gene on both strands)
+plus a set of synthetic module graphs, then times every stage and records
+its peak memory. Results go to a JSON file that can be compared against
+the file written on another commit:
+
+    python BLIMMP_Scripts/benchmarks.py --sizes 1e3,1e4,1e5 -o bench.json
+    python BLIMMP_Scripts/benchmarks.py --sizes 1e3,1e4,1e5 -o new.json --compare bench.json
+"""
+import argparse, os, sys, json, time, platform, subprocess, tempfile, tracemalloc
+import pandas as pd, numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import module_detection as md
+
+KO_OCCURRENCES_TXT = os.path.join(HERE, "Data_Dependencies", "ko_occurrences.txt")
+NEIGHBOR_TXT = os.path.join(HERE, "Data_Dependencies", "ko_neighbors.txt")
+
+DOMTBLOUT_HEADER = (
+    "#                                                                            --- full sequence --- -------------- this domain -------------   hmm coord   ali coord   env coord\n"
+    "# target name        accession   tlen query name           accession   qlen   E-value  score  bias   #  of  c-Evalue  i-Evalue  score  bias  from    to  from    to  from    to  acc description of target\n"
+    "#------------------- ---------- ----- -------------------- ---------- ----- --------- ------ ----- --- --- --------- --------- ------ ----- ----- ----- ----- ----- ----- ----- ---- ---------------------\n"
+)
+
+"""## Synthetic data"""
+
+def ko_weights():
+    ko_occ = md.read_ko_occurence_txt(KO_OCCURRENCES_TXT)
+    counts = ko_occ['occurences'].astype(float).to_numpy()
+    return ko_occ['KO id'].to_numpy(), counts / counts.sum()
+
+def make_module_graphs(outdir, n_modules=400, seed=1, max_paths=5000):
+    # layered graphs start_0 -> step alternatives -> end_0, every third step optional
+    rng = np.random.default_rng(seed)
+    kos, p = ko_weights()
+    os.makedirs(outdir, exist_ok=True)
+    for m in range(n_modules):
+        module = f"M{m + 1:05d}"
+        nodes = {"start_0": 0}
+        paths = [["start_0"]]
+        n_steps = int(rng.integers(2, 9))
+        for step in range(n_steps):
+            n_alt = int(rng.integers(1, 4)) if len(paths) * 3 <= max_paths else 1
+            layer = [f"{ko}_{step + 1}" for ko in rng.choice(kos, size=n_alt, replace=False, p=p)]
+            for node in layer:
+                nodes[node] = step + 1
+            new = [path + [node] for path in paths for node in layer]
+            if step % 3 == 2:
+                new += paths
+            paths = new
+        nodes["end_0"] = n_steps + 1
+        paths_dict = {str(i + 1): ",".join(path + ["end_0"]) for i, path in enumerate(paths)}
+        with open(os.path.join(outdir, f"module_{module}_nodes.json"), "w") as f:
+            json.dump(nodes, f)
+        with open(os.path.join(outdir, f"module_{module}_paths.json"), "w") as f:
+            json.dump(paths_dict, f)
+    return outdir
+
+def make_domtblout(path, n_hits, seed=0, hits_per_gene=3, genes_per_contig=40, chunk=1_000_000):
+    """Write n_hits synthetic hits, ordered by query KO like hmmsearch output.
+
+    Genes are laid out along contigs on either strand; every hit lands on a
+    gene with jittered alignment ends, so hits of one gene overlap. A small
+    fraction has zero-length alignments and is dropped by the parser.
+    """
+    rng = np.random.default_rng(seed)
+    kos, p = ko_weights()
+    n_genes = max(1, n_hits // hits_per_gene)
+    gene_len = rng.integers(300, 1500, size=n_genes)
+    gene_start = (np.arange(n_genes) % genes_per_contig) * 1600 + rng.integers(0, 100, size=n_genes)
+    gene_minus = rng.random(n_genes) < 0.5
+    per_ko = rng.multinomial(n_hits, p)
+
+    with open(path, "w") as f:
+        f.write(DOMTBLOUT_HEADER)
+    first = 0
+    while first < len(kos):
+        # 1) a contiguous block of KOs holding about `chunk` hits
+        last = first + max(1, int(np.searchsorted(np.cumsum(per_ko[first:]), chunk)))
+        query = np.repeat(kos[first:last], per_ko[first:last])
+        n = len(query)
+        first = last
+        if n == 0:
+            continue
+        # 2) gene, alignment and score per hit
+        gene = rng.integers(0, n_genes, size=n)
+        length = gene_len[gene]
+        lo = gene_start[gene] + (rng.random(n) * 0.15 * length).astype(np.int64)
+        hi = gene_start[gene] + length - (rng.random(n) * 0.15 * length).astype(np.int64)
+        hi = np.where(rng.random(n) < 0.005, lo, hi)
+        ali_from = np.where(gene_minus[gene], hi, lo)
+        ali_to = np.where(gene_minus[gene], lo, hi)
+        hmm_from = rng.integers(1, 40, size=n)
+        hmm_to = hmm_from + (hi - lo) // 3
+        score = np.round(rng.gamma(2.0, 40.0, size=n), 1)
+        evalue = np.float64(10.0) ** np.round(-score / 4 + rng.normal(0, 2, size=n) + 2, 2)
+        evalue = np.char.mod("%.1e", evalue)
+        chunk_df = pd.DataFrame({
+            "target": np.char.add("contig_", (gene // genes_per_contig).astype(str)),
+            "tacc": "-", "tlen": 100000, "query": query, "qacc": "-", "qlen": 300,
+            "E-value": evalue, "full score": score, "full bias": 0.1, "n": 1, "of": 1,
+            "c-Evalue": evalue, "i-Evalue": evalue, "score": score, "bias": 0.2,
+            "hmm from": hmm_from, "hmm to": hmm_to, "ali from": ali_from, "ali to": ali_to,
+            "env from": lo, "env to": hi, "acc": 0.9, "description": "-",
+        })
+        chunk_df.to_csv(path, sep=" ", header=False, index=False, mode="a")
+    with open(path, "a") as f:
+        f.write("#\n# Program:         hmmsearch\n# [ok]\n")
+    return path
+
+"""## Measurement"""
+
+def measure(fn, repeat=1, memory=True):
+    # best-of-repeat wall/CPU time, then one traced call for the peak allocation
+    wall, cpu, out = [], [], None
+    for _ in range(repeat):
+        t0, c0 = time.perf_counter(), time.process_time()
+        out = fn()
+        wall.append(time.perf_counter() - t0)
+        cpu.append(time.process_time() - c0)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return out, {"wall_s": min(wall), "cpu_s": min(cpu), "peak_mb": peak}
+
+def run_stages(domtblout, reference, out_dir, repeat=1, memory=True):
+    # reference: md.ReferenceData over the synthetic module graphs
+    modules, ko_occ, neighbors, path_index = reference.modules, reference.ko_occ, reference.neighbors, reference.path_index
+    records = []
+
+    def stage(name, fn, rows_in):
+        out, rec = measure(fn, repeat, memory)
+        rec.update(stage=name, rows_in=int(rows_in), rows_out=int(len(out)) if hasattr(out, "__len__") else None)
+        records.append(rec)
+        peak = "" if rec["peak_mb"] is None else f", peak {rec['peak_mb']:.1f} MB"
+        print(f"  {name:<14} {rec['wall_s']:9.4f} s wall, {rec['cpu_s']:9.4f} s cpu{peak}")
+        return out
+
+    hits = stage("parse", lambda: md.process_domtblout(domtblout, ko_table=reference.ko_table), 0)
+    groups = stage("grouping", lambda: md.assign_overlap_groups(hits), len(hits))
+    groups = groups.reset_index()
+    best = stage("confidence", lambda: md.calculate_hit_confidence_log(groups, e_threshold=md.E_THRESHOLD), len(groups))
+
+    def dk():
+        # the pipeline's best_hits and dk stages: best hit per module KO, then Dk
+        all_kos = md.module_ko_hits(reference, md.best_hit_per_ko(best))
+        return md.calculate_dk_per_ko(ko_occ, all_kos, 0.7, reference.occ_rows(all_kos))
+    df_dk = stage("dk", dk, len(best))
+    dk_before = dict(zip(df_dk['KO id'], df_dk['Dk']))
+    diffused = stage("diffusion", lambda: md.spring_update_probabilities(dk_before, neighbors, alpha=0.6), len(df_dk))
+    dk_after = dict(zip(diffused['KO id'], diffused['Dk_Neighbors']))
+
+    stage("paths", lambda: md.path_probabilities(modules, dk_before, dk_after), len(dk_after))
+    best_paths = stage("paths_index", lambda: md.indexed_path_probabilities(path_index, dk_before, dk_after), len(dk_after))
+    evalue = dict(zip(df_dk['KO id'], df_dk['E-value'].replace(np.nan, 100.0)))
+    out_json = os.path.join(out_dir, "bench_sample_modules_representation.json")
+    def export():
+        md.export_module_data_with_best_path(reference.module_nodes, ko_occ, dk_before, evalue, dk_after, best_paths, out_json)
+        return modules.modules("nodes")
+    stage("export", export, len(best_paths))
+    return records
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline_path):
+    # ratio new/old wall time per (n_hits, stage) present in both files
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    old = {(r["n_hits"], r["stage"]): r for r in baseline["results"]}
+    print(f"\nWall time against {baseline_path} at {baseline.get('commit')} (ratio > 1 is slower):")
+    if baseline.get("modules") != report["modules"]:
+        print(f"  warning: {baseline.get('modules')} vs {report['modules']} synthetic modules, path stages are not comparable")
+    results = report["results"]
+    for r in results:
+        o = old.get((r["n_hits"], r["stage"]))
+        if o and o["wall_s"] > 0:
+            print(f"  {r['n_hits']:>10} {r['stage']:<14} {o['wall_s']:9.4f} s -> {r['wall_s']:9.4f} s  x{r['wall_s'] / o['wall_s']:.2f}")
+
+def parse_sizes(text):
+    return [int(float(s)) for s in text.split(",") if s.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time every module_detection stage on synthetic inputs.')
+    parser.add_argument('--sizes', type=parse_sizes, default=parse_sizes("1e3,1e4,1e5"),
+                        help='Comma-separated hit counts, e.g. 1e3,1e5,1e7 (default: 1e3,1e4,1e5)')
+    parser.add_argument('--modules', type=int, default=400, help='Number of synthetic module graphs (default: 400)')
+    parser.add_argument('--repeat', type=int, default=1, help='Timed calls per stage, best one is kept (default: 1)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the extra traced call per stage that measures peak memory')
+    parser.add_argument('--workdir', default=None,
+                        help='Keep the generated inputs here instead of a temporary folder; existing files are reused')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='benchmarks.json', help='Results JSON (default: benchmarks.json)')
+    parser.add_argument('--compare', default=None, metavar='JSON', help='Results JSON of an earlier run to compare with')
+    args = parser.parse_args(argv)
+
+    tmp = None
+    if args.workdir is None:
+        tmp = tempfile.TemporaryDirectory(prefix="blimmp_bench_")
+        args.workdir = tmp.name
+    os.makedirs(args.workdir, exist_ok=True)
+
+    # 1) reference data: real KO tables, synthetic module graphs
+    graph_dir = os.path.join(args.workdir, f"module_graphs_{args.modules}")
+    if not os.path.isdir(graph_dir):
+        make_module_graphs(graph_dir, n_modules=args.modules, seed=args.seed + 1)
+    modules = md.ModuleGraphStore(graph_dir)
+    reference = md.ReferenceData(modules, *md.build_reference_tables(KO_OCCURRENCES_TXT, NEIGHBOR_TXT, modules),
+                                 path_index=md.PathIndex.compile(modules))
+    print(f"{args.modules} synthetic modules, {len(reference.path_index.path_ids)} paths in {graph_dir}")
+
+    # 2) one synthetic sample per size
+    results = []
+    for n_hits in args.sizes:
+        domtblout = os.path.join(args.workdir, f"synthetic_{n_hits}_{args.seed}.domtblout")
+        if not os.path.isfile(domtblout):
+            t0 = time.perf_counter()
+            make_domtblout(domtblout, n_hits, seed=args.seed)
+            print(f"Generated {domtblout} in {time.perf_counter() - t0:.1f} s")
+        print(f"{n_hits} hits:")
+        for rec in run_stages(domtblout, reference, args.workdir, args.repeat, not args.no_memory):
+            results.append({"n_hits": n_hits, **rec})
+
+    report = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "modules": args.modules,
+        "repeat": args.repeat,
+        "max_rss_mb": md.max_rss_mb(),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results written to {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+    if tmp is not None:
+        tmp.cleanup()
+
+if __name__ == "__main__":
+    main()
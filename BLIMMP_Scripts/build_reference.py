@@ -0,0 +1,218 @@
+"""Rebuild ko_occurrences.txt and ko_neighbors.txt from a genome collection.
+
+Every input is the KO annotation table of one genome (KofamScan mapper
+output, eggNOG-mapper or GhostKOALA tables, plain KO lists); each KO id
+(K#####) on a line that is not a '#' comment counts as present, or only the
+one in --ko-column. KO presence is kept as one bitset over genomes per KO,
+so occurrence counts and the co-occurrence of candidate KO pairs are
+popcounts of ANDed rows, computed in chunks by a pool of processes.
+
+Candidate pairs are all KOs that share a module graph, plus any pairs
+given with --pairs. The neighbor weight of b for KO a is the fraction of
+the genomes with a that also carry b. Both files are written in the format
+module_detection.py reads; point it at them with --reference-data:
+
+    python BLIMMP_Scripts/build_reference.py isolates/ -o isolates_reference -j 8
+    python BLIMMP_Scripts/module_detection.py sample.domtblout -f domtblout -o out \\
+        --reference-data isolates_reference
+"""
+import argparse, bz2, gzip, lzma, os, re, sys, glob, time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd, numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+import module_detection as md
+
+KO_RE = re.compile(r"\bK\d{5}\b")
+COMMENT_RE = re.compile(r"^#.*$", re.M)
+PAIR_CHUNK_BYTES = 64 * 2**20      # presence bits ANDed at once per task
+POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+"""## Genome annotations"""
+
+def open_text(path):
+    # plain or compressed (.gz, .bz2, .xz) text
+    opener = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}.get(os.path.splitext(path)[1], open)
+    return opener(path, 'rt')
+
+def genome_files(inputs):
+    # files as given, every file of a directory, or glob matches; sorted per input
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(sorted(os.path.join(item, f) for f in os.listdir(item)
+                                if os.path.isfile(os.path.join(item, f)) and not f.startswith('.')))
+        elif os.path.isfile(item):
+            files.append(item)
+        else:
+            matches = sorted(glob.glob(item))
+            if not matches:
+                raise ValueError(f"No input matches {item}")
+            files.extend(matches)
+    if len(set(files)) != len(files):
+        raise ValueError("A genome file is given more than once")
+    return files
+
+def genome_kos(job):
+    # sorted KO ids annotated in one genome table
+    path, column = job
+    with open_text(path) as f:
+        text = COMMENT_RE.sub("", f.read())
+    if column is None:
+        return sorted(set(KO_RE.findall(text)))
+    kos = set()
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) > column and KO_RE.fullmatch(fields[column]):
+            kos.add(fields[column])
+    return sorted(kos)
+
+"""## Presence bitsets"""
+
+def presence_bits(genomes, ko_index):
+    # KO x genome presence, 8 genomes per byte, rows padded to whole uint64 words
+    n_words = -(-len(genomes) // 64)
+    bits = np.zeros((len(ko_index), n_words * 8), dtype=np.uint8)
+    rows = ko_index.get_indexer(np.concatenate([np.asarray(kos, dtype=object) for kos in genomes] or [[]]))
+    cols = np.repeat(np.arange(len(genomes)), [len(kos) for kos in genomes])
+    # one bit position at a time: each (KO, byte) cell is then set at most once
+    for bit in range(8):
+        sel = (cols & 7) == bit
+        bits[rows[sel], cols[sel] >> 3] |= np.uint8(1 << bit)
+    return bits.view(np.uint64)
+
+def popcount(words):
+    # set bits per row of a 2-D uint64 array
+    if hasattr(np, "bitwise_count"):     # numpy >= 2.0
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return POPCOUNT8[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+_WORKER_BITS = None
+
+def _init_pair_worker(bits):
+    global _WORKER_BITS
+    _WORKER_BITS = bits
+
+def _pair_counts(job):
+    a, b = job
+    return popcount(_WORKER_BITS[a] & _WORKER_BITS[b])
+
+def cooccurrence(bits, a, b, workers=1):
+    """Genomes carrying both KO rows a[i] and b[i], for every candidate pair i."""
+    chunk = max(1, PAIR_CHUNK_BYTES // max(1, bits.shape[1] * 8))
+    jobs = [(a[i:i + chunk], b[i:i + chunk]) for i in range(0, len(a), chunk)]
+    if not jobs:
+        return np.zeros(0, dtype=np.int64)
+    if workers == 1 or len(jobs) == 1:
+        _init_pair_worker(bits)
+        return np.concatenate([_pair_counts(job) for job in jobs])
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_pair_worker, initargs=(bits,)) as pool:
+        return np.concatenate(list(pool.map(_pair_counts, jobs)))
+
+"""## Candidate pairs"""
+
+def module_pairs(module_graphs):
+    # (a, b) for all KOs a != b that share a module graph
+    store = md.as_module_store(module_graphs)
+    pairs = set()
+    for module in store.modules("nodes"):
+        kos = sorted({n.split("_", 1)[0] for n in store.nodes(module) if n.startswith("K")})
+        pairs.update((a, b) for a in kos for b in kos if a != b)
+    return pairs
+
+def read_pairs(path):
+    # one KO pair per line; each pair is a neighbor relation in both directions
+    pairs = set()
+    with open_text(path) as f:
+        for line in f:
+            kos = KO_RE.findall(line)
+            if len(kos) >= 2 and kos[0] != kos[1]:
+                pairs.update([(kos[0], kos[1]), (kos[1], kos[0])])
+    return pairs
+
+"""## Output"""
+
+def write_ko_occurrences(path, counts, n_genomes):
+    # "KO_ID <genomes>" header, then every KO found in at least one genome
+    present = counts[counts > 0]
+    with open(path, "w") as f:
+        f.write(f"KO_ID\t{n_genomes}\n")
+        f.writelines(f"{ko}\t{n}\n" for ko, n in present.items())
+
+def write_ko_neighbors(path, neighbors, counts, decimals=2):
+    # KO:<occurrences>: NBR: weight, NBR: weight, ... as read by make_neighbor_dictionary
+    with open(path, "w") as f:
+        f.write("KO_IDs:0: \n")
+        for ko, group in neighbors.groupby('KO id', sort=True):
+            entries = ", ".join(f"{nbr}: {w:.{decimals}f}" for nbr, w in zip(group['neighbor'], group['weight']))
+            f.write(f"{ko}:{counts.get(ko, 0)}: {entries}\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Rebuild ko_occurrences.txt and ko_neighbors.txt from per-genome KO tables.')
+    parser.add_argument('inputs', nargs='+', help='KO annotation files (one per genome), directories or glob patterns')
+    parser.add_argument('-o', '--output', required=True, help='Output folder for ko_occurrences.txt and ko_neighbors.txt')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Worker processes (default 1)')
+    parser.add_argument('--ko-column', type=int, default=None, metavar='N',
+                        help='Take the KO id from whitespace column N (0-based) only, instead of any K##### on a line')
+    parser.add_argument('--module-graphs', default=None,
+                        help='Zip archive or folder with module_*_nodes.json for the candidate pairs '
+                             '(default: the one under Graph_Dependencies)')
+    parser.add_argument('--pairs', default=None, help='Extra candidate KO pairs, one pair per line')
+    parser.add_argument('--no-module-pairs', action='store_true', help='Only use the pairs given with --pairs')
+    parser.add_argument('--decimals', type=int, default=2, help='Decimals of the neighbor weights (default 2)')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.no_module_pairs and not args.pairs:
+        parser.error("--no-module-pairs needs --pairs")
+    try:
+        files = genome_files(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # 1) KO sets per genome
+    t0 = time.perf_counter()
+    jobs = [(path, args.ko_column) for path in files]
+    if args.workers == 1:
+        genomes = list(map(genome_kos, jobs))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            genomes = list(pool.map(genome_kos, jobs, chunksize=max(1, len(jobs) // (4 * args.workers))))
+    print(f"{len(genomes)} genomes read in {time.perf_counter() - t0:.1f} s")
+
+    # 2) candidate pairs
+    pairs = set()
+    if not args.no_module_pairs:
+        pairs |= module_pairs(args.module_graphs or md.find_module_graphs(HERE))
+    if args.pairs:
+        pairs |= read_pairs(args.pairs)
+    pairs = pd.DataFrame(sorted(pairs), columns=['KO id', 'neighbor'])
+
+    # 3) presence bitsets over every KO seen in a genome or a pair
+    ko_index = pd.Index(sorted(set().union(*genomes, pairs['KO id'], pairs['neighbor'])))
+    t0 = time.perf_counter()
+    bits = presence_bits(genomes, ko_index)
+    counts = pd.Series(popcount(bits), index=ko_index)
+    print(f"{len(ko_index)} KOs x {len(genomes)} genomes ({bits.nbytes / 2**20:.1f} MB of bits) "
+          f"in {time.perf_counter() - t0:.1f} s")
+
+    # 4) co-occurrence of the candidate pairs; weight = P(neighbor | KO)
+    t0 = time.perf_counter()
+    a, b = ko_index.get_indexer(pairs['KO id']), ko_index.get_indexer(pairs['neighbor'])
+    both = cooccurrence(bits, a, b, args.workers)
+    occ = counts.to_numpy()[a]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pairs['weight'] = np.where(occ > 0, both / occ, 0.0)
+    print(f"{len(pairs)} candidate pairs scored in {time.perf_counter() - t0:.1f} s")
+
+    os.makedirs(args.output, exist_ok=True)
+    occ_path = os.path.join(args.output, "ko_occurrences.txt")
+    nbr_path = os.path.join(args.output, "ko_neighbors.txt")
+    write_ko_occurrences(occ_path, counts, len(genomes))
+    write_ko_neighbors(nbr_path, pairs, counts, args.decimals)
+    print(f"Wrote {occ_path} and {nbr_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
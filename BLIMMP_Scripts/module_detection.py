@@ -1,6 +1,15 @@
 # -*- coding: utf-8 -*-
-import argparse, os, json, zipfile, glob, pandas as pd, numpy as np
+import argparse, gzip, io, os, re, sys, json, time, math, shutil, tempfile, threading, uuid, zipfile, glob, hashlib, pickle, signal, cProfile, secrets, hmac, mimetypes, pandas as pd, numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from importlib.util import find_spec
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
 from math import exp
+try:
+    import resource
+except ImportError:    # not available on Windows
+    resource = None
 
 #Process TBL file
 
@@ -11,47 +20,93 @@ def process_tbl(location):
     return pd.read_csv(location, header=None, skiprows=2, skipfooter=8,
                        names=cols, sep=r"\s+", engine='python')
 
-#Process HMM result files                                              
-def process_domtblout(path):
-    cols = [
-        'target name', 'target_accession', 'tlen', 'query_name',
-        'query_accession', 'qlen', 'full_Evalue', 'full_score',
-        'full_bias', 'n_domains', 'of_domains', 'c_Evalue',
-        'i_Evalue', 'i_score', 'i_bias', 'hmm from', 'hmm to',
-        'ali from', 'ali to', 'env from', 'env to', 'acc', 'description'
-    ]
-
-    # skiprows=3 to drop the first 3 lines
-    # skipfooter=10 to drop the last 10 lines 
-    df = pd.read_csv(
+#Process HMM result files
+# Positions of the columns we keep from a domtblout line (0-based). Selecting by
+# position rather than by name keeps the C tokenizer happy when the free-text
+# description at the end of a line contains spaces.
+DOMTBLOUT_COLUMNS = {
+    0:  'target name',
+    3:  'query_name',
+    12: 'i_Evalue',
+    13: 'i_score',
+    15: 'hmm from',
+    16: 'hmm to',
+    17: 'ali from',
+    18: 'ali to',
+}
+DOMTBLOUT_DTYPES = {
+    'target name': 'category',
+    'query_name':  'category',
+    'i_Evalue':    np.float64,
+    'i_score':     np.float64,
+    'hmm from':    np.int32,
+    'hmm to':      np.int32,
+    'ali from':    np.int32,
+    'ali to':      np.int32,
+}
+DOMTBLOUT_CHUNKSIZE = 1_000_000
+
+def read_domtblout_chunks(path, chunksize=DOMTBLOUT_CHUNKSIZE):
+    # C engine, whitespace separated. Header, footer and any trailing
+    # "# ..." text are dropped through comment='#', so no skipfooter is needed
+    # and the file is never held in memory as a whole. Compression (gzip, bz2,
+    # xz, zstd) is inferred from the file extension.
+    positions = sorted(DOMTBLOUT_COLUMNS)
+    names = [DOMTBLOUT_COLUMNS[i] for i in positions]
+    reader = pd.read_csv(
         path,
         comment='#',
         sep=r'\s+',
-        names=cols,
-        usecols=[
-            'target name','query_name',
-            'hmm from','hmm to',
-            'ali from','ali to',
-            'i_score','i_Evalue'
-        ],
-        skiprows=3,
-        skipfooter=10,
-        engine='python'
+        header=None,
+        usecols=positions,
+        dtype={i: DOMTBLOUT_DTYPES[DOMTBLOUT_COLUMNS[i]] for i in positions},
+        compression='infer',
+        chunksize=chunksize,
+        engine='c'
     )
+    with reader:
+        for chunk in reader:
+            chunk.columns = names
+            yield chunk
 
-    df.rename(columns={'query_name': 'KO id','i_score':'score','i_Evalue':'E-value'}, inplace=True)
+DOMTBLOUT_RENAMES = {'query_name': 'KO id','i_score':'score','i_Evalue':'E-value'}
 
-    # compute inclusive lengths and filter out any zero‐length hits
-    df['ali_len'] = abs(df['ali to'] - df['ali from'])
-    df['hmm_len'] = abs(df['hmm to'] - df['hmm from'])
+def filter_domtblout_chunk(df):
+    df = df.rename(columns=DOMTBLOUT_RENAMES)
+    return positive_length_hits(df)
 
+def positive_length_hits(df):
     # keep only rows where both alignment lengths are positive
-    df = df[(df['ali_len'] > 0) & (df['hmm_len'] > 0)].copy()
-
-    # drop the helper columns
-    df.drop(columns=['ali_len','hmm_len'], inplace=True)
-
-    return df            
+    keep = (df['ali to'] != df['ali from']) & (df['hmm to'] != df['hmm from'])
+    return df[keep]
+
+def encode_categorical(values, categories=None):
+    # dictionary-encode values; categories (e.g. the reference KO table) come
+    # first so their codes are stable, unseen values follow in order of appearance
+    seen = pd.Index(pd.unique(values.dropna()).astype(str))
+    if categories is not None:
+        categories = pd.Index(categories).astype(str)
+        seen = categories.append(seen[~seen.isin(categories)])
+    return pd.Categorical(values, categories=seen)
+
+def process_domtblout(path, chunksize=DOMTBLOUT_CHUNKSIZE, ko_table=None):
+    # Row labels keep counting across chunks, so the index matches the
+    # position of each hit among the data lines of the file. Target names
+    # and KO ids stay categorical; all chunks share one set of categories,
+    # led by ko_table for the KO ids when given.
+    chunks = [filter_domtblout_chunk(chunk) for chunk in read_domtblout_chunks(path, chunksize)]
+    return concat_hit_chunks(chunks, ko_table)
+
+def concat_hit_chunks(chunks, ko_table=None):
+    # chunks were encoded separately; recode them onto shared categories
+    for col, seed in (('target name', None), ('KO id', ko_table)):
+        parts = [chunk[col].array for chunk in chunks]
+        if seed is not None:
+            parts.insert(0, pd.Categorical([], categories=seed))
+        categories = pd.api.types.union_categoricals(parts, sort_categories=False).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks) if len(chunks) > 1 else chunks[0]
 
 # Get the clusters/group data
 
@@ -60,7 +115,7 @@ def cluster_strand(df, from_col="ali from", to_col="ali to"):
     df = df.copy()
     df["start"] = df[[from_col,to_col]].min(axis=1)
     df["end"]   = df[[from_col,to_col]].max(axis=1)
-    df = df.sort_values("start").reset_index()
+    df = df.sort_values("start", kind="stable").reset_index()
 
     groups = []        # each group: {"id": int, "end": float}
     grp_ids = []       # to collect group-id per row
@@ -92,51 +147,156 @@ def cluster_strand(df, from_col="ali from", to_col="ali to"):
     # restore original order & index
     return df.set_index("index").sort_index()[["grp_id"]]
 
-def assign_overlap_groups(df_hits):
-    # 1) strand column
+OVERLAP_MIN_FRAC = 0.6
+
+def sweep_overlap_groups(run_codes, start, end, min_frac=OVERLAP_MIN_FRAC):
+    """Sweep-line version of cluster_strand over every (target, strand) run at once.
+
+    run_codes identifies the (target, strand) run of each hit. Returns the
+    grp_id of each hit, numbered per run from 1 exactly as cluster_strand
+    does; ties on start keep the input order.
+    """
+    n = len(start)
+    grp_ids = np.zeros(n, dtype=np.int64)
+    if n == 0:
+        return grp_ids
+
+    # 1) one sort across all runs: by run, then by start
+    order = np.lexsort((start, run_codes))
+    run_s, s_s, e_s = run_codes[order], start[order], end[order]
+
+    # 2) split every run into connected components: a hit that starts after
+    #    the furthest end seen so far in its run cannot join any open group.
+    new_run = np.empty(n, dtype=bool)
+    new_run[0] = True
+    np.not_equal(run_s[1:], run_s[:-1], out=new_run[1:])
+    run_idx = np.cumsum(new_run) - 1
+    span = np.int64(e_s.max()) - min(np.int64(s_s.min()), 0) + 1
+    reach = np.maximum.accumulate(e_s.astype(np.int64) + run_idx * span) - run_idx * span
+    new_comp = new_run.copy()
+    new_comp[1:] |= s_s[1:] > reach[:-1]
+    comp_starts = np.flatnonzero(new_comp)
+    comp_sizes = np.diff(np.append(comp_starts, n))
+
+    # 3) singletons open one group each; only components with several hits
+    #    need the greedy first-fit scan over their open groups
+    local_ids = np.ones(n, dtype=np.int64)
+    comp_groups = np.ones(len(comp_starts), dtype=np.int64)
+    s_list, e_list = s_s.tolist(), e_s.tolist()
+    for c in np.flatnonzero(comp_sizes > 1).tolist():
+        lo = comp_starts[c]
+        groups = []    # open groups in creation order: [start, end, id]
+        for i in range(lo, lo + comp_sizes[c]):
+            s, e = s_list[i], e_list[i]
+            for grp in groups:
+                if s <= grp[1]:
+                    overlap = max(0, min(e, grp[1]) - max(s, grp[0]))
+                    if overlap / min(e - s, grp[1] - grp[0]) >= min_frac:
+                        local_ids[i] = grp[2]
+                        grp[0] = min(grp[0], s)
+                        grp[1] = max(grp[1], e)
+                        break
+            else:
+                groups.append([s, e, len(groups) + 1])
+                local_ids[i] = len(groups)
+        comp_groups[c] = len(groups)
+
+    # 4) offset component-local ids by the groups opened earlier in the run
+    created = np.cumsum(comp_groups)
+    comp_run_start = np.maximum.accumulate(np.where(new_run[comp_starts], np.arange(len(comp_starts)), 0))
+    offset = created - comp_groups - (created[comp_run_start] - comp_groups[comp_run_start])
+    comp_of_row = np.cumsum(new_comp) - 1
+    grp_ids[order] = local_ids + offset[comp_of_row]
+    return grp_ids
+
+STRANDS = pd.CategoricalDtype(["+", "-"])
+
+def assign_overlap_groups(df_hits, engine="sweep"):
+    # 1) strand column, categorical (+ = code 0, - = code 1)
     df = df_hits.copy()
-    df["strand"] = np.where(df["ali to"] >= df["ali from"], "+", "-")
-
-    # 2) per‐target, per‐strand clustering
-    out = []
-    for (tgt, strand), sub in df.groupby(["target name","strand"], sort=False):
-        clustered = cluster_strand(sub)
-        # merge grp_id back onto sub
-        sub = sub.join(clustered, how="left")
-        out.append(sub)
-
-    # 3) combine all targets & strands
-    result = pd.concat(out).sort_index()
-    # new label: target_subgroup
-    result["overlap_group"] = (
-        result["target name"]
-        .astype(str)
-        + "_"
-        + result["grp_id"].astype(str)
-        + "_"
-        + result["strand"].astype(str)
-    )
+    minus = (df["ali to"] < df["ali from"]).to_numpy()
+    df["strand"] = pd.Categorical.from_codes(minus.astype(np.int8), dtype=STRANDS)
+
+    if engine == "iterrows":
+        # reference implementation: per-target, per-strand clustering
+        out = []
+        for (tgt, strand), sub in df.groupby(["target name","strand"], sort=False, observed=True):
+            clustered = cluster_strand(sub)
+            # merge grp_id back onto sub
+            sub = sub.join(clustered, how="left")
+            out.append(sub)
+        result = pd.concat(out).sort_index()
+    else:
+        # 2) single sweep over all targets & strands
+        target_codes = pd.factorize(df["target name"])[0].astype(np.int64)
+        run_codes = target_codes * 2 + minus
+        ali_from, ali_to = df["ali from"].to_numpy(), df["ali to"].to_numpy()
+        df["grp_id"] = sweep_overlap_groups(run_codes, np.minimum(ali_from, ali_to), np.maximum(ali_from, ali_to))
+        result = df.sort_index()
+
+    # 3) integer overlap group per (target, strand, grp_id), numbered in order
+    #    of the target's first hit, then strand, then grp_id. The
+    #    target_grp_strand text label is built by overlap_group_labels for the
+    #    rows that are written out.
+    run_codes = pd.factorize(result["target name"])[0].astype(np.int64) * 2 + result["strand"].cat.codes.to_numpy()
+    grp = result["grp_id"].to_numpy(dtype=np.int64)
+    result["grp_id"] = grp.astype(np.int32)
+    result["overlap_group"] = np.unique(run_codes * (grp.max(initial=0) + 1) + grp, return_inverse=True)[1].astype(np.int32)
     return result
 
-def calculate_hit_confidence_log(df, e_threshold=1e-5):
+def overlap_group_labels(df):
+    # "target_grp_strand" text of the overlap group of each row (NaN without a hit)
+    labels = (df["target name"].astype(object) + "_" + df["grp_id"].astype("Int64").astype(str)
+              + "_" + df["strand"].astype(object))
+    return labels.where(df["grp_id"].notna())
+
+def segmented_logsumexp(values, codes, n_groups):
+    # max-shifted log-sum-exp of values within each integer group code
+    gmax = np.full(n_groups, -np.inf)
+    with np.errstate(invalid='ignore'):
+        np.maximum.at(gmax, codes, values)
+    shift = np.where(np.isneginf(gmax), 0.0, gmax)
+    sums = np.bincount(codes, weights=np.exp(values - shift[codes]), minlength=n_groups)
+    with np.errstate(divide='ignore'):
+        return shift + np.log(sums)
+
+def segmented_argmax(values, codes, n_groups):
+    # position of the first maximum (NaN skipped) within each group code,
+    # ordered by code; groups with no finite value are left out
+    gbest = np.full(n_groups, -np.inf)
+    np.fmax.at(gbest, codes, values)
+    cand = np.flatnonzero(values == gbest[codes])
+    _, first = np.unique(codes[cand], return_index=True)
+    return cand[first]
+
+E_THRESHOLD = 1e-5
+
+def calculate_hit_confidence_log(df, e_threshold=E_THRESHOLD):
     df = df.copy()
+    # integer group codes; sorted so groups come out in label order
+    codes, uniques = pd.factorize(df['overlap_group'], sort=True)
+    n_groups = len(uniques)
+
     # 1) noise term in log-space (natural log)
     #    noise_weight = 2**(-log2(e_threshold)) noise_logw = -ln(e_threshold)
     noise_logw = -np.log(e_threshold)
 
     # 2) per-hit log-weight: ln(2**score) = score * ln(2)
-    df['log_per_hit_weight'] = df['score'] * np.log(2)
+    log_w = df['score'].to_numpy(dtype=np.float64) * np.log(2)
+    df['log_per_hit_weight'] = log_w
 
     # 3) group log-sum of per-hit weights
-    df['group_log_sum'] = df.groupby('overlap_group')['log_per_hit_weight'] \
-                             .transform(lambda x: np.logaddexp.reduce(x.values))
+    group_log_sum = segmented_logsumexp(log_w, codes, n_groups)[codes]
+    df['group_log_sum'] = group_log_sum
 
     # 4) total log-weight = log(group_sum + noise_weight)
-    df['total_log_weight'] = np.logaddexp(df['group_log_sum'], noise_logw)
+    total_log_weight = np.logaddexp(group_log_sum, noise_logw)
+    df['total_log_weight'] = total_log_weight
 
     # 5) hit confidence = per_hit_weight / total_weight
     #    in log-space: exp(log_w − total_log_w)
-    df['hit_conf'] = np.exp(df['log_per_hit_weight'] - df['total_log_weight'])
+    hit_conf = np.exp(log_w - total_log_weight)
+    df['hit_conf'] = hit_conf
 
     # 6) debug: print any stragglers
     nan_rows = df[df['hit_conf'].isna()][[
@@ -146,21 +306,18 @@ def calculate_hit_confidence_log(df, e_threshold=1e-5):
         print("Rows with NaN hit_conf:\n", nan_rows)
 
     # 7) pick the max-confidence row per overlap_group
-    idx = (
-      df
-      .groupby('overlap_group')['hit_conf']
-      .idxmax()
-      .dropna()        # drop any NaN idx (should be none)
-      .astype(int)
-    )
-    df_max_conf = df.loc[idx].reset_index(drop=True)
+    df_max_conf = df.iloc[segmented_argmax(hit_conf, codes, n_groups)].reset_index(drop=True)
     return df_max_conf
 
+KO_OCCURRENCE_GENOMES = 895    # genomes counted in the shipped ko_occurrences.txt, which has no header
+
 def read_ko_occurence_txt(KO_OCCURRENCES_TXT):
   ko_occ = pd.read_csv(KO_OCCURRENCES_TXT, sep=r"\s+", names=['KO id','occurences'])
-  idx = ko_occ[ko_occ['KO id'] == "KO_ID"].index
-  ko_occ.drop(idx, inplace=True)
-  ko_occ['KO_freq'] = ko_occ['occurences'] / 895
+  # files written by build_reference.py start with a "KO_ID <number of genomes>" line
+  header = ko_occ[ko_occ['KO id'] == "KO_ID"]
+  n_genomes = int(header['occurences'].iloc[0]) if len(header) else KO_OCCURRENCE_GENOMES
+  ko_occ.drop(header.index, inplace=True)
+  ko_occ['KO_freq'] = ko_occ['occurences'] / n_genomes
 
   return ko_occ
 
@@ -172,8 +329,19 @@ def read_ko_occurence_txt(KO_OCCURRENCES_TXT):
 
 """## Dk Calculation"""
 
-def calculate_dk_per_ko(ko_occurences, bath_hits, sigma_val):
-  df_dk = (bath_hits.merge(ko_occurences, on='KO id', how='left').fillna({'occurences':0,'KO_freq':1e-4}))
+def occurrence_rows(ko_occurences, occ_rows):
+  # ko_occurences columns for given row positions, NaN where the position is -1
+  occ = ko_occurences.drop(columns='KO id').reset_index(drop=True)
+  return occ.reindex(occ_rows).reset_index(drop=True)
+
+def calculate_dk_per_ko(ko_occurences, bath_hits, sigma_val, occ_rows=None):
+  # occ_rows: ko_occurences row of every bath_hits row (-1 for none), taken
+  # from the integer KO codes; without it the tables are merged on 'KO id'
+  if occ_rows is None:
+    df_dk = bath_hits.merge(ko_occurences, on='KO id', how='left')
+  else:
+    df_dk = pd.concat([bath_hits.reset_index(drop=True), occurrence_rows(ko_occurences, occ_rows)], axis=1)
+  df_dk = df_dk.fillna({'occurences':0,'KO_freq':1e-4})
   sigma_val_1 = 1 - ((np.exp(3 * sigma_val) - 1) / np.exp(3))
   df_dk['sigma'] = sigma_val_1
   df_dk['Dk']  = (df_dk['hit_conf']+ (1 - df_dk['hit_conf']) * df_dk['sigma'] * df_dk['KO_freq'])
@@ -207,34 +375,214 @@ def make_neighbor_dictionary(NEIGHBOR_TXT):
 
 
 
-def spring_update_probabilities(dk_dict, adjacency, alpha=0.6):
-  new_dk = {}
-  for i, p_i in dk_dict.items():
-      #print(i,p_i)
-      nbrs = adjacency.get(i, {})
-      #print(len(nbrs))
-      if not nbrs:
-          new_dk[i] = p_i; continue
-      sum_e = sum(nbrs.values())
-      #print(sum_e)
-      X     = alpha ** (1.0 / sum_e)
-      #print(X)
-      a_i   = 1.0 - p_i
-      #print(nbrs)
-      shift = sum(a_i * (w/sum_e)*X * dk_dict.get(j,0.0) for j,w in nbrs.items())
-      #print(shift)
-      #new_dk[i] = min(p_i + shift, 1.0)
-      new_dk[i] = min(p_i + shift,1.0)
-
-  df_spring = (pd.DataFrame.from_dict(new_dk, orient="index", columns=["Dk_Neighbors"])
-          .reset_index()
-          .rename(columns={"index": "KO id"}))
+class NeighborMatrix:
+    """ko_neighbors.txt adjacency as a CSR matrix over a fixed KO index.
+
+    Row i holds the neighbors j of KO i with coefficient
+    (w_ij / sum_e_i) * alpha ** (1 / sum_e_i), so one diffusion step is a
+    single sparse matrix-vector product.
+    """
+
+    def __init__(self, ko_ids, indptr, indices, weights, alpha=0.6):
+        self.ko_ids = np.asarray(ko_ids, dtype=object)
+        self.index = {ko: i for i, ko in enumerate(self.ko_ids)}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        n = len(self.ko_ids)
+        self.rows = np.repeat(np.arange(n, dtype=np.int32), np.diff(self.indptr))
+        self.row_sum = np.bincount(self.rows, weights=self.weights, minlength=n)
+        self.has_neighbors = np.diff(self.indptr) > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.norm = self.weights / self.row_sum[self.rows]
+        self.alpha = alpha
+        self.coef = self.coefficients(alpha)
+
+    @classmethod
+    def from_adjacency(cls, adjacency, alpha=0.6):
+        # rows in adjacency order, KOs that only appear as neighbors after them
+        ko_ids = list(adjacency)
+        index = {ko: i for i, ko in enumerate(ko_ids)}
+        indptr, indices, weights = [0], [], []
+        for ko in list(adjacency):
+            for nbr, w in adjacency[ko].items():
+                if nbr not in index:
+                    index[nbr] = len(ko_ids)
+                    ko_ids.append(nbr)
+                indices.append(index[nbr])
+                weights.append(w)
+            indptr.append(len(indices))
+        indptr += [len(indices)] * (len(ko_ids) - len(indptr) + 1)
+        return cls(ko_ids, indptr, indices, weights, alpha)
+
+    def coefficients(self, alpha):
+        with np.errstate(divide='ignore'):
+            X = alpha ** (1.0 / self.row_sum)
+        return self.norm * X[self.rows]
+
+    def positions(self, kos):
+        # position of each KO in the matrix index, -1 if it has no entry
+        return np.fromiter((self.index.get(k, -1) for k in kos), dtype=np.int64, count=len(kos))
+
+    def matvec(self, x, coef=None):
+        coef = self.coef if coef is None else coef
+        return np.bincount(self.rows, weights=coef * x[self.indices], minlength=len(self.ko_ids))
+
+    def join_rows(self, edge_strings, edge_lengths):
+        # ",".join of each row's edge strings: one join over all edges, then
+        # one slice per row at the cumulative string offsets
+        text = ",".join(edge_strings)
+        starts = np.concatenate(([0], np.cumsum(edge_lengths + 1)))
+        lo, hi = starts[self.indptr[:-1]], starts[self.indptr[1:]] - 1
+        return [text[a:b] if b > a else "" for a, b in zip(lo.tolist(), hi.tolist())]
+
+    def row_text(self):
+        # per KO: comma-joined neighbor ids and weights; sample independent, built once
+        if getattr(self, "_row_text", None) is None:
+            ids = self.ko_ids[self.indices]
+            weights = [str(w) for w in self.weights.tolist()]
+            self._row_text = (
+                self.join_rows(ids, np.fromiter(map(len, ids), dtype=np.int64, count=len(ids))),
+                self.join_rows(weights, np.fromiter(map(len, weights), dtype=np.int64, count=len(weights))),
+            )
+        return self._row_text
+
+    def matvec_norm(self, x):
+        # sum_j (w_ij / sum_e_i) * x[..., j] for a stack of vectors x (..., n)
+        out = np.zeros(x.shape)
+        if len(self.indices):
+            starts = self.indptr[:-1][self.has_neighbors]
+            out[..., self.has_neighbors] = np.add.reduceat(x[..., self.indices] * self.norm, starts, axis=-1)
+        return out
+
+
+def spring_update_probabilities(dk_dict, adjacency, alpha=0.6, iterations=1, tol=None):
+  # adjacency: nested dict from make_neighbor_dictionary or a NeighborMatrix
+  if isinstance(adjacency, NeighborMatrix):
+      nm = adjacency
+  else:
+      nm = NeighborMatrix.from_adjacency(adjacency, alpha)
+  coef = nm.coef if nm.alpha == alpha else nm.coefficients(alpha)
+
+  kos = list(dk_dict)
+  dk = np.fromiter(dk_dict.values(), dtype=np.float64, count=len(kos))
+  pos = nm.positions(kos)
+  known = pos >= 0
+
+  # KOs missing from dk_dict stay at 0.0 and are never updated
+  x = np.zeros(len(nm.ko_ids))
+  x[pos[known]] = dk[known]
+  update = pos[known]
+  update = update[nm.has_neighbors[update]]
+
+  for it in range(1, iterations + 1):
+      p_i = x[update]
+      shift = nm.matvec(x, coef)[update]
+      new = np.minimum(p_i + (1.0 - p_i) * shift, 1.0)
+      delta = np.max(np.abs(new - p_i)) if len(update) else 0.0
+      x[update] = new
+      if tol is not None and delta < tol:
+          break
+  if iterations > 1:
+      print(f"Neighbor diffusion stopped after {it} iteration(s), max change {delta:.3g}")
+
+  new_dk = dk.copy()
+  new_dk[known] = x[pos[known]]
+  df_spring = pd.DataFrame({"KO id": kos, "Dk_Neighbors": new_dk})
   return df_spring
 
 
 
 """## Modules"""
 
+MODULE_MEMBER_RE = re.compile(r"^module_(.+)_(nodes|paths|edges)\.json$")
+
+class ModuleGraphStore:
+    """Read-only access to the module_<id>_{nodes,paths,edges}.json files.
+
+    source is either a zip archive (members may sit in any sub-folder) or a
+    directory. Members are parsed on first use and kept in memory; nothing
+    is extracted or written.
+    """
+
+    def __init__(self, source):
+        self.source = os.path.abspath(source)
+        self.is_zip = os.path.isfile(self.source)
+        self._zip = self._zip_pid = None
+        self._cache = {}
+        self.members = {}     # (module, kind) -> member name or file path
+        if self.is_zip:
+            names = self._archive().namelist()
+        else:
+            names = [os.path.join(self.source, f) for f in sorted(os.listdir(self.source))]
+        for name in names:
+            match = MODULE_MEMBER_RE.match(os.path.basename(name))
+            if match:
+                self.members.setdefault((match.group(1), match.group(2)), name)
+
+    def __getstate__(self):
+        # open archives are not shared between processes
+        state = self.__dict__.copy()
+        state["_zip"] = state["_zip_pid"] = None
+        return state
+
+    def _archive(self):
+        if self._zip is None or self._zip_pid != os.getpid():
+            self._zip, self._zip_pid = zipfile.ZipFile(self.source), os.getpid()
+        return self._zip
+
+    def modules(self, kind="nodes"):
+        return sorted(m for m, k in self.members if k == kind)
+
+    def has(self, module, kind):
+        return (module, kind) in self.members
+
+    def load(self, module, kind):
+        key = (module, kind)
+        if key not in self._cache:
+            name = self.members[key]
+            if self.is_zip:
+                with self._archive().open(name) as f:
+                    self._cache[key] = json.load(f)
+            else:
+                with open(name) as f:
+                    self._cache[key] = json.load(f)
+        return self._cache[key]
+
+    def nodes(self, module):
+        return self.load(module, "nodes")
+
+    def paths(self, module):
+        return self.load(module, "paths")
+
+    def source_files(self, kind="nodes"):
+        # files whose content determines the data of the given kind
+        if self.is_zip:
+            return [self.source]
+        return [self.members[(m, kind)] for m in self.modules(kind)]
+
+def as_module_store(module_source):
+    # functions below accept a ModuleGraphStore or a plain directory path
+    if isinstance(module_source, ModuleGraphStore):
+        return module_source
+    return ModuleGraphStore(module_source)
+
+def find_module_graphs(HERE):
+    """Module graph source shipped with the scripts, without unpacking it.
+
+    Prefers an already extracted KEGG_Module_Graphs folder, otherwise the
+    first zip archive under Graph_Dependencies.
+    """
+    GD = os.path.join(HERE, "Graph_Dependencies")
+    UNZIP_SUBDIR = os.path.join(GD, "KEGG_Graphs_Generated", "KEGG_Module_Graphs")
+    if glob.glob(os.path.join(UNZIP_SUBDIR, "module_*_nodes.json")):
+        return UNZIP_SUBDIR
+    for root, _, files in sorted(os.walk(GD)):
+        for fname in sorted(files):
+            if fname.lower().endswith('.zip'):
+                return os.path.join(root, fname)
+    raise FileNotFoundError(f"No module graphs (KEGG_Module_Graphs folder or .zip) under {GD}")
+
 def module_kos():
   #Access all module info
   glob.glob(os.path.join(MODULE_JSON_DIR, "module_*_paths.json"))
@@ -289,17 +637,11 @@ def find_most_probable_row(paths_dict, dk_map_before, dk_map_after):
 
 def path_probabilities(module_json_dir, dk_map_before, dk_map_after):
     best_rows = []
-    pattern = os.path.join(module_json_dir, "module_*_paths.json")
-    json_files = glob.glob(pattern)
-
-    for json_file in json_files:
-        # Extract module name from filename, e.g. 'module_M00001'
-        module_name_1 = os.path.basename(json_file).split("_paths.json")[0]
-        module_name = os.path.basename(module_name_1).split("module_")[-1]
+    store = as_module_store(module_json_dir)
 
+    for module_name in store.modules("paths"):
         # Load the dictionary of paths for this module
-        with open(json_file) as f:
-            paths_dict = json.load(f)
+        paths_dict = store.paths(module_name)
 
         # Compute best path for this module
         best = find_most_probable_row(paths_dict, dk_map_before, dk_map_after)
@@ -323,18 +665,418 @@ def path_probabilities(module_json_dir, dk_map_before, dk_map_after):
     df_best = df_best[columns_order]
     return df_best
 
+"""## Compiled path index"""
+
+def default_cache_dir():
+    # never inside the installation tree; BLIMMP_CACHE_DIR overrides
+    return os.environ.get("BLIMMP_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "BLIMMP")
+
+def files_signature(paths):
+    # cheap fingerprint of a set of files: names, sizes and mtimes
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        st = os.stat(path)
+        h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+class PathIndex:
+    """Every path of every module, integer coded.
+
+    tokens holds the node codes of all paths back to back; path i spans
+    tokens[path_offsets[i]:path_offsets[i+1]] and module m spans paths
+    module_offsets[m]:module_offsets[m+1]. node_ko maps a node code to its
+    KO code (-1 for nodes without "_", which never enter the product) and
+    node_counted marks the nodes that count towards the path length.
+    """
+
+    ARRAYS = ("modules", "module_offsets", "path_ids", "path_offsets",
+              "tokens", "nodes", "node_ko", "node_counted", "kos")
+
+    def __init__(self, modules, module_offsets, path_ids, path_offsets,
+                 tokens, nodes, node_ko, node_counted, kos):
+        self.modules = np.asarray(modules, dtype=str)
+        self.module_offsets = np.asarray(module_offsets, dtype=np.int64)
+        self.path_ids = np.asarray(path_ids, dtype=np.int64)
+        self.path_offsets = np.asarray(path_offsets, dtype=np.int64)
+        self.tokens = np.asarray(tokens, dtype=np.int32)
+        self.nodes = np.asarray(nodes, dtype=str)
+        self.node_ko = np.asarray(node_ko, dtype=np.int32)
+        self.node_counted = np.asarray(node_counted, dtype=bool)
+        self.kos = np.asarray(kos, dtype=str)
+
+        # derived per-path layout used by the scoring kernel
+        n_paths = len(self.path_ids)
+        token_path = np.repeat(np.arange(n_paths), np.diff(self.path_offsets))
+        token_ko = self.node_ko[self.tokens]
+        factor = token_ko >= 0
+        self.factor_ko = token_ko[factor]
+        factor_counts = np.bincount(token_path[factor], minlength=n_paths)
+        self.factor_starts = (np.cumsum(factor_counts) - factor_counts)[factor_counts > 0]
+        self.has_factors = factor_counts > 0
+        self.path_len = np.bincount(token_path, weights=self.node_counted[self.tokens], minlength=n_paths)
+        self.path_module = np.repeat(np.arange(len(self.modules)), np.diff(self.module_offsets))
+
+    @classmethod
+    def compile(cls, module_json_dir):
+        store = as_module_store(module_json_dir)
+        nodes, node_index, kos, ko_index = [], {}, [], {}
+        node_ko, node_counted = [], []
+        modules, module_offsets, path_ids, path_offsets, tokens = [], [0], [], [0], []
+
+        def node_code(node):
+            code = node_index.get(node)
+            if code is None:
+                code = node_index[node] = len(nodes)
+                nodes.append(node)
+                if '_' in node:
+                    ko = node.split("_")[0]
+                    if ko not in ko_index:
+                        ko_index[ko] = len(kos)
+                        kos.append(ko)
+                    node_ko.append(ko_index[ko])
+                else:
+                    node_ko.append(-1)
+                node_counted.append('K' in node)
+            return code
+
+        for module_name in store.modules("paths"):
+            modules.append(module_name)
+            paths_dict = store.paths(module_name)
+            for pid, comma in paths_dict.items():
+                path_ids.append(int(pid))
+                tokens.extend(node_code(n.strip()) for n in comma.split(","))
+                path_offsets.append(len(tokens))
+            module_offsets.append(len(path_ids))
+
+        return cls(modules, module_offsets, path_ids, path_offsets,
+                   tokens, nodes, node_ko, node_counted, kos)
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, **{name: getattr(self, name) for name in self.ARRAYS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(*(data[name] for name in cls.ARRAYS))
+
+    def path_str(self, i):
+        lo, hi = self.path_offsets[i], self.path_offsets[i + 1]
+        return " -> ".join(self.nodes[self.tokens[lo:hi]])
+
+    def score(self, dk_maps):
+        """raw and geometric-mean scores of every path under each dk map.
+
+        Same semantics as score_path: KOs missing from a map count as 1.0 and
+        a path with a zero factor or no counted node scores 0. Returns two
+        arrays of shape (len(dk_maps), n_paths).
+        """
+        log_dk = np.zeros((len(dk_maps), len(self.kos)))
+        with np.errstate(divide='ignore'):
+            for r, dk_map in enumerate(dk_maps):
+                log_dk[r] = np.log(np.fromiter((dk_map.get(ko, 1.0) for ko in self.kos),
+                                               dtype=np.float64, count=len(self.kos)))
+        return self.score_log(log_dk)
+
+    def score_log(self, log_dk):
+        # log_dk: (..., n_kos) log-probabilities; one segmented sum per path
+        log_dk = np.asarray(log_dk, dtype=np.float64)
+        log_raw = np.zeros(log_dk.shape[:-1] + (len(self.path_ids),))
+        if len(self.factor_starts):
+            log_raw[..., self.has_factors] = np.add.reduceat(
+                log_dk[..., self.factor_ko], self.factor_starts, axis=-1)
+        scored = (self.path_len > 0) & np.isfinite(log_raw)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            geo = np.where(scored, np.exp(log_raw / self.path_len), 0.0)
+        return np.exp(log_raw), geo
+
+def load_path_index(module_json_dir, cache_dir=None):
+    # compiled once per set of path files, then reloaded from the cache
+    store = as_module_store(module_json_dir)
+    cache_dir = cache_dir or default_cache_dir()
+    cache_file = os.path.join(cache_dir, f"path_index_{files_signature(store.source_files('paths'))}.npz")
+    if os.path.isfile(cache_file):
+        return PathIndex.load(cache_file)
+    index = PathIndex.compile(store)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        index.save(cache_file)
+    except OSError as e:
+        print(f"Could not write path index cache to {cache_dir}: {e}")
+    return index
+
+def top_k_positions(scores, k):
+    # positions of the k largest scores, best first; ties go to the earlier
+    # position. Partial selection, the segment is never fully sorted.
+    if len(scores) > k:
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        sel = np.concatenate([above, np.flatnonzero(scores == kth)[:k - len(above)]])
+    else:
+        sel = np.arange(len(scores))
+    return sel[np.lexsort((sel, -scores[sel]))]
+
+def indexed_path_probabilities(path_index, dk_map_before, dk_map_after, top_k=1):
+    # same table as path_probabilities, scored from the compiled index.
+    # With top_k > 1 each module gets its top_k paths by geo_after and a
+    # 'rank' column (1 = best).
+    raw, geo = path_index.score([dk_map_before, dk_map_after])
+    if top_k == 1:
+        best = segmented_argmax(geo[1], path_index.path_module, len(path_index.modules))
+        ranks = None
+    else:
+        best, ranks = [], []
+        offsets = path_index.module_offsets
+        for m in range(len(path_index.modules)):
+            lo, hi = offsets[m], offsets[m + 1]
+            sel = lo + top_k_positions(geo[1, lo:hi], top_k)
+            best.append(sel)
+            ranks.append(np.arange(1, len(sel) + 1))
+        best = np.concatenate(best).astype(np.int64)
+        ranks = np.concatenate(ranks)
+
+    df_best = pd.DataFrame({
+        'module':     path_index.modules[path_index.path_module[best]],
+        'path_id':    path_index.path_ids[best],
+        'path_str':   [path_index.path_str(i) for i in best],
+        'raw_before': raw[0, best],
+        'geo_before': geo[0, best],
+        'raw_after':  raw[1, best],
+        'geo_after':  geo[1, best],
+    })
+    if ranks is not None:
+        df_best.insert(1, 'rank', ranks)
+    return df_best
+
+"""## Best path by dynamic programming"""
+
+def load_module_graph(module_json_dir, module):
+    """Edges, sources and sinks of one module graph.
+
+    Uses module_<id>_edges.json when present (either {"src": ["dst", ...]}
+    or [["src", "dst"], ...]); otherwise the edges are the consecutive node
+    pairs of module_<id>_paths.json, which describes the same DAG.
+    Returns (edges, sources, sinks) or None when the module has no graph.
+    """
+    store = as_module_store(module_json_dir)
+    if store.has(module, "edges"):
+        raw = store.load(module, "edges")
+        pairs = [(a, b) for a, dsts in raw.items() for b in dsts] if isinstance(raw, dict) else [tuple(e) for e in raw]
+        nodes = list(store.nodes(module)) if store.has(module, "nodes") else []
+        edges = {n: [] for n in nodes}
+        has_pred = set()
+        for a, b in pairs:
+            edges.setdefault(a, []).append(b)
+            edges.setdefault(b, [])
+            has_pred.add(b)
+        sources = [n for n in edges if n not in has_pred]
+        sinks = [n for n, dsts in edges.items() if not dsts]
+        return (edges, sources, sinks) if edges else None
+
+    if not store.has(module, "paths"):
+        return None
+    paths_dict = store.paths(module)
+    edges, sources, sinks = {}, {}, {}
+    for comma in paths_dict.values():
+        path = [n.strip() for n in comma.split(",")]
+        sources[path[0]] = None
+        sinks[path[-1]] = None
+        for a, b in zip(path, path[1:]):
+            edges.setdefault(a, {})[b] = None
+        edges.setdefault(path[-1], {})
+    edges = {n: list(dsts) for n, dsts in edges.items()}
+    return (edges, list(sources), list(sinks)) if edges else None
+
+def topological_order(edges):
+    # Kahn's algorithm over {node: [successors]}
+    indeg = {n: 0 for n in edges}
+    for dsts in edges.values():
+        for b in dsts:
+            indeg[b] += 1
+    order = [n for n in edges if indeg[n] == 0]
+    for n in order:
+        for b in edges[n]:
+            indeg[b] -= 1
+            if indeg[b] == 0:
+                order.append(b)
+    return order
+
+DP_TIE_TOL = 1e-12    # relative difference of summed logs still counted as a tie
+
+def dp_tie(a, b):
+    # equal up to the rounding of summing logs in another order
+    return a == b or (a > -np.inf and b > -np.inf and abs(a - b) <= DP_TIE_TOL * max(1.0, abs(a), abs(b)))
+
+def best_path_dp(edges, sources, sinks, dk_map, order=None, listed=None):
+    """Path from a source to a sink with the highest score_path geo value.
+
+    DP over (node, number of counted nodes): for each node and path length
+    keep the best log-product reaching it, then pick the sink state with
+    the largest mean log. Runs in O(edges x max path length) without
+    listing the paths. Returns the node list, or None.
+
+    Like find_most_probable_row, ties go to the path listed first:
+    predecessors within rounding of the best are all kept, the tied optima
+    are re-scored with score_path and ranked by listed ({path_str: (rank,
+    path id)}, e.g. ModuleGraphs.path_ids); unlisted paths rank last.
+    """
+    def weight(node):
+        if '_' in node:
+            p = dk_map.get(node.split("_")[0], 1.0)
+            return np.log(p) if p > 0 else -np.inf
+        return 0.0
+
+    # 1) topological order (Kahn), unless compiled with the graph
+    order = topological_order(edges) if order is None else order
+
+    # 2) forward pass: state[node][length] = [log product, previous (node, length) states]
+    state = {n: {} for n in edges}
+    for n in sources:
+        state[n].setdefault(int('K' in n), [weight(n), [None]])
+    for n in order:
+        if not state[n]:
+            continue
+        for b in edges[n]:
+            w_b, c_b = weight(b), int('K' in b)
+            best_b = state[b]
+            for length, (log_p, _) in state[n].items():
+                key, cand = length + c_b, log_p + w_b
+                if key not in best_b:
+                    best_b[key] = [cand, [(n, length)]]
+                elif dp_tie(cand, best_b[key][0]):
+                    best_b[key][1].append((n, length))
+                elif cand > best_b[key][0]:
+                    best_b[key] = [cand, [(n, length)]]
+
+    # 3) best sink states by geometric mean
+    ends, best_mean = [], -np.inf
+    for n in sinks:
+        for length, (log_p, _) in state[n].items():
+            mean = log_p / length if length > 0 else -np.inf    # geo 0 without counted nodes
+            if ends and dp_tie(mean, best_mean):
+                ends.append((n, length))
+            elif not ends or mean > best_mean:
+                ends, best_mean = [(n, length)], mean
+    if not ends:
+        return None
+
+    # 4) walk the back-pointers of every tied optimum, keep the one listed first
+    def tied_paths(end):
+        stack = [(end, [])]
+        while stack:
+            (n, length), tail = stack.pop()
+            for prev in reversed(state[n][length][1]):
+                if prev is None:
+                    yield [n] + tail
+                else:
+                    stack.append((prev, [n] + tail))
+
+    if not listed:
+        return next(tied_paths(ends[0]))
+    best, best_key = None, None
+    for end in ends:
+        for path in tied_paths(end):
+            key = (-score_path(path, dk_map)[1], listed.get(" -> ".join(path), (np.inf,))[0])
+            if best is None or key < best_key:
+                best, best_key = path, key
+    return best
+
+class ModuleGraphs:
+    """Edge graph of every module for --path-search dp, compiled once.
+
+    graphs maps a module to (edges, sources, sinks, order), order being a
+    topological order of its nodes; path_ids maps a module to
+    {path_str: (rank, id)} for the paths listed in module_<id>_paths.json,
+    rank being the position in that file.
+    """
+
+    def __init__(self, graphs, path_ids):
+        self.graphs = graphs
+        self.path_ids = path_ids
+
+    @classmethod
+    def compile(cls, module_json_dir):
+        store = as_module_store(module_json_dir)
+        graphs, path_ids = {}, {}
+        for module_name in store.modules("nodes"):
+            graph = load_module_graph(store, module_name)
+            if graph is None:
+                continue
+            graphs[module_name] = graph + (topological_order(graph[0]),)
+            if store.has(module_name, "paths"):
+                listed = path_ids[module_name] = {}
+                for rank, (pid, comma) in enumerate(store.paths(module_name).items()):
+                    listed.setdefault(" -> ".join(n.strip() for n in comma.split(",")), (rank, int(pid)))
+        return cls(graphs, path_ids)
+
+    def save(self, path):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((self.graphs, self.path_ids), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(*pickle.load(f))
+
+    def path_id(self, module, path_str):
+        # -1 when the path has no entry in module_<id>_paths.json
+        return self.path_ids.get(module, {}).get(path_str, (None, -1))[1]
+
+MODULE_GRAPHS_VERSION = 2
+
+def load_module_graphs(module_json_dir, cache_dir=None):
+    # compiled once per set of node, path and edge files, then reloaded from the cache
+    store = as_module_store(module_json_dir)
+    cache_dir = cache_dir or default_cache_dir()
+    sources = set(store.source_files("nodes")) | set(store.source_files("paths")) | set(store.source_files("edges"))
+    cache_file = os.path.join(cache_dir, f"module_graphs_v{MODULE_GRAPHS_VERSION}_{files_signature(sources)}.pkl")
+    if os.path.isfile(cache_file):
+        try:
+            return ModuleGraphs.load(cache_file)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            print(f"Module graph cache {cache_file} is unreadable ({e}), rebuilding")
+    graphs = ModuleGraphs.compile(store)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        graphs.save(cache_file)
+    except OSError as e:
+        print(f"Could not write module graph cache to {cache_dir}: {e}")
+    return graphs
+
+def dp_path_probabilities(module_graphs, dk_map_before, dk_map_after):
+    # best path per module without enumerating paths; module_graphs is a
+    # ModuleGraphs or a module graph source (compiled on the spot)
+    if not isinstance(module_graphs, ModuleGraphs):
+        module_graphs = ModuleGraphs.compile(module_graphs)
+    best_rows = []
+    for module_name, (edges, sources, sinks, order) in module_graphs.graphs.items():
+        path = best_path_dp(edges, sources, sinks, dk_map_after, order, module_graphs.path_ids.get(module_name))
+        if path is None:
+            continue
+        path_str = " -> ".join(path)
+        r_before, g_before = score_path(path, dk_map_before)
+        r_after, g_after = score_path(path, dk_map_after)
+        best_rows.append({
+            'module':     module_name,
+            'path_id':    module_graphs.path_id(module_name, path_str),
+            'path_str':   path_str,
+            'raw_before': r_before,
+            'geo_before': g_before,
+            'raw_after':  r_after,
+            'geo_after':  g_after
+        })
+    columns_order = ['module','path_id','path_str','raw_before','geo_before','raw_after','geo_after']
+    return pd.DataFrame(best_rows, columns=columns_order)
+
 def modules_to_kos(MODULE_JSON_DIR):
   ko_to_modules = {}
-  pattern = os.path.join(MODULE_JSON_DIR, "module_*_nodes.json")
-  for filepath in glob.glob(pattern):
-      # Extract a module name (e.g. “module_M00001”) from the filename
-      filename = os.path.basename(filepath)
-      module_name = filename.replace("_nodes.json", "")
-      module_name = module_name.replace("module_", "")
-
+  store = as_module_store(MODULE_JSON_DIR)
+  for module_name in store.modules("nodes"):
       # Load that module’s node list
-      with open(filepath, "r") as f:
-          module_nodes = json.load(f)
+      module_nodes = store.nodes(module_name)
 
       # For each node starting with "K", split off the KO part (before the first "_")
       module_kos = {n.split("_", 1)[0] for n in module_nodes if n.startswith("K")}
@@ -354,8 +1096,105 @@ def modules_to_kos(MODULE_JSON_DIR):
 
   return ko_to_modules_str
   
+def module_node_table(module_json_dir):
+    """Nodes of every module graph in viewer order (by group within a module).
+
+    Compiled once with the reference tables, so exports do not re-read the
+    module JSON files. 'module' is categorical over all modules, including
+    any without nodes.
+    """
+    store = as_module_store(module_json_dir)
+    module_ids = store.modules("nodes")
+    rows = []
+    for module_id in module_ids:
+        for node, group in sorted(store.nodes(module_id).items(), key=lambda x: int(x[1])):
+            rows.append((module_id, node, int(group)))
+    table = pd.DataFrame(rows, columns=['module', 'id', 'group'])
+    table['module'] = pd.Categorical(table['module'], categories=module_ids)
+    table['group'] = table['group'].astype(np.int64)
+    table['KO id'] = table['id'].str.split('_').str[0]
+    return table
+
+def as_module_node_table(module_source):
+    # module_representation accepts a compiled node table, a ModuleGraphStore or a directory
+    if isinstance(module_source, pd.DataFrame):
+        return module_source
+    return module_node_table(module_source)
+
+class ModuleRepresentation:
+    """Viewer JSON of one sample: (module, {nodes, best_path[, top_paths]}) pairs.
+
+    Node values are looked up for all modules at once; entries are built
+    one module at a time while iterating, so writers can stream them.
+    """
+
+    def __init__(self, module_nodes, ko_occ_df, dk_before, evalue, dk_after, df_best_paths):
+        module_nodes = as_module_node_table(module_nodes)
+        kos = module_nodes['KO id']
+        ko_freq = ko_occ_df.set_index('KO id')['KO_freq'].to_dict()
+
+        def lookup(mapping, default):
+            return pd.Series(mapping, dtype=np.float64).reindex(kos, fill_value=default).tolist()
+
+        self.module_ids = list(module_nodes['module'].cat.categories)
+        self.offsets = np.searchsorted(module_nodes['module'].cat.codes.to_numpy(),
+                                       np.arange(len(self.module_ids) + 1)).tolist()
+        self.columns = (module_nodes['id'].tolist(), module_nodes['group'].tolist(),
+                        lookup(ko_freq, 0.0), lookup(dk_before, 0.0), lookup(evalue, 100.0), lookup(dk_after, 0.0))
+
+        # best path per module, all numeric fields as float
+        def path_record(bp):
+            return {
+                'path_id':     int(bp['path_id']),
+                'path_str':    bp['path_str'],
+                'raw_before':  float(bp['raw_before']),
+                'geo_before':  float(bp['geo_before']),
+                'raw_after':   float(bp['raw_after']),
+                'geo_after':   float(bp['geo_after']),
+            }
+
+        self.ranked = 'rank' in df_best_paths.columns
+        best_rows = df_best_paths[df_best_paths['rank'] == 1] if self.ranked else df_best_paths
+        raw_map = best_rows.set_index('module')[
+            ['path_id','path_str','raw_before','geo_before','raw_after','geo_after']
+        ].to_dict(orient='index')
+        self.best_path_map = {m: None if bp is None else path_record(bp) for m, bp in raw_map.items()}
+
+        # ranked alternatives, only when the paths table carries a rank column
+        self.top_paths_map = {}
+        if self.ranked:
+            for bp in df_best_paths.to_dict(orient='records'):
+                self.top_paths_map.setdefault(bp['module'], []).append({'rank': int(bp['rank']), **path_record(bp)})
+
+    def __len__(self):
+        return len(self.module_ids)
+
+    def __iter__(self):
+        for i, module_id in enumerate(self.module_ids):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            nodes_list = [
+                {"id": node, "group": group, "KO_Occurrence": occ,
+                 "Dk_before": before, "E-value": ev, "Dk_after": after}
+                for node, group, occ, before, ev, after in zip(*(c[lo:hi] for c in self.columns))
+            ]
+            entry = {"nodes": nodes_list, "best_path": self.best_path_map.get(module_id)}
+            if self.ranked:
+                entry["top_paths"] = self.top_paths_map.get(module_id, [])
+            yield module_id, entry
+
+def module_representation(
+    module_json_dir,
+    ko_occ_df: pd.DataFrame,
+    dk_before: dict,
+    evalue: dict,
+    dk_after: dict,
+    df_best_paths: pd.DataFrame
+):
+    # per module: enriched node list and best path, as exported for the viewer
+    return dict(ModuleRepresentation(module_json_dir, ko_occ_df, dk_before, evalue, dk_after, df_best_paths))
+
 def export_module_data_with_best_path(
-    module_json_dir: str,
+    module_json_dir,
     ko_occ_df: pd.DataFrame,
     dk_before: dict,
     evalue: dict,
@@ -363,57 +1202,42 @@ def export_module_data_with_best_path(
     df_best_paths: pd.DataFrame,
     output_path: str
 ):
-    
-    ko_freq = ko_occ_df.set_index('KO id')['KO_freq'].to_dict()
-
-    # Prepare best_path map, converting all numeric fields to float
-    raw_map = df_best_paths.set_index('module')[
-        ['path_id','path_str','raw_before','geo_before','raw_after','geo_after']
-    ].to_dict(orient='index')
-
-    best_path_map = {}
-    for module_id, bp in raw_map.items():
-        if bp is None:
-            best_path_map[module_id] = None
-        else:
-            best_path_map[module_id] = {
-                'path_id':     int(bp['path_id']),
-                'path_str':    bp['path_str'],
-                'raw_before':  float(bp['raw_before']),
-                'geo_before':  float(bp['geo_before']),
-                'raw_after':   float(bp['raw_after']),
-                'geo_after':   float(bp['geo_after']),
-            }
+    modules = ModuleRepresentation(module_json_dir, ko_occ_df, dk_before, evalue, dk_after, df_best_paths)
+    write_module_representation(modules, output_path)
 
-    aggregated = {} 
-    for node_file in glob.glob(os.path.join(module_json_dir, "module_*_nodes.json")):
-        module_id = os.path.basename(node_file).split("_")[1]
-        with open(node_file) as f:
-            nodes_dict = json.load(f)
-
-        nodes_list = []
-        for node, group in nodes_dict.items():
-            ko = node.split("_")[0]
-            nodes_list.append({
-                "id":             node,
-                "group":          int(group),
-                "KO_Occurrence":  float(ko_freq.get(ko, 0.0)),
-                "Dk_before":      float(dk_before.get(ko, 0.0)),
-                "E-value":        float(evalue.get(ko, 100.0)),
-                "Dk_after":       float(dk_after.get(ko, 0.0)),
-            })
-
-        nodes_list.sort(key=lambda x: x["group"])
-        aggregated[module_id] = {
-            "nodes":     nodes_list,
-            "best_path": best_path_map.get(module_id)
-        }
+def compact_json(obj):
+    return json.dumps(obj, separators=(',', ':'))
 
+def write_module_representation(modules, output_path):
+    """Stream modules (a dict or (module, entry) pairs) to one compact JSON object."""
+    items = modules.items() if isinstance(modules, dict) else modules
     with open(output_path, "w") as f:
-        json.dump(aggregated, f, indent=4)
+        f.write("{")
+        for i, (module_id, entry) in enumerate(items):
+            f.write(("," if i else "") + json.dumps(module_id) + ":" + compact_json(entry))
+        f.write("}")
 
     print(f"Wrote enriched modules + best‐path JSON to {output_path}")
 
+def write_module_shards(modules, shard_dir):
+    """One gzip-compressed JSON per module plus index.json for lazy loading.
+
+    index.json maps each module to its best path and shard file, so it can
+    stand in for the full JSON in module.html.
+    """
+    items = modules.items() if isinstance(modules, dict) else modules
+    os.makedirs(shard_dir, exist_ok=True)
+    index = {}
+    for module_id, entry in items:
+        fname = f"{module_id}.json.gz"
+        with open(os.path.join(shard_dir, fname), "wb") as f:
+            f.write(gzip.compress(compact_json(entry).encode(), mtime=0))
+        index[module_id] = {"best_path": entry["best_path"], "file": fname}
+    with open(os.path.join(shard_dir, "index.json"), "w") as f:
+        f.write(compact_json(index))
+
+    print(f"Wrote {len(index)} module shards + index.json to {shard_dir}")
+
 def completeness_float(x):
     """Argparse type: float in [0.0,1.0]."""
     try:
@@ -424,11 +1248,14 @@ def completeness_float(x):
         raise argparse.ArgumentTypeError(f"completeness must be between 0.0 and 1.0, got {f}")
     return f  
 
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zst')
+
 def existing_nonempty_tbl(path):
-    # 1) check extension
-    if not (path.endswith(".tbl") or path.endswith(".domtblout")):
+    # 1) check extension (optionally followed by a compression suffix)
+    stem = path[:-len(path.split('.')[-1]) - 1] if path.endswith(COMPRESSED_SUFFIXES) else path
+    if not (stem.endswith(".tbl") or stem.endswith(".domtblout")):
         raise argparse.ArgumentTypeError(
-            f"‘{path}’ must end in .tblout or .domtblout"
+            f"‘{path}’ must end in .tblout or .domtblout (optionally .gz/.bz2/.xz/.zst)"
         )
     # 2) check file exists
     if not os.path.isfile(path):
@@ -445,7 +1272,1996 @@ def format_adjacency(ko, adjacency_map, diffused_map):
     probs = ",".join(str(diffused_map.get(n, 0.0)) for n in nbrs.keys())
     return ids, wts, probs
 
-def main():
+ADJACENCY_COLUMNS = ['adjacency_list', 'adjacency_weight_list', 'neighbor_Dk_list']
+ADJACENCY_FORMATS = {'parquet': 'parquet', 'feather': 'feather'}    # --adjacency-format -> file suffix
+
+def neighbor_dk_vector(neighbors, diffused_map):
+    # Dk_Neighbors of every KO in the neighbor index, 0.0 if it has none
+    return pd.Series(diffused_map, dtype=np.float64).reindex(neighbors.ko_ids, fill_value=0.0).to_numpy()
+
+def adjacency_report(kos, neighbors, diffused_map):
+    """format_adjacency for every KO of kos at once, from the CSR neighbor matrix.
+
+    Returns a DataFrame with the three ADJACENCY_COLUMNS, in the order of kos.
+    """
+    pos = neighbors.positions(kos)
+    id_text, weight_text = neighbors.row_text()
+    dk_text = np.array([str(x) for x in neighbor_dk_vector(neighbors, diffused_map).tolist()], dtype=object)
+    dk_lengths = np.fromiter(map(len, dk_text), dtype=np.int64, count=len(dk_text))
+    neighbor_dk_text = neighbors.join_rows(dk_text[neighbors.indices], dk_lengths[neighbors.indices])
+
+    def pick(rows):
+        return [rows[p] if p >= 0 else "" for p in pos.tolist()]
+    return pd.DataFrame(dict(zip(ADJACENCY_COLUMNS, (pick(id_text), pick(weight_text), pick(neighbor_dk_text)))))
+
+def adjacency_long(kos, neighbors, diffused_map):
+    """One row per (KO, neighbor) of kos: KO id, neighbor, weight, neighbor_Dk."""
+    pos = neighbors.positions(kos)
+    pos = pos[pos >= 0]
+    counts = neighbors.indptr[pos + 1] - neighbors.indptr[pos]
+    first = np.repeat(neighbors.indptr[pos], counts)
+    edges = first + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    categories = pd.Index(neighbors.ko_ids)
+    return pd.DataFrame({
+        'KO id':       pd.Categorical.from_codes(np.repeat(pos, counts), categories=categories),
+        'neighbor':    pd.Categorical.from_codes(neighbors.indices[edges], categories=categories),
+        'weight':      neighbors.weights[edges],
+        'neighbor_Dk': neighbor_dk_vector(neighbors, diffused_map)[neighbors.indices[edges]],
+    })
+
+def write_adjacency_long(table, out_pref, fmt):
+    path = f"{out_pref}_adjacency.{ADJACENCY_FORMATS[fmt]}"
+    if fmt == 'parquet':
+        table.to_parquet(path, index=False)
+    else:
+        table.to_feather(path)
+    print(f"Long-format adjacency ({len(table)} rows) written to {path}")
+
+"""## Profiling"""
+
+PROFILE_STAGES = ("parse", "grouping", "confidence", "stream", "best_hits", "dk", "diffusion", "adjacency", "paths",
+                  "modules", "export", "sweep", "uncertainty")
+
+def max_rss_mb():
+    # process high-water mark; ru_maxrss is KiB on Linux, bytes on macOS
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+class _NoStage:
+    # shared do-nothing stage used while profiling is off
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def rows(self, rows_in=None, rows_out=None):
+        pass
+
+_NO_STAGE = _NoStage()
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler, self.record = profiler, {"stage": name, "rows_in": None, "rows_out": None}
+        self.cprofile = cProfile.Profile() if name == profiler.cprofile_stage else None
+
+    def __enter__(self):
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        if self.cprofile is not None:
+            self.cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            self.profiler.dump_cprofile(self.record["stage"], self.cprofile)
+        self.record.update(wall_s=time.perf_counter() - self.wall,
+                           cpu_s=time.process_time() - self.cpu,
+                           max_rss_mb=max_rss_mb())
+        self.profiler.records.append(self.record)
+        return False
+
+    def rows(self, rows_in=None, rows_out=None):
+        if rows_in is not None:
+            self.record["rows_in"] = int(rows_in)
+        if rows_out is not None:
+            self.record["rows_out"] = int(rows_out)
+
+class StageProfiler:
+    """Wall/CPU time, peak RSS and row counts per pipeline stage.
+
+    Disabled profilers hand out one shared no-op context, so the stage
+    wrappers stay in the pipeline at almost no cost. max_rss_mb is the
+    process high-water mark after the stage.
+    """
+
+    def __init__(self, enabled=False, cprofile_stage=None, out_pref=None):
+        self.enabled = enabled or cprofile_stage is not None
+        self.cprofile_stage = cprofile_stage
+        self.out_pref = out_pref
+        self.records = []
+
+    def stage(self, name):
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def dump_cprofile(self, name, profile):
+        path = f"{self.out_pref}_profile_{name}.prof"
+        profile.dump_stats(path)
+        print(f"cProfile stats of stage '{name}' written to {path} (view with python -m pstats)")
+
+    def write(self, fmt="json"):
+        if not self.records:
+            return None
+        path = f"{self.out_pref}_profile.{fmt}"
+        if fmt == "csv":
+            report = pd.DataFrame(self.records).astype({"rows_in": "Int64", "rows_out": "Int64"})
+            report.to_csv(path, index=False)
+        else:
+            with open(path, "w") as f:
+                json.dump({"stages": self.records,
+                           "total_wall_s": sum(r["wall_s"] for r in self.records),
+                           "total_cpu_s": sum(r["cpu_s"] for r in self.records),
+                           "max_rss_mb": max_rss_mb()}, f, indent=2)
+        print(f"Stage profile written to {path}")
+        return path
+
+"""## Reference data"""
+
+REFERENCE_CACHE_VERSION = 3
+NEIGHBOR_ARRAYS = ("indptr", "indices", "weights")
+
+def file_sha256(path, block=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(block), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def build_reference_tables(ko_occ_path, adj_path, MODULE_JSON_DIR):
+    ko_to_modules_str = modules_to_kos(MODULE_JSON_DIR)
+    module_nodes = module_node_table(MODULE_JSON_DIR)
+    ko_occ = read_ko_occurence_txt(ko_occ_path)
+    neighbors = NeighborMatrix.from_adjacency(make_neighbor_dictionary(adj_path), alpha=0.6)
+    return ko_occ, neighbors, ko_to_modules_str, module_nodes
+
+def load_reference_tables(ko_occ_path, adj_path, MODULE_JSON_DIR, cache_dir=None):
+    """KO occurrences, neighbor matrix, KO->module map and module nodes, cached on disk.
+
+    The cache is reused while every source file keeps its size and mtime;
+    if those changed but the SHA-256 checksums did not (e.g. after a copy)
+    it is reused and re-stamped. Anything else rebuilds it. The neighbor
+    CSR arrays are stored as .npy files and memory-mapped on load.
+    """
+    store = as_module_store(MODULE_JSON_DIR)
+    sources = [os.path.abspath(p) for p in [ko_occ_path, adj_path] + store.source_files("nodes")]
+    stat = {p: [os.stat(p).st_size, os.stat(p).st_mtime_ns] for p in sources}
+    cache_dir = os.path.join(cache_dir or default_cache_dir(),
+                             "reference_" + hashlib.sha256("\n".join(sources).encode()).hexdigest()[:16])
+    meta_path = os.path.join(cache_dir, "meta.json")
+
+    meta = None
+    if os.path.isfile(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("version") != REFERENCE_CACHE_VERSION or sorted(meta.get("stat", {})) != sorted(sources):
+            meta = None
+        elif meta["stat"] != stat:
+            if all(meta["sha256"][p] == file_sha256(p) for p in sources):
+                meta["stat"] = stat
+                write_json_atomic(meta_path, meta)
+            else:
+                meta = None
+
+    if meta is not None:
+        try:
+            with open(os.path.join(cache_dir, "tables.pkl"), "rb") as f:
+                tables = pickle.load(f)
+            arrays = [np.load(os.path.join(cache_dir, f"neighbors_{name}.npy"), mmap_mode="r")
+                      for name in NEIGHBOR_ARRAYS]
+            neighbors = NeighborMatrix(tables["neighbor_ko_ids"], *arrays, alpha=0.6)
+            return tables["ko_occ"], neighbors, tables["ko_to_modules"], tables["module_nodes"]
+        except (OSError, KeyError, ValueError, pickle.UnpicklingError) as e:
+            print(f"Reference cache in {cache_dir} is unreadable ({e}), rebuilding")
+
+    ko_occ, neighbors, ko_to_modules_str, module_nodes = build_reference_tables(ko_occ_path, adj_path, store)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f".{os.getpid()}.tmp"
+        for name in NEIGHBOR_ARRAYS:
+            target = os.path.join(cache_dir, f"neighbors_{name}.npy")
+            with open(target + tmp, "wb") as f:
+                np.save(f, getattr(neighbors, name))
+            os.replace(target + tmp, target)
+        tables = {"ko_occ": ko_occ, "ko_to_modules": ko_to_modules_str,
+                  "module_nodes": module_nodes, "neighbor_ko_ids": list(neighbors.ko_ids)}
+        with open(os.path.join(cache_dir, "tables.pkl" + tmp), "wb") as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(os.path.join(cache_dir, "tables.pkl" + tmp), os.path.join(cache_dir, "tables.pkl"))
+        # meta last: the cache only counts as valid once everything is written
+        write_json_atomic(meta_path, {"version": REFERENCE_CACHE_VERSION, "stat": stat,
+                                      "sha256": {p: file_sha256(p) for p in sources}})
+        print(f"Reference cache written to {cache_dir}")
+    except OSError as e:
+        print(f"Could not write reference cache to {cache_dir}: {e}")
+    return ko_occ, neighbors, ko_to_modules_str, module_nodes
+
+def write_json_atomic(path, obj):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+class ReferenceData:
+    """Reference tables shared by every sample of a run."""
+
+    def __init__(self, modules, ko_occ, neighbors, ko_to_modules, module_nodes=None, path_index=None):
+        # global KO code table: every KO of the modules, occurrences and
+        # neighbors, sorted; hit tables code their KO ids against it
+        self.ko_table = pd.Index(sorted(set(ko_to_modules) | set(ko_occ['KO id']) | set(neighbors.ko_ids)))
+        self.module_ko_codes = self.ko_table.get_indexer(sorted(ko_to_modules))
+        # ko_occ row of every module KO (-1 without one, first row on repeats);
+        # per-module-KO tables are in module_ko_codes order, so Dk joins on it
+        occ_row = np.full(len(self.ko_table), -1, dtype=np.int64)
+        occ_row[self.ko_table.get_indexer(ko_occ['KO id'])[::-1]] = np.arange(len(ko_occ))[::-1]
+        self.module_occ_rows = occ_row[self.module_ko_codes]
+        self.modules = modules
+        self.ko_occ = ko_occ
+        self.neighbors = neighbors
+        self.ko_to_modules = ko_to_modules
+        self.module_nodes = module_node_table(modules) if module_nodes is None else module_nodes
+        self.path_index = path_index
+        self.graph_index = None   # ModuleGraphs for --path-search dp, loaded on demand
+
+    @property
+    def version(self):
+        # content digest of the tables results depend on (KO occurrences,
+        # module KOs, neighbor matrix); keys the result cache
+        if getattr(self, "_version", None) is None:
+            h = hashlib.sha256(f"reference-{REFERENCE_CACHE_VERSION}".encode())
+            h.update(pd.util.hash_pandas_object(self.ko_occ[['KO id', 'KO_freq']], index=False).to_numpy().tobytes())
+            h.update(json.dumps(sorted(self.ko_to_modules.items())).encode())
+            h.update("\n".join(self.neighbors.ko_ids).encode())
+            for name in NEIGHBOR_ARRAYS:
+                h.update(np.ascontiguousarray(getattr(self.neighbors, name)).tobytes())
+            self._version = h.hexdigest()[:32]
+        return self._version
+
+    def occ_rows(self, ko_hits):
+        # module_occ_rows when ko_hits has the module KO rows of module_ko_hits,
+        # else None (merge on KO ids)
+        kos = ko_hits['KO id'].to_numpy()
+        if len(kos) == len(self.module_ko_codes) and (kos == self.ko_table.to_numpy()[self.module_ko_codes]).all():
+            return self.module_occ_rows
+        return None
+
+    def require_path_index(self, cache_dir=None):
+        # loaded on demand when the reference was set up for --path-search dp
+        if self.path_index is None:
+            self.path_index = load_path_index(self.modules, cache_dir)
+        return self.path_index
+
+    def require_graph_index(self, cache_dir=None):
+        if self.graph_index is None:
+            self.graph_index = load_module_graphs(self.modules, cache_dir)
+        return self.graph_index
+
+    @classmethod
+    def load(cls, cache_dir=None, with_path_index=True, use_cache=True, module_graphs=None, reference_data=None):
+        HERE = os.path.dirname(os.path.abspath(__file__))
+        modules = ModuleGraphStore(module_graphs or find_module_graphs(HERE))
+        print(f"Module graphs from {modules.source}: {len(modules.modules('nodes'))} node files, "
+              f"{len(modules.modules('paths'))} path files")
+        data_dir = reference_data or os.path.join(HERE, "Data_Dependencies")
+        ko_occ_path     = os.path.join(data_dir, "ko_occurrences.txt")
+        adj_path   = os.path.join(data_dir, "ko_neighbors.txt")
+        if use_cache:
+            tables = load_reference_tables(ko_occ_path, adj_path, modules, cache_dir)
+        else:
+            tables = build_reference_tables(ko_occ_path, adj_path, modules)
+        path_index = load_path_index(modules, cache_dir) if with_path_index else None
+        return cls(modules, *tables, path_index=path_index)
+
+def float_grid(text):
+    """Argparse type: comma-separated floats."""
+    try:
+        values = [float(v) for v in text.split(",") if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{text!r} is not a comma-separated list of numbers")
+    if not values:
+        raise argparse.ArgumentTypeError("empty list")
+    return values
+
+def add_analysis_arguments(parser):
+    parser.add_argument('--diffusion-iterations', type=int, default=1,
+                        help='Number of neighbor diffusion steps (default 1)')
+    parser.add_argument('--diffusion-tol', type=float, default=None,
+                        help='Stop diffusion early once no Dk changes by more than this')
+    parser.add_argument('--path-search', choices=['index', 'dp'], default='index',
+                        help='Best path per module from the compiled path index (default) or by dynamic programming over the module graph')
+    parser.add_argument('--top-paths', type=int, default=1, metavar='K',
+                        help='Report the K best paths per module, ranked, instead of only the best one')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Directory for compiled reference data (default $BLIMMP_CACHE_DIR or ~/.cache/BLIMMP)')
+    parser.add_argument('--module-graphs', default=None,
+                        help='Zip archive or folder with module_*_nodes/paths.json (default: the one under Graph_Dependencies)')
+    parser.add_argument('--reference-data', default=None, metavar='DIR',
+                        help='Folder with ko_occurrences.txt and ko_neighbors.txt, e.g. written by build_reference.py '
+                             '(default: Data_Dependencies)')
+    parser.add_argument('--no-reference-cache', action='store_true',
+                        help='Parse the reference text and JSON files instead of using the compiled cache')
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help='Do not reuse or store intermediate per-sample results (see the cache command)')
+    parser.add_argument('--result-cache-mb', type=float, default=RESULT_CACHE_MB, metavar='MB',
+                        help=f'Evict least recently used results beyond this size (default {RESULT_CACHE_MB} MB)')
+    parser.add_argument('--sweep-completeness', type=float_grid, default=None, metavar='C1,C2,...',
+                        help='Also score every completeness in this list (with each --sweep-alpha) into <output>_sweep.csv')
+    parser.add_argument('--sweep-alpha', type=float_grid, default=None, metavar='A1,A2,...',
+                        help='Diffusion alpha values for the sweep (default 0.6)')
+    parser.add_argument('--uncertainty', type=int, default=0, metavar='N',
+                        help='Sample KO presence from Dk/Dk_Neighbors N times and write best-path score quantiles per module to <output>_uncertainty.csv')
+    parser.add_argument('--mc-seed', type=int, default=0, help='Random seed of --uncertainty (default 0)')
+    parser.add_argument('--mc-floor', type=float, default=1e-4,
+                        help='Probability used for absent KOs in --uncertainty replicates (default 1e-4)')
+    parser.add_argument('--mc-quantiles', type=float_grid, default=[0.05, 0.5, 0.95], metavar='Q1,Q2,...',
+                        help='Quantiles reported by --uncertainty (default 0.05,0.5,0.95)')
+    parser.add_argument('--stream', nargs='?', const='spill', choices=['spill', 'sorted'], default=None,
+                        help='Process the domtblout in blocks of whole targets with bounded memory. '
+                             'spill (default) hash-partitions hits by target into temporary files; '
+                             'sorted needs the hits of each target name on consecutive lines (e.g. sort -k1,1, '
+                             'any locale) and reads it once')
+    parser.add_argument('--stream-chunksize', type=int, default=DOMTBLOUT_CHUNKSIZE, metavar='ROWS',
+                        help=f'Rows read at a time in --stream mode (default {DOMTBLOUT_CHUNKSIZE})')
+    parser.add_argument('--tmp-dir', default=None, help='Directory for --stream spill files (default: system temp)')
+    parser.add_argument('--ingest-workers', type=int, default=1, metavar='N',
+                        help='Parse, group and score one uncompressed domtblout in N processes over byte ranges '
+                             '(uses the --stream mode, spill unless sorted is given)')
+    parser.add_argument('--adjacency-format', choices=['strings'] + list(ADJACENCY_FORMATS), default='strings',
+                        help='strings: comma-joined neighbor columns in <output>_dk.csv (default); parquet/feather: '
+                             'one row per KO and neighbor in <output>_adjacency.<format> instead (needs pyarrow)')
+    parser.add_argument('--module-shards', action='store_true',
+                        help='Write the viewer JSON as one gzip file per module plus index.json in <output>_modules/ '
+                             'instead of <output>_sample_modules_representation.json')
+    parser.add_argument('--profile', nargs='?', const='json', choices=['json', 'csv'], default=None,
+                        help='Write per-stage wall/CPU time, peak RSS and row counts to <output>_profile.json (or .csv)')
+    parser.add_argument('--profile-stage', choices=PROFILE_STAGES, default=None,
+                        help='Also dump cProfile stats of this stage to <output>_profile_<stage>.prof')
+
+def analysis_option_error(args):
+    if args.diffusion_iterations < 1:
+        return "--diffusion-iterations must be at least 1"
+    if args.top_paths < 1:
+        return "--top-paths must be at least 1"
+    if args.top_paths > 1 and args.path_search == 'dp':
+        return "--top-paths needs the path index; it cannot be combined with --path-search dp"
+    if args.sweep_completeness is not None and not all(0.0 <= c <= 1.0 for c in args.sweep_completeness):
+        return "--sweep-completeness values must be between 0.0 and 1.0"
+    if args.sweep_alpha is not None and not all(a > 0 for a in args.sweep_alpha):
+        return "--sweep-alpha values must be positive"
+    if args.ingest_workers < 1:
+        return "--ingest-workers must be at least 1"
+    if args.stream_chunksize < 1:
+        return "--stream-chunksize must be at least 1"
+    if args.uncertainty < 0:
+        return "--uncertainty must not be negative"
+    if not 0.0 <= args.mc_floor <= 1.0:
+        return "--mc-floor must be between 0.0 and 1.0"
+    if not all(0.0 <= q <= 1.0 for q in args.mc_quantiles):
+        return "--mc-quantiles values must be between 0.0 and 1.0"
+    if args.adjacency_format not in ('strings', *ADJACENCY_FORMATS):
+        return f"--adjacency-format must be one of strings, {', '.join(ADJACENCY_FORMATS)}"
+    if args.adjacency_format != 'strings' and find_spec("pyarrow") is None:
+        return f"--adjacency-format {args.adjacency_format} needs pyarrow (pip install pyarrow)"
+    if args.path_search not in ('index', 'dp'):
+        return f"--path-search must be 'index' or 'dp', got {args.path_search!r}"
+    return None
+
+def check_analysis_arguments(parser, args):
+    error = analysis_option_error(args)
+    if error:
+        parser.error(error)
+
+def analysis_options(**overrides):
+    """Namespace with the analysis option defaults of the command line, updated by keyword."""
+    parser = argparse.ArgumentParser(add_help=False)
+    add_analysis_arguments(parser)
+    args = parser.parse_args([])
+    unknown = set(overrides) - set(vars(args))
+    if unknown:
+        raise TypeError(f"Unknown analysis option(s): {', '.join(sorted(unknown))}")
+    vars(args).update(overrides)
+    error = analysis_option_error(args)
+    if error:
+        raise ValueError(error)
+    return args
+
+HIT_COLUMNS = ['target name', 'KO id', 'E-value', 'score', 'hmm from', 'hmm to', 'ali from', 'ali to']
+
+def read_hits(hits, ko_table=None):
+    """Hit table from a domtblout path, a DataFrame or an Arrow table.
+
+    Tables may use the parsed column names (HIT_COLUMNS) or the raw
+    domtblout names (DOMTBLOUT_RENAMES). Hits with a zero-length alignment
+    are dropped either way. Target names and KO ids are returned
+    categorical, KO ids coded by ko_table first.
+    """
+    if isinstance(hits, (str, os.PathLike)):
+        return process_domtblout(hits, ko_table=ko_table)
+    if hasattr(hits, "to_pandas") and not isinstance(hits, pd.DataFrame):
+        hits = hits.to_pandas()
+    if not isinstance(hits, pd.DataFrame):
+        raise TypeError(f"Expected a domtblout path, DataFrame or Arrow table, got {type(hits).__name__}")
+    if 'query_name' in hits.columns:
+        hits = hits.rename(columns=DOMTBLOUT_RENAMES)
+    missing = [c for c in HIT_COLUMNS if c not in hits.columns]
+    if missing:
+        raise ValueError(f"Hit table is missing column(s): {', '.join(missing)}")
+    # zero-length alignments would divide by zero in sweep_overlap_groups
+    hits = positive_length_hits(hits)
+    # row positions become the 'index' column of the Dk table (the tie-break
+    # in best_hit_per_ko), whatever index or index name the caller's table has
+    hits = hits.reset_index(drop=True)
+    return hits.assign(**{'target name': encode_categorical(hits['target name']),
+                          'KO id': encode_categorical(hits['KO id'], ko_table)})
+
+class SampleResult:
+    """In-memory results of one sample: Dk table, path table and module structure."""
+
+    def __init__(self, dk, paths, modules, ko_hits=None, adjacency=None):
+        self.dk = dk              # per KO Dk, Dk_Neighbors and adjacency report (the _dk.csv rows)
+        self.paths = paths        # best (or top-K) path per module (the _paths.csv rows)
+        self._modules = modules   # dict, or a ModuleRepresentation until first accessed
+        self.ko_hits = ko_hits    # best hit per module KO, independent of completeness and alpha
+        self.adjacency = adjacency    # long (KO, neighbor) table in place of the dk string columns, if asked for
+
+    @property
+    def modules(self):
+        # module -> {nodes, best_path[, top_paths]} (the viewer JSON)
+        if not isinstance(self._modules, dict):
+            self._modules = dict(self._modules)
+        return self._modules
+
+    def write(self, out_pref, shards=False, adjacency_format='parquet'):
+        out_dir = os.path.dirname(out_pref) or "."
+        os.makedirs(out_dir, exist_ok=True)
+        self.dk.to_csv(f"{out_pref}_dk.csv", index=False)
+        self.paths.to_csv(f"{out_pref}_paths.csv", index=False)
+        print(f"Reports written to {out_pref}_dk.csv and {out_pref}_paths.csv")
+        if self.adjacency is not None:
+            write_adjacency_long(self.adjacency, out_pref, adjacency_format)
+        if shards:
+            write_module_shards(self._modules, f"{out_pref}_modules")
+        else:
+            write_module_representation(self._modules, f"{out_pref}_sample_modules_representation.json")
+
+def best_hit_per_ko(df_conf, best=None):
+    # highest score per KO; ties go to the hit listed first in the domtblout
+    if best is not None:
+        df_conf = pd.concat([best, df_conf], ignore_index=True)
+    df_conf = df_conf.sort_values(['score', 'index'], ascending=[False, True], kind='stable')
+    return df_conf.drop_duplicates(subset='KO id', keep='first')
+
+def ko_hit_table(reference, hits, profiler=None, stream=None, chunksize=DOMTBLOUT_CHUNKSIZE, tmp_dir=None,
+                 workers=1):
+    # hits -> best hit and its confidence for every module KO (hit_conf 0 without a hit)
+    profiler = profiler or StageProfiler()
+
+    if (stream or workers > 1) and isinstance(hits, (str, os.PathLike)):
+        with profiler.stage("stream") as st:
+            if workers > 1 and str(hits).endswith(COMPRESSED_SUFFIXES):
+                print(f"{hits} is compressed and cannot be split into byte ranges; reading it in one process")
+                workers = 1
+            if workers > 1:
+                hmm_hits_1, n_hits = parallel_best_hits(hits, workers, stream, chunksize, tmp_dir)
+            else:
+                hmm_hits_1, n_hits = stream_best_hits(hits, stream, chunksize, tmp_dir)
+            print("Number of rows after duplicates dropped: ",len(hmm_hits_1))
+            st.rows(n_hits, len(hmm_hits_1))
+        with profiler.stage("best_hits") as st:
+            hmm_hits_1['KO id'] = encode_categorical(hmm_hits_1['KO id'], reference.ko_table)
+            hmm_hits_all_kos = module_ko_hits(reference, hmm_hits_1)
+            st.rows(len(hmm_hits_1), len(hmm_hits_all_kos))
+        return hmm_hits_all_kos
+
+    with profiler.stage("parse") as st:
+        hmm_hits = read_hits(hits, reference.ko_table)
+        st.rows(rows_out=len(hmm_hits))
+    with profiler.stage("grouping") as st:
+        hmm_groups = assign_overlap_groups(hmm_hits)
+        st.rows(len(hmm_hits), len(hmm_groups))
+    with profiler.stage("confidence") as st:
+        hmm_hits_1 = calculate_hit_confidence_log(hmm_groups.reset_index(), e_threshold=E_THRESHOLD)
+        print("Number of rows after hit confidence calculation: ",len(hmm_hits_1))
+        st.rows(len(hmm_groups), len(hmm_hits_1))
+    with profiler.stage("best_hits") as st:
+        st.rows(rows_in=len(hmm_hits_1))
+        hmm_hits_1 = best_hit_per_ko(hmm_hits_1)
+        print("Number of rows after duplicates dropped: ",len(hmm_hits_1))
+        hmm_hits_all_kos = module_ko_hits(reference, hmm_hits_1)
+        st.rows(rows_out=len(hmm_hits_all_kos))
+    return hmm_hits_all_kos
+
+def module_ko_hits(reference, hmm_hits_1):
+    # one row per module KO, joined on the integer KO codes; text labels
+    # only for these rows
+    hmm_hits_1 = hmm_hits_1.assign(overlap_group=overlap_group_labels(hmm_hits_1)).drop(columns=["grp_id"])
+    columns = ['KO id'] + [c for c in hmm_hits_1.columns if c != 'KO id']
+    hmm_hits_all_kos = (hmm_hits_1.set_index(hmm_hits_1['KO id'].cat.codes.to_numpy())
+                        .reindex(reference.module_ko_codes)[columns].reset_index(drop=True))
+    hmm_hits_all_kos['KO id'] = reference.ko_table[reference.module_ko_codes]
+    for col in ('target name', 'strand'):
+        hmm_hits_all_kos[col] = hmm_hits_all_kos[col].astype(object)
+    hmm_hits_all_kos['hit_conf'] = hmm_hits_all_kos['hit_conf'].fillna(0)
+    print("Number of rows after adding all available KO information: ",len(hmm_hits_all_kos))
+    return hmm_hits_all_kos
+
+def detect_sample(reference, hits, sigma, args, profiler=None, ko_hits=None, digest=None):
+    # hits -> Dk, diffused Dk, best paths and module structure, all in memory
+    ko_to_modules_str = reference.ko_to_modules
+    ko_occ, neighbors, path_index = reference.ko_occ, reference.neighbors, reference.path_index
+    profiler = profiler or StageProfiler()
+
+    # stage results are reused from the result cache when the input is a
+    # file; each key extends the previous one with that stage's parameters
+    cache = result_cache(args) if ko_hits is None and isinstance(hits, (str, os.PathLike)) else None
+    if cache is not None:
+        source = {"input": os.path.abspath(hits)}
+        hits_key = cache.key("hits", cache.input_digest(hits, digest), E_THRESHOLD, reference.version)
+        dk_key = cache.key("dk", hits_key, sigma)
+        diffused_key = cache.key("diffused", dk_key, 0.6, args.diffusion_iterations, args.diffusion_tol)
+        ko_hits = cache.get("hits", hits_key)
+
+    if ko_hits is None:
+        hmm_hits_all_kos = ko_hit_table(reference, hits, profiler, stream=args.stream,
+                                        chunksize=args.stream_chunksize, tmp_dir=args.tmp_dir,
+                                        workers=args.ingest_workers)
+        if cache is not None:
+            cache.put("hits", hits_key, hmm_hits_all_kos, e_threshold=E_THRESHOLD, **source)
+    else:
+        hmm_hits_all_kos = ko_hits
+    with profiler.stage("dk") as st:
+        hmm_df_dk = cache.get("dk", dk_key) if cache is not None else None
+        if hmm_df_dk is None:
+            hmm_df_dk = calculate_dk_per_ko(ko_occ, hmm_hits_all_kos, sigma, reference.occ_rows(hmm_hits_all_kos))
+            if cache is not None:
+                cache.put("dk", dk_key, hmm_df_dk, completeness=sigma, **source)
+        hmm_dk_dict = dict(zip(hmm_df_dk['KO id'], hmm_df_dk['Dk']))
+        st.rows(len(hmm_hits_all_kos), len(hmm_df_dk))
+    with profiler.stage("diffusion") as st:
+        hmm_dk_spring_all = cache.get("diffused", diffused_key) if cache is not None else None
+        if hmm_dk_spring_all is None:
+            hmm_dk_spring_all = spring_update_probabilities(
+                hmm_dk_dict, neighbors, alpha=0.6,
+                iterations=args.diffusion_iterations, tol=args.diffusion_tol
+            )
+            if cache is not None:
+                cache.put("diffused", diffused_key, hmm_dk_spring_all, completeness=sigma, alpha=0.6,
+                          iterations=args.diffusion_iterations, tol=args.diffusion_tol, **source)
+        if len(hmm_dk_spring_all) == len(hmm_df_dk):
+            # rows follow hmm_dk_dict, i.e. the (unique) KO rows of hmm_df_dk
+            hmm_df_dk_new = hmm_df_dk.assign(Dk_Neighbors=hmm_dk_spring_all['Dk_Neighbors'].to_numpy())
+        else:
+            hmm_df_dk_new = hmm_df_dk.merge(hmm_dk_spring_all, on="KO id", how="left")
+
+        hmm_df_dk_new["Modules"] = hmm_df_dk_new["KO id"].map(ko_to_modules_str)
+        hmm_df_dk_new = hmm_df_dk_new.dropna(subset=['Modules'])
+        series = hmm_df_dk_new.set_index("KO id")["Dk_Neighbors"]
+        new_dk_dict = series.to_dict()
+        st.rows(len(hmm_df_dk), len(hmm_df_dk_new))
+
+    adjacency = None
+    with profiler.stage("adjacency") as st:
+        kos = hmm_df_dk_new['KO id'].tolist()
+        if args.adjacency_format == 'strings':
+            report = adjacency_report(kos, neighbors, new_dk_dict)
+            hmm_df_dk_new[ADJACENCY_COLUMNS] = report.set_axis(hmm_df_dk_new.index).to_numpy()
+            st.rows(len(hmm_df_dk_new), len(hmm_df_dk_new))
+        else:
+            adjacency = adjacency_long(kos, neighbors, new_dk_dict)
+            st.rows(len(hmm_df_dk_new), len(adjacency))
+
+    with profiler.stage("paths") as st:
+        if args.path_search == 'dp':
+            hmm_paths = dp_path_probabilities(reference.require_graph_index(args.cache_dir), hmm_dk_dict, new_dk_dict)
+        else:
+            hmm_paths = indexed_path_probabilities(path_index, hmm_dk_dict, new_dk_dict, top_k=args.top_paths)
+        st.rows(len(new_dk_dict), len(hmm_paths))
+
+    with profiler.stage("modules") as st:
+        modules = ModuleRepresentation(
+            reference.module_nodes,
+            ko_occ_df=ko_occ,
+            dk_before=hmm_dk_dict,
+            evalue=dict(zip(hmm_hits_all_kos['KO id'], hmm_hits_all_kos['E-value'].replace(np.nan,100.0))),
+            dk_after=new_dk_dict,
+            df_best_paths=hmm_paths
+        )
+        st.rows(len(hmm_paths), len(modules))
+
+    return SampleResult(hmm_df_dk_new, hmm_paths, modules, hmm_hits_all_kos, adjacency)
+
+def run_sample(reference, path, sigma, out_pref, args):
+    # domtblout -> Dk, diffused Dk, best paths; writes the per-sample reports
+    out_dir = os.path.dirname(out_pref) or "."
+    os.makedirs(out_dir, exist_ok=True)
+    profiler = StageProfiler(args.profile is not None, args.profile_stage, out_pref)
+
+    result = detect_sample(reference, path, sigma, args, profiler)
+    with profiler.stage("export") as st:
+        result.write(out_pref, shards=args.module_shards, adjacency_format=args.adjacency_format)
+        st.rows(rows_out=len(result.dk) + len(result.paths))
+    if args.sweep_completeness is not None or args.sweep_alpha is not None:
+        with profiler.stage("sweep") as st:
+            sweep_paths, sweep_dk = sweep_sample(
+                reference, result.ko_hits, args.sweep_completeness or [sigma], args.sweep_alpha or [0.6],
+                iterations=args.diffusion_iterations, tol=args.diffusion_tol, cache_dir=args.cache_dir)
+            sweep_paths.to_csv(f"{out_pref}_sweep.csv", index=False)
+            sweep_dk.to_csv(f"{out_pref}_sweep_dk.csv", index=False)
+            print(f"Sweep of {sweep_dk['completeness'].nunique()} completeness x {sweep_dk['alpha'].nunique()} alpha "
+                  f"values written to {out_pref}_sweep.csv and {out_pref}_sweep_dk.csv")
+            st.rows(len(result.ko_hits), len(sweep_paths))
+    if args.uncertainty:
+        with profiler.stage("uncertainty") as st:
+            report = uncertainty_sample(reference.require_path_index(args.cache_dir), result.dk, args.uncertainty,
+                                        args.mc_seed, args.mc_floor, args.mc_quantiles)
+            report.to_csv(f"{out_pref}_uncertainty.csv", index=False)
+            print(f"Best-path score quantiles over {args.uncertainty} replicates written to {out_pref}_uncertainty.csv")
+            st.rows(len(result.dk), len(report))
+    profiler.write(args.profile or "json")
+
+    print(f"Diagram reports written to {out_pref}_nodes_enriched.csv")
+    print(f"Open HTML file index.html in a local browser. Upload {out_pref}_nodes_enriched.json when prompted.")
+
+    return result
+
+"""## Streaming"""
+
+STREAM_PARTITION_BYTES = 32 * 2**20     # domtblout text per spill partition
+STREAM_COMPRESSION_RATIO = 8            # assumed for compressed inputs
+STREAM_OPEN_FILES = 128                 # spill files a process keeps open at once
+
+class TargetHashes:
+    # 64-bit hashes of finished target names (8 bytes per target), kept as
+    # sorted runs; a run is merged into the previous one once it reaches
+    # half its size, so there are O(log n) runs to search
+    def __init__(self):
+        self.runs = []
+
+    def isin(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.runs:
+            pos = np.searchsorted(run, hashes).clip(max=len(run) - 1)
+            found |= run[pos] == hashes
+        return found
+
+    def add(self, hashes):
+        if not len(hashes):
+            return    # an empty run would break isin
+        run = np.sort(hashes)
+        while self.runs and len(self.runs[-1]) <= 2 * len(run):
+            run = np.sort(np.concatenate([self.runs.pop(), run]))
+        self.runs.append(run)
+
+def new_targets(targets, done, name):
+    # hashes of distinct target runs that were not finished before
+    hashes = pd.util.hash_array(targets)
+    _, first = np.unique(hashes, return_index=True)
+    again = done.isin(hashes)
+    again[np.setdiff1d(np.arange(len(hashes)), first)] = True
+    if again.any():
+        raise ValueError(f"{name} is not grouped by target name ({targets[again][0]} comes back after "
+                         f"other targets); use --stream spill instead")
+    return hashes
+
+def sorted_target_blocks(chunks, name="input"):
+    # input grouped by target name (e.g. sort -k1,1 under any locale): each
+    # chunk is cut before its last target and the rest carried into the next
+    # chunk. Only contiguity matters, not the collation order, so a target
+    # that comes back after another target is the error.
+    carry, done = None, TargetHashes()
+    for chunk in chunks:
+        chunk = filter_domtblout_chunk(chunk)
+        chunk['target name'] = chunk['target name'].astype(object)
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        if chunk.empty:
+            continue
+        targets = chunk['target name'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+        finished = targets[starts[:-1]]
+        done.add(new_targets(finished, done, name))
+        cut = int(starts[-1])
+        carry = chunk.iloc[cut:]
+        if cut:
+            yield chunk.iloc[:cut]
+    if carry is not None and len(carry):
+        new_targets(carry['target name'].to_numpy()[:1], done, name)
+        yield carry
+
+def spill_partition_count(path):
+    ratio = STREAM_COMPRESSION_RATIO if str(path).endswith(COMPRESSED_SUFFIXES) else 1
+    return max(1, math.ceil(os.path.getsize(path) * ratio / STREAM_PARTITION_BYTES))
+
+def spill_open_limit():
+    # STREAM_OPEN_FILES, or a quarter of a lower soft limit on open files
+    if resource is None:
+        return STREAM_OPEN_FILES
+    soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft == resource.RLIM_INFINITY:
+        return STREAM_OPEN_FILES
+    return max(1, min(STREAM_OPEN_FILES, soft // 4))
+
+class SpillFiles:
+    """Append-only part_<i><tag>.pkl files with at most max_open of them open.
+
+    The least recently written file is closed when another one is needed
+    and reopened in append mode later, so the partition count is not
+    limited by the open file limit (ulimit -n). Pickles written back to
+    back are read with repeated loads.
+    """
+
+    def __init__(self, spill_dir, tag="", max_open=None):
+        self.spill_dir, self.tag = spill_dir, tag
+        self.max_open = spill_open_limit() if max_open is None else max(1, max_open)
+        self.files = {}     # partition -> open file, least recently written first
+
+    def write(self, i, obj):
+        f = self.files.pop(i, None)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.files.pop(next(iter(self.files))).close()
+            f = open(os.path.join(self.spill_dir, f"part_{i}{self.tag}.pkl"), "ab")
+        self.files[i] = f
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+def write_spill(chunks, spill_dir, n_partitions, tag=""):
+    # hash-partition hits by target name into part_<i><tag>.pkl; returns the
+    # number of data lines read (before filtering)
+    n_rows = 0
+    files = SpillFiles(spill_dir, tag)
+    try:
+        for chunk in chunks:
+            n_rows += len(chunk)
+            chunk = filter_domtblout_chunk(chunk)
+            targets = chunk['target name'].cat
+            part = (pd.util.hash_array(targets.categories.to_numpy(dtype=object)) % n_partitions)[targets.codes.to_numpy()]
+            for i, piece in chunk.groupby(part, sort=False):
+                piece = piece.assign(**{col: piece[col].cat.remove_unused_categories() for col in ('target name', 'KO id')})
+                files.write(i, piece)
+    finally:
+        files.close()
+    return n_rows
+
+def read_spill(paths, offsets=None):
+    # all pieces of one partition, row labels shifted by the offset of the
+    # byte range each file came from
+    pieces = []
+    for k, path in enumerate(paths):
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    piece = pickle.load(f)
+                except EOFError:
+                    break
+                if offsets is not None:
+                    piece.index += offsets[k]
+                pieces.append(piece)
+    return concat_hit_chunks(pieces).sort_index() if pieces else None
+
+def spilled_target_blocks(path, chunksize=DOMTBLOUT_CHUNKSIZE, tmp_dir=None, n_partitions=None):
+    # any input order: hits are hash-partitioned by target name into spill
+    # files, so every target ends up whole in one partition
+    n_partitions = n_partitions or spill_partition_count(path)
+    with tempfile.TemporaryDirectory(prefix="blimmp_stream_", dir=tmp_dir) as spill_dir:
+        write_spill(read_domtblout_chunks(path, chunksize), spill_dir, n_partitions)
+        for i in range(n_partitions):
+            block = read_spill([os.path.join(spill_dir, f"part_{i}.pkl")])
+            if block is not None:
+                yield block
+
+def block_confidence(block):
+    # grouping + confidence of a block of whole targets, as object columns
+    # so results of different blocks concatenate cheaply
+    groups = assign_overlap_groups(block)
+    conf = calculate_hit_confidence_log(groups.reset_index(), e_threshold=E_THRESHOLD)
+    return conf.astype({'target name': object, 'KO id': object, 'strand': object})
+
+def stream_best_hits(path, mode="spill", chunksize=DOMTBLOUT_CHUNKSIZE, tmp_dir=None):
+    """Best hit per KO over a domtblout of any size, one block of whole targets at a time.
+
+    Grouping and confidence only look at hits of one target, so each block
+    is reduced to its best hit per KO and merged into the running result;
+    peak memory is one block plus one row per KO. Returns (best hits,
+    number of hits read).
+    """
+    if mode == "sorted":
+        blocks = sorted_target_blocks(read_domtblout_chunks(path, chunksize), path)
+    else:
+        blocks = spilled_target_blocks(path, chunksize, tmp_dir)
+    best, n_hits, n_blocks = None, 0, 0
+    for block in blocks:
+        best = best_hit_per_ko(block_confidence(block), best)
+        n_hits += len(block)
+        n_blocks += 1
+    print(f"Streamed {n_hits} hits in {n_blocks} block(s)")
+    return finish_best_hits(path, best), n_hits
+
+def finish_best_hits(path, best):
+    if best is None:
+        # no hits at all: the (empty) in-memory result has the same columns
+        best = best_hit_per_ko(calculate_hit_confidence_log(
+            assign_overlap_groups(process_domtblout(path)).reset_index()))
+    return best.reset_index(drop=True)
+
+"""## Parallel ingestion"""
+
+class ByteRange(io.RawIOBase):
+    # read-only view of bytes [start, end) of a file
+    def __init__(self, path, start, end):
+        self.f = open(path, "rb")
+        self.f.seek(start)
+        self.left = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.left)
+        if n <= 0:
+            return 0
+        n = self.f.readinto(memoryview(b)[:n])
+        self.left -= n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+def target_name_of(line):
+    return line.split(None, 1)[0] if line.strip() and not line.startswith(b"#") else None
+
+def byte_ranges(path, n_ranges, target_runs=False):
+    """Split a file into about n_ranges [start, end) byte ranges on line starts.
+
+    With target_runs each boundary is moved further to the first line of a
+    new target name, so no target is split (input grouped by target).
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, n_ranges):
+            pos = max(size * i // n_ranges, bounds[-1])
+            if pos >= size:
+                break
+            f.seek(pos)
+            if pos:
+                f.readline()
+            if target_runs:
+                # skip to the first line whose target differs from this one
+                first = target_name_of(f.readline())
+                while True:
+                    start = f.tell()
+                    line = f.readline()
+                    if not line or target_name_of(line) != first:
+                        f.seek(start)
+                        break
+            if f.tell() > bounds[-1] and f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _range_chunks(path, start, end, chunksize):
+    # pandas leaves handles it did not open alone: close the range when done
+    with io.BufferedReader(ByteRange(path, start, end)) as f:
+        yield from read_domtblout_chunks(f, chunksize)
+
+def _spill_byte_range(job):
+    path, start, end, chunksize, spill_dir, n_partitions, r = job
+    return write_spill(_range_chunks(path, start, end, chunksize), spill_dir, n_partitions, tag=f"_{r}")
+
+def _reduce_partition(job):
+    spill_dir, i, offsets = job
+    block = read_spill([os.path.join(spill_dir, f"part_{i}_{r}.pkl") for r in range(len(offsets))], offsets)
+    if block is None:
+        return None, 0
+    return best_hit_per_ko(block_confidence(block)), len(block)
+
+def _reduce_sorted_range(job):
+    path, start, end, chunksize = job
+    counted = [0]
+    def chunks():
+        for chunk in _range_chunks(path, start, end, chunksize):
+            counted[0] += len(chunk)
+            yield chunk
+    best, n_hits = None, 0
+    for block in sorted_target_blocks(chunks(), f"{path} [{start}:{end}]"):
+        best = best_hit_per_ko(block_confidence(block), best)
+        n_hits += len(block)
+    return best, n_hits, counted[0]
+
+def parallel_best_hits(path, workers, mode="spill", chunksize=DOMTBLOUT_CHUNKSIZE, tmp_dir=None):
+    """stream_best_hits over line-aligned byte ranges of one file in worker processes.
+
+    sorted input: ranges end on target boundaries and each worker reduces
+    its range. Any other order: workers first spill their range by target
+    hash, then each reduces whole partitions. Row labels are shifted by the
+    data lines of the preceding ranges, so results match the serial run.
+    """
+    best, n_hits = None, 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if mode == "sorted":
+            ranges = byte_ranges(path, workers * 2, target_runs=True)
+            results = list(pool.map(_reduce_sorted_range, [(path, a, b, chunksize) for a, b in ranges]))
+            offset = 0
+            for range_best, range_hits, range_rows in results:
+                if range_best is not None:
+                    range_best['index'] += offset
+                    best = best_hit_per_ko(range_best, best)
+                n_hits += range_hits
+                offset += range_rows
+        else:
+            ranges = byte_ranges(path, workers * 2)
+            n_partitions = max(spill_partition_count(path), workers)
+            with tempfile.TemporaryDirectory(prefix="blimmp_ingest_", dir=tmp_dir) as spill_dir:
+                jobs = [(path, a, b, chunksize, spill_dir, n_partitions, r) for r, (a, b) in enumerate(ranges)]
+                rows = list(pool.map(_spill_byte_range, jobs))
+                offsets = np.concatenate([[0], np.cumsum(rows)[:-1]]).astype(np.int64).tolist()
+                for part_best, part_hits in pool.map(_reduce_partition, [(spill_dir, i, offsets) for i in range(n_partitions)]):
+                    if part_best is not None:
+                        best = best_hit_per_ko(part_best, best)
+                    n_hits += part_hits
+    print(f"Read {n_hits} hits from {len(ranges)} byte range(s) with {workers} workers")
+    return finish_best_hits(path, best), n_hits
+
+"""## Parameter sweep"""
+
+SWEEP_CHUNK = 2_000_000    # max. path factors x combinations scored at once
+
+def completeness_sigma(completeness):
+    # the sigma term of calculate_dk_per_ko, for any array of completeness values
+    return 1 - ((np.exp(3 * np.asarray(completeness, dtype=np.float64)) - 1) / np.exp(3))
+
+def sweep_sample(reference, ko_hits, completeness_grid, alpha_grid, iterations=1, tol=None, cache_dir=None):
+    """Dk, diffused Dk and best paths for every (completeness, alpha) pair.
+
+    ko_hits is the per-KO table of ko_hit_table, computed once. Dk is
+    broadcast over completeness as a (C, K) array and diffusion runs on an
+    (A, C, n) stack: alpha only scales row i of the neighbor matrix by
+    alpha ** (1 / sum_e_i), so every combination shares one normalized
+    product per step. Returns the long-format path and Dk tables.
+    """
+    C = np.asarray(completeness_grid, dtype=np.float64)
+    A = np.asarray(alpha_grid, dtype=np.float64)
+    nm = reference.neighbors
+    path_index = reference.require_path_index(cache_dir)
+
+    # 1) Dk for every completeness, same terms as calculate_dk_per_ko
+    occ_rows = reference.occ_rows(ko_hits)
+    if occ_rows is None:
+        df = ko_hits[['KO id', 'hit_conf']].merge(reference.ko_occ, on='KO id', how='left')
+    else:
+        df = pd.concat([ko_hits[['KO id', 'hit_conf']].reset_index(drop=True),
+                        occurrence_rows(reference.ko_occ, occ_rows)], axis=1)
+    df = df.fillna({'KO_freq': 1e-4})
+    kos = df['KO id'].to_numpy()
+    hit_conf = df['hit_conf'].to_numpy(dtype=np.float64)
+    ko_freq = df['KO_freq'].to_numpy(dtype=np.float64)
+    dk = hit_conf + (1 - hit_conf) * completeness_sigma(C)[:, None] * ko_freq    # (C, K)
+
+    # 2) diffusion of all combinations at once, as in spring_update_probabilities
+    pos = nm.positions(kos)
+    known = pos >= 0
+    update = pos[known]
+    update = update[nm.has_neighbors[update]]
+    x = np.zeros((len(A), len(C), len(nm.ko_ids)))
+    x[..., pos[known]] = dk[:, known]
+    with np.errstate(divide='ignore'):
+        X = A[:, None, None] ** (1.0 / nm.row_sum[update])                     # (A, 1, U)
+    for it in range(1, iterations + 1):
+        p_i = x[..., update]
+        new = np.minimum(p_i + (1.0 - p_i) * X * nm.matvec_norm(x)[..., update], 1.0)
+        delta = np.max(np.abs(new - p_i)) if new.size else 0.0
+        x[..., update] = new
+        if tol is not None and delta < tol:
+            break
+    dk_after = np.broadcast_to(dk, x.shape[:2] + dk.shape[1:]).copy()       # (A, C, K)
+    dk_after[..., known] = x[..., pos[known]]
+
+    # 3) log Dk in path index KO order; KOs without a Dk count as 1.0
+    ko_pos = {ko: i for i, ko in enumerate(kos)}
+    col = np.fromiter((ko_pos.get(ko, -1) for ko in path_index.kos), dtype=np.int64, count=len(path_index.kos))
+    has = col >= 0
+    def log_table(values):
+        out = np.zeros(values.shape[:-1] + (len(col),))
+        with np.errstate(divide='ignore'):
+            out[..., has] = np.log(values[..., col[has]])
+        return out
+
+    raw_before, geo_before = path_index.score_log(log_table(dk))             # (C, P)
+
+    # 4) best path by geo_after per module and combination, in chunks of combinations
+    n_comb, n_paths, n_modules = len(A) * len(C), len(path_index.path_ids), len(path_index.modules)
+    flat_after = dk_after.reshape(n_comb, -1)
+    step = max(1, SWEEP_CHUNK // max(1, len(path_index.factor_ko)))
+    comb, best, raw_best, geo_best = [], [], [], []
+    for lo in range(0, n_comb, step):
+        raw_after, geo_after = path_index.score_log(log_table(flat_after[lo:lo + step]))
+        n = len(raw_after)
+        codes = (np.arange(n)[:, None] * n_modules + path_index.path_module).ravel()
+        sel = segmented_argmax(geo_after.ravel(), codes, n * n_modules)
+        c, p = np.divmod(sel, n_paths)
+        comb.append(lo + c)
+        best.append(p)
+        raw_best.append(raw_after[c, p])
+        geo_best.append(geo_after[c, p])
+    comb, best = np.concatenate(comb), np.concatenate(best)
+    a_i, c_i = np.divmod(comb, len(C))
+
+    path_strs = {i: path_index.path_str(i) for i in np.unique(best).tolist()}
+    sweep_paths = pd.DataFrame({
+        'completeness': C[c_i],
+        'alpha':        A[a_i],
+        'module':       path_index.modules[path_index.path_module[best]],
+        'path_id':      path_index.path_ids[best],
+        'path_str':     [path_strs[i] for i in best.tolist()],
+        'raw_before':   raw_before[c_i, best],
+        'geo_before':   geo_before[c_i, best],
+        'raw_after':    np.concatenate(raw_best),
+        'geo_after':    np.concatenate(geo_best),
+    })
+    sweep_dk = pd.DataFrame({
+        'completeness': np.tile(np.repeat(C, len(kos)), len(A)),
+        'alpha':        np.repeat(A, len(C) * len(kos)),
+        'KO id':        np.tile(kos, n_comb),
+        'Dk':           np.broadcast_to(dk, dk_after.shape).ravel(),
+        'Dk_Neighbors': dk_after.ravel(),
+    })
+    return sweep_paths, sweep_dk
+
+"""## Monte Carlo uncertainty"""
+
+MC_CHUNK = 2_000_000       # max. path factors x replicates scored at once
+
+def best_geo_per_module(path_index, geo):
+    # (..., n_paths) geo scores -> (..., n_modules with paths) best score
+    offsets = path_index.module_offsets
+    has_paths = offsets[1:] > offsets[:-1]
+    return np.maximum.reduceat(geo, offsets[:-1][has_paths], axis=-1), has_paths
+
+def uncertainty_sample(path_index, dk_table, replicates=1000, seed=0, floor=1e-4,
+                       quantiles=(0.05, 0.5, 0.95)):
+    """Quantiles of the best-path geo score per module under sampled KO presence.
+
+    Every replicate draws each KO present with probability Dk (before) or
+    Dk_Neighbors (after); both use the same uniform draw, so the two
+    columns differ only through the diffusion. A present KO enters
+    score_path with 1.0, an absent one with `floor` (0 makes every path
+    through it score 0). KOs outside dk_table count as 1.0 as in
+    compute_path_probability. Replicates are scored in chunks.
+    """
+    ko_pos = {ko: i for i, ko in enumerate(dk_table['KO id'])}
+    col = np.fromiter((ko_pos.get(ko, -1) for ko in path_index.kos), dtype=np.int64, count=len(path_index.kos))
+    has = col >= 0
+    p_before = dk_table['Dk'].to_numpy(dtype=np.float64)[col[has]]
+    p_after = dk_table['Dk_Neighbors'].to_numpy(dtype=np.float64)[col[has]]
+    with np.errstate(divide='ignore'):
+        log_absent = np.log(floor)
+
+    rng = np.random.default_rng(seed)
+    step = max(1, MC_CHUNK // max(1, len(path_index.factor_ko)))
+    best_before, best_after = [], []
+    for lo in range(0, replicates, step):
+        n = min(step, replicates - lo)
+        u = rng.random((n, len(p_before)))
+        for p, best in ((p_before, best_before), (p_after, best_after)):
+            log_dk = np.zeros((n, len(col)))
+            log_dk[:, has] = np.where(u < p, 0.0, log_absent)
+            best.append(best_geo_per_module(path_index, path_index.score_log(log_dk)[1])[0])
+    best_before, best_after = np.concatenate(best_before), np.concatenate(best_after)    # (R, M)
+
+    _, has_paths = best_geo_per_module(path_index, np.zeros(len(path_index.path_ids)))
+    report = pd.DataFrame({'module': path_index.modules[has_paths], 'replicates': replicates})
+    for name, best in (('before', best_before), ('after', best_after)):
+        report[f'geo_{name}_mean'] = best.mean(axis=0)
+        for q, values in zip(quantiles, np.quantile(best, quantiles, axis=0)):
+            report[f'geo_{name}_q{q:g}'] = values
+        report[f'p_complete_{name}'] = (best >= 1.0).mean(axis=0)
+    return report
+
+class ModuleDetector:
+    """Reference data loaded once, applied to any number of samples in memory.
+
+        detector = ModuleDetector(top_paths=3)
+        result = detector.detect("sample.domtblout", completeness=0.8)
+        result.dk, result.paths, result.modules
+
+    Keyword options are the analysis options of the command line
+    (diffusion_iterations, diffusion_tol, path_search, top_paths, ...).
+    """
+
+    def __init__(self, reference=None, **options):
+        self.options = analysis_options(**options)
+        if reference is None:
+            reference = ReferenceData.load(self.options.cache_dir,
+                                           with_path_index=self.options.path_search == 'index',
+                                           use_cache=not self.options.no_reference_cache,
+                                           reference_data=self.options.reference_data,
+                                           module_graphs=self.options.module_graphs)
+        elif self.options.path_search == 'index':
+            reference.require_path_index(self.options.cache_dir)
+        self.reference = reference
+
+    def detect(self, hits, completeness=1.0):
+        """hits: domtblout path, DataFrame or Arrow table; completeness in [0, 1]."""
+        if not 0.0 <= completeness <= 1.0:
+            raise ValueError(f"completeness must be between 0.0 and 1.0, got {completeness}")
+        return detect_sample(self.reference, hits, completeness, self.options)
+
+    def uncertainty(self, result, replicates=1000, seed=0, floor=1e-4, quantiles=(0.05, 0.5, 0.95)):
+        """Per module quantiles of the best-path score; result is a SampleResult from detect()."""
+        return uncertainty_sample(self.reference.require_path_index(self.options.cache_dir), result.dk,
+                                  replicates, seed, floor, quantiles)
+
+    def sweep(self, hits, completeness_grid, alpha_grid=(0.6,)):
+        """Long-format (paths, dk) tables over every completeness x alpha pair; hits parsed once."""
+        ko_hits = hits.ko_hits if isinstance(hits, SampleResult) else ko_hit_table(
+            self.reference, hits, stream=self.options.stream,
+            chunksize=self.options.stream_chunksize, tmp_dir=self.options.tmp_dir,
+            workers=self.options.ingest_workers)
+        return sweep_sample(self.reference, ko_hits, completeness_grid, alpha_grid,
+                            iterations=self.options.diffusion_iterations, tol=self.options.diffusion_tol,
+                            cache_dir=self.options.cache_dir)
+
+"""## Result cache"""
+
+RESULT_CACHE_VERSION = 1
+RESULT_CACHE_MB = 1024
+RESULT_STAGES = ("hits", "dk", "diffused")
+RESULT_CACHE_LOW_WATER = 0.9    # put evicts down to this fraction of max_mb, not just below it
+_RESULT_CACHE_BYTES = {}    # cache root -> bytes this process knows to be stored there
+
+class ResultCache:
+    """Content-addressed intermediate results under <cache_dir>/results.
+
+    Each stage output (max-confidence hits per KO, Dk table, diffused Dk) is
+    stored as <stage>/<key>.pkl with a <key>.json description. Keys chain:
+    hits from the SHA-256 of the input's content, the e-value threshold and
+    the reference version; dk adds the completeness; diffused adds alpha,
+    iterations and tol.
+    Reading an entry touches it. The cache size is scanned once per process
+    and then kept up to date by put; once it exceeds max_mb the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir=None, max_mb=RESULT_CACHE_MB):
+        self.root = os.path.join(cache_dir or default_cache_dir(), "results")
+        self.max_bytes = max_mb * 2**20
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps([RESULT_CACHE_VERSION, *parts]).encode()).hexdigest()[:32]
+
+    def input_digest(self, path, sha256=None):
+        # SHA-256 of the input's content, unless the caller already has it
+        # (e.g. hashed while uploading). The digest of a path is memoised in
+        # inputs/ and reused while its size, mtime, ctime and inode are
+        # unchanged, so an unchanged input is only read by the parser.
+        if sha256 is None:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            stamp = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+            memo = os.path.join(self.root, "inputs", hashlib.sha256(path.encode()).hexdigest()[:32] + ".json")
+            try:
+                with open(memo) as f:
+                    saved = json.load(f)
+                if saved["stamp"] == stamp:
+                    sha256 = saved["sha256"]
+            except (OSError, ValueError, KeyError):
+                pass
+            if sha256 is None:
+                sha256 = file_sha256(path)
+                try:
+                    os.makedirs(os.path.dirname(memo), exist_ok=True)
+                    write_json_atomic(memo, {"path": path, "stamp": stamp, "sha256": sha256})
+                except OSError:
+                    pass
+        return f"sha256:{sha256}"
+
+    def get(self, stage, key):
+        path = os.path.join(self.root, stage, f"{key}.pkl")
+        try:
+            with open(path, "rb") as f:
+                obj = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+        try:
+            os.utime(path)    # LRU touch; a read-only or shared cache still serves the entry
+        except OSError:
+            pass
+        print(f"Reusing cached {stage} result {key[:12]}")
+        return obj
+
+    def put(self, stage, key, obj, **meta):
+        stage_dir = os.path.join(self.root, stage)
+        path = os.path.join(stage_dir, f"{key}.pkl")
+        try:
+            os.makedirs(stage_dir, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            meta_path = os.path.join(stage_dir, f"{key}.json")
+            write_json_atomic(meta_path, {"stage": stage, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), **meta})
+            size = os.path.getsize(path) + os.path.getsize(meta_path)
+        except OSError as e:
+            print(f"Could not write result cache entry to {stage_dir}: {e}")
+            return
+        _RESULT_CACHE_BYTES[self.root] = self.stored_bytes() + size
+        if _RESULT_CACHE_BYTES[self.root] > self.max_bytes:
+            self.evict(int(self.max_bytes * RESULT_CACHE_LOW_WATER))
+
+    def scan(self):
+        # (stage, key, bytes, last used) of every entry, from directory stats only
+        for stage in RESULT_STAGES:
+            try:
+                files = {e.name: e.stat() for e in os.scandir(os.path.join(self.root, stage)) if e.is_file()}
+            except FileNotFoundError:
+                continue
+            for name, st in files.items():
+                if name.endswith(".pkl"):
+                    meta = files.get(name[:-len(".pkl")] + ".json")
+                    yield stage, name[:-len(".pkl")], st.st_size + (meta.st_size if meta else 0), st.st_mtime
+
+    def stored_bytes(self):
+        if self.root not in _RESULT_CACHE_BYTES:
+            _RESULT_CACHE_BYTES[self.root] = sum(size for _, _, size, _ in self.scan())
+        return _RESULT_CACHE_BYTES[self.root]
+
+    def entries(self):
+        rows = []
+        for stage in RESULT_STAGES:
+            for pkl in glob.glob(os.path.join(self.root, stage, "*.pkl")):
+                key = os.path.basename(pkl)[:-len(".pkl")]
+                meta_path = pkl[:-len(".pkl")] + ".json"
+                try:
+                    st = os.stat(pkl)
+                    size = st.st_size + (os.path.getsize(meta_path) if os.path.exists(meta_path) else 0)
+                    with open(meta_path) as f:
+                        meta = json.load(f)
+                except (OSError, ValueError):
+                    meta = {}
+                    if not os.path.exists(pkl):
+                        continue
+                rows.append({"stage": stage, "key": key, "bytes": size, "last_used": st.st_mtime,
+                             **{k: v for k, v in meta.items() if k != "stage"}})
+        return rows
+
+    def remove(self, entry):
+        for ext in (".pkl", ".json"):
+            try:
+                os.remove(os.path.join(self.root, entry["stage"], entry["key"] + ext))
+            except FileNotFoundError:
+                pass
+
+    def evict(self, max_bytes=None):
+        # least recently used first, until the cache fits; returns (entries, bytes) removed
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self.scan(), key=lambda e: e[3])
+        total = sum(size for _, _, size, _ in entries)
+        removed = freed = 0
+        for stage, key, size, _ in entries:
+            if total <= max_bytes:
+                break
+            self.remove({"stage": stage, "key": key})
+            total -= size
+            removed += 1
+            freed += size
+        _RESULT_CACHE_BYTES[self.root] = total
+        return removed, freed
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        _RESULT_CACHE_BYTES.pop(self.root, None)
+
+def result_cache(args):
+    return None if args.no_result_cache else ResultCache(args.cache_dir, args.result_cache_mb)
+
+def cache_main(argv=None):
+    parser = argparse.ArgumentParser(prog='module_detection.py cache',
+                                     description='Inspect or trim the cache of intermediate per-sample results.')
+    parser.add_argument('action', choices=['list', 'evict', 'clear'], nargs='?', default='list',
+                        help='list entries (default), evict down to --max-mb, or remove everything')
+    parser.add_argument('--cache-dir', default=None,
+                        help='Cache directory (default $BLIMMP_CACHE_DIR or ~/.cache/BLIMMP)')
+    parser.add_argument('--max-mb', type=float, default=RESULT_CACHE_MB,
+                        help=f'Size limit for evict, in MB (default {RESULT_CACHE_MB})')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.cache_dir, args.max_mb)
+    if args.action == 'clear':
+        cache.clear()
+        print(f"Removed {cache.root}")
+        return 0
+    if args.action == 'evict':
+        removed, freed = cache.evict()
+        print(f"Evicted {removed} entries, {freed / 2**20:.1f} MB")
+        return 0
+
+    entries = sorted(cache.entries(), key=lambda e: e["last_used"], reverse=True)
+    if entries:
+        table = pd.DataFrame(entries)
+        table["key"] = table["key"].str[:12]
+        table["MB"] = (table.pop("bytes") / 2**20).round(3)
+        table["last_used"] = pd.to_datetime(table["last_used"], unit="s").dt.strftime("%Y-%m-%d %H:%M")
+        print(table.to_string(index=False))
+    total = sum(e["bytes"] for e in entries)
+    print(f"{len(entries)} entries, {total / 2**20:.1f} MB in {cache.root}")
+    return 0
+
+"""## Batch mode"""
+
+BATCH_SUFFIXES = tuple(f"{ext}{c}" for ext in ('.domtblout', '.tbl') for c in ('',) + COMPRESSED_SUFFIXES)
+
+def sample_name(path):
+    return os.path.basename(path).split('.')[0]
+
+def collect_batch_inputs(inputs, manifest=None, completeness=1.0):
+    """(sample, path, completeness) for every input of a batch.
+
+    inputs may be files, directories (scanned for domtblout files) or glob
+    patterns. A manifest is a CSV/TSV with 'path' and optional 'sample' and
+    'completeness' columns; relative paths are taken from its directory.
+    """
+    jobs = []
+    if manifest:
+        df = pd.read_csv(manifest, sep=None, engine='python', dtype={'sample': str})
+        if 'path' not in df.columns:
+            raise ValueError(f"Manifest {manifest} needs a 'path' column")
+        base = os.path.dirname(os.path.abspath(manifest))
+        for row in df.to_dict(orient='records'):
+            path = row['path'] if os.path.isabs(row['path']) else os.path.join(base, row['path'])
+            sample = row.get('sample')
+            sample = sample if isinstance(sample, str) and sample else sample_name(path)
+            c = row.get('completeness', completeness)
+            jobs.append((sample, path, completeness if pd.isna(c) else completeness_float(c)))
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = sorted(os.path.join(item, f) for f in os.listdir(item) if f.endswith(BATCH_SUFFIXES))
+        elif os.path.isfile(item):
+            paths = [item]
+        else:
+            paths = sorted(glob.glob(item))
+            if not paths:
+                raise ValueError(f"No input matches {item}")
+        jobs.extend((sample_name(p), p, completeness) for p in paths)
+
+    seen = {}
+    for sample, path, _ in jobs:
+        if sample in seen and seen[sample] != path:
+            raise ValueError(f"Sample name {sample} is used by both {seen[sample]} and {path}")
+        seen[sample] = path
+    return jobs
+
+_WORKER_REFERENCE = None
+
+def _init_batch_worker(reference):
+    # runs once per worker process; with fork the reference is inherited
+    # copy-on-write instead of being re-read
+    global _WORKER_REFERENCE
+    _WORKER_REFERENCE = reference
+
+def _run_batch_sample(job):
+    sample, path, sigma, out_pref, args = job
+    try:
+        print(f"Processing sample {sample} with sigma={sigma}")
+        result = run_sample(_WORKER_REFERENCE, path, sigma, out_pref, args)
+        dk = result.dk[PARTIAL_DK_COLUMNS] if args.shard_count else None
+        return sample, result.paths, dk, None
+    except Exception as e:
+        return sample, None, None, f"{type(e).__name__}: {e}"
+
+def batch_summary(results):
+    # sample x module table of the best geo_after
+    frames = []
+    for sample, paths, _ in results:
+        best = paths[paths['rank'] == 1] if 'rank' in paths.columns else paths
+        frames.append(best[['module', 'geo_after']].assign(sample=sample))
+    if not frames:
+        return pd.DataFrame()
+    long = pd.concat(frames, ignore_index=True)
+    return long.pivot(index='sample', columns='module', values='geo_after').sort_index(axis=1)
+
+def batch_main(argv=None):
+    parser = argparse.ArgumentParser(prog='BLIMMP batch',
+                                     description='Process many domtblout files with one copy of the reference data')
+    parser.add_argument('inputs', nargs='*', help='domtblout files, directories or glob patterns')
+    parser.add_argument('-m', '--manifest', help='CSV/TSV with path[, sample, completeness] columns')
+    parser.add_argument('-c','--completeness', type=completeness_float, default=1.0,
+                        help='Completeness for inputs without a manifest value (0.0–1.0). Defaults to 1.0.')
+    parser.add_argument('-o', '--output', required=True, help='Output directory')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Number of worker processes (default 1)')
+    parser.add_argument('--shard-index', type=int, default=None, metavar='I',
+                        help='Process only slice I (0-based) of the inputs and write partial tables for merge-shards')
+    parser.add_argument('--shard-count', type=int, default=None, metavar='N', help='Number of slices (with --shard-index)')
+    add_analysis_arguments(parser)
+    args = parser.parse_args(argv)
+    check_analysis_arguments(parser, args)
+    if not args.inputs and not args.manifest:
+        parser.error("give input files/directories/globs or --manifest")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error("--shard-index and --shard-count go together")
+    if args.shard_count is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    try:
+        samples = collect_batch_inputs(args.inputs, args.manifest, args.completeness)
+    except (ValueError, argparse.ArgumentTypeError) as e:
+        parser.error(str(e))
+    if args.shard_count:
+        # contiguous slices of the input order, the same on every node
+        total = len(samples)
+        samples = [samples[i] for i in np.array_split(np.arange(total), args.shard_count)[args.shard_index]]
+        print(f"Shard {args.shard_index} of {args.shard_count}: {len(samples)} of {total} sample(s)")
+    print(f"Batch of {len(samples)} sample(s) with {args.workers} worker(s)")
+
+    reference = ReferenceData.load(args.cache_dir, with_path_index=args.path_search == 'index',
+                                   use_cache=not args.no_reference_cache, module_graphs=args.module_graphs,
+                                   reference_data=args.reference_data)
+    os.makedirs(args.output, exist_ok=True)
+    jobs = [(sample, path, sigma, os.path.join(args.output, sample), args) for sample, path, sigma in samples]
+
+    results, failures = [], []
+    if args.workers == 1:
+        _init_batch_worker(reference)
+        outcomes = map(_run_batch_sample, jobs)
+        for sample, paths, dk, error in outcomes:
+            (failures.append((sample, error)) if error else results.append((sample, paths, dk)))
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_batch_worker,
+                                 initargs=(reference,)) as pool:
+            for sample, paths, dk, error in pool.map(_run_batch_sample, jobs):
+                (failures.append((sample, error)) if error else results.append((sample, paths, dk)))
+
+    if args.shard_count:
+        write_shard_partials(results, failures, args.output, args.shard_index, args.shard_count)
+        summary_path = os.path.join(args.output, f"{shard_stem(args.shard_index, args.shard_count)}_summary.csv")
+    else:
+        summary_path = os.path.join(args.output, "batch_summary.csv")
+    batch_summary(results).to_csv(summary_path)
+    print(f"Sample x module summary of {len(results)} sample(s) written to {summary_path}")
+    # workers only count their own cache writes; enforce the limit once for all of them
+    cache = result_cache(args)
+    if cache is not None:
+        cache.evict()
+    for sample, error in failures:
+        print(f"  ! {sample} failed: {error}")
+    return 1 if failures else 0
+
+"""## Sharded cohorts"""
+
+PARTIAL_DK_COLUMNS = ['KO id', 'Dk', 'Dk_Neighbors']
+PARTIAL_PATH_COLUMNS = ['module', 'path_id', 'raw_before', 'geo_before', 'raw_after', 'geo_after']
+SHARD_RE = re.compile(r"^shard-(\d+)-of-(\d+)_(dk|paths|failed)\.(parquet|pkl|csv)$")
+COHORT_MATRICES = {    # output name -> (partial table, index column, value column)
+    "ko_dk":             ("dk", "KO id", "Dk"),
+    "ko_dk_neighbors":   ("dk", "KO id", "Dk_Neighbors"),
+    "module_geo_before": ("paths", "module", "geo_before"),
+    "module_geo_after":  ("paths", "module", "geo_after"),
+}
+
+def shard_stem(index, count):
+    return f"shard-{index:05d}-of-{count:05d}"
+
+def write_partial(table, path_stem):
+    # Parquet when pyarrow is installed, else CSV; never a pickle, which runs
+    # code when merge-shards loads it from a shared folder
+    if find_spec("pyarrow") is not None:
+        table.to_parquet(f"{path_stem}.parquet", index=False)
+        return f"{path_stem}.parquet"
+    table.to_csv(f"{path_stem}.csv", index=False)
+    return f"{path_stem}.csv"
+
+def read_partial(path):
+    if path.endswith(".parquet"):
+        if find_spec("pyarrow") is None:
+            raise ValueError(f"{path} is a parquet partial; merging it needs pyarrow (pip install pyarrow)")
+        return pd.read_parquet(path)
+    # keys as strings (KO ids, module numbers like 00010), floats exactly as written
+    return pd.read_csv(path, dtype={'sample': str, 'KO id': str, 'module': str}, float_precision='round_trip')
+
+def write_shard_partials(results, failures, out_dir, index, count):
+    """Long dk (sample, KO id, Dk, Dk_Neighbors) and best-path tables of one shard.
+
+    Written even when the shard is empty, so merge-shards can tell a
+    finished shard from a missing one.
+    """
+    stem = os.path.join(out_dir, shard_stem(index, count))
+    dk_frames, path_frames = [], []
+    for sample, paths, dk in results:
+        best = paths[paths['rank'] == 1] if 'rank' in paths.columns else paths
+        path_frames.append(best[PARTIAL_PATH_COLUMNS].assign(sample=sample))
+        dk_frames.append(dk[PARTIAL_DK_COLUMNS].assign(sample=sample))
+
+    def long_table(frames, columns, key):
+        table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns + ['sample'])
+        table = table[['sample'] + columns]
+        for col in ('sample', key):
+            table[col] = table[col].astype(str).astype('category')
+        return table
+    written = [write_partial(long_table(dk_frames, PARTIAL_DK_COLUMNS, 'KO id'), f"{stem}_dk"),
+               write_partial(long_table(path_frames, PARTIAL_PATH_COLUMNS, 'module'), f"{stem}_paths")]
+    if failures:
+        pd.DataFrame(failures, columns=['sample', 'error']).to_csv(f"{stem}_failed.csv", index=False)
+    print(f"Partial tables of {len(results)} sample(s) written to {' and '.join(written)}")
+
+def merge_shards_main(argv=None):
+    parser = argparse.ArgumentParser(prog='module_detection.py merge-shards',
+                                     description='Combine the partial tables of batch --shard-index/--shard-count runs '
+                                                 'into cohort sample x KO and sample x module matrices')
+    parser.add_argument('shard_dirs', nargs='+', help='Output folders of the shard runs')
+    parser.add_argument('-o', '--output', required=True, help='Output prefix for the cohort matrices')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='Matrix file format (default csv; parquet needs pyarrow)')
+    parser.add_argument('--allow-missing', action='store_true', help='Merge even if some shards have no partials')
+    args = parser.parse_args(argv)
+    if args.format == 'parquet' and find_spec("pyarrow") is None:
+        parser.error("--format parquet needs pyarrow (pip install pyarrow)")
+
+    # 1) find the partials: shard -> table -> file
+    shards, counts = {}, set()
+    for shard_dir in args.shard_dirs:
+        for fname in sorted(os.listdir(shard_dir)):
+            match = SHARD_RE.match(fname)
+            if match and match.group(4) == "pkl":
+                parser.error(f"{os.path.join(shard_dir, fname)} is a pickle partial of an older version, which "
+                             f"merge-shards no longer loads; run that shard again")
+            if match:
+                index, count, table = int(match.group(1)), int(match.group(2)), match.group(3)
+                counts.add(count)
+                shards.setdefault(index, {})[table] = os.path.join(shard_dir, fname)
+    if not shards:
+        parser.error(f"No shard partials in {', '.join(args.shard_dirs)}")
+    if len(counts) > 1:
+        parser.error(f"Partials of different shard counts: {sorted(counts)}")
+    count = counts.pop()
+    missing = [i for i in range(count) if not {"dk", "paths"} <= set(shards.get(i, {}))]
+    if missing:
+        message = f"{len(missing)} of {count} shard(s) have no partials: {missing[:20]}"
+        if not args.allow_missing:
+            parser.error(message + " (use --allow-missing to merge the rest)")
+        print(f"Warning: {message}")
+
+    # 2) long tables of the cohort
+    tables = {"dk": [], "paths": []}
+    failed = []
+    for index in sorted(shards):
+        for table, path in shards[index].items():
+            if table == "failed":
+                failed.append(pd.read_csv(path))
+            elif index not in missing:
+                try:
+                    tables[table].append(read_partial(path))
+                except ValueError as e:
+                    parser.error(str(e))
+    long = {name: pd.concat(frames, ignore_index=True) for name, frames in tables.items()}
+    for name, table in long.items():
+        table['sample'] = table['sample'].astype(str)
+    samples = long["paths"].groupby('sample').size()
+    if long["paths"].duplicated(['sample', 'module']).any():
+        dupes = long["paths"].loc[long["paths"].duplicated(['sample', 'module']), 'sample'].unique()
+        parser.error(f"Samples found in more than one shard: {list(dupes[:20])}")
+
+    # 3) sample x KO and sample x module matrices
+    out_dir = os.path.dirname(args.output) or "."
+    os.makedirs(out_dir, exist_ok=True)
+    for name, (table, key, value) in COHORT_MATRICES.items():
+        matrix = long[table].pivot(index='sample', columns=key, values=value).sort_index().sort_index(axis=1)
+        matrix.columns = matrix.columns.astype(str)
+        path = f"{args.output}_{name}.{args.format}"
+        matrix.to_csv(path) if args.format == 'csv' else matrix.to_parquet(path)
+        print(f"{matrix.shape[0]} sample(s) x {matrix.shape[1]} {key} written to {path}")
+    if failed:
+        failed = pd.concat(failed, ignore_index=True)
+        failed.to_csv(f"{args.output}_failed.csv", index=False)
+        print(f"{len(failed)} sample(s) failed in the shard runs, listed in {args.output}_failed.csv")
+    print(f"Merged {len(shards) - len(missing)} of {count} shard(s), {len(samples)} sample(s)")
+    return 0
+
+"""## Scoring server"""
+
+SERVE_PORT = 8765
+SERVE_MAX_JOBS = 100       # finished jobs kept in memory, oldest dropped first
+SERVE_UPLOAD_MB = 4096
+SERVE_WAIT_S = 300         # longest a wait=1 request is held before answering 202
+SERVE_ORIGINS = ()         # other browser origins allowed to read results; the viewer is served at /viewer/
+SERVE_TOKEN_HEADER = "X-BLIMMP-Token"
+VIEWER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Graph_Model_Diagrams")
+
+def _init_served_worker(reference):
+    # default SIGTERM even in a worker started after serve_main installed its handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    _init_batch_worker(reference)
+
+def _run_served_sample(job):
+    path, sigma, args, digest = job
+    result = detect_sample(_WORKER_REFERENCE, path, sigma, args, digest=digest)
+    return result.modules
+
+class ScoringService:
+    """Jobs of the scoring server, scored by a process pool that holds the reference data.
+
+    A job is a domtblout path or an uploaded file; its result is the module
+    representation also written to _sample_modules_representation.json.
+    """
+
+    def __init__(self, reference, args, workers=1, upload_dir=None, max_jobs=SERVE_MAX_JOBS):
+        self.reference = reference
+        self.args = args
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.upload_dir = tempfile.mkdtemp(prefix="blimmp_uploads_", dir=upload_dir)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # the pool forks its workers on the first submit: do that here, before
+        # any server thread exists, so they inherit the reference data and no
+        # other thread's locks
+        self.pool = self.start_pool()
+
+    def start_pool(self):
+        pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_served_worker,
+                                   initargs=(self.reference,))
+        pool.submit(int).result()
+        return pool
+
+    def restart_pool(self, broken):
+        # a worker died (e.g. killed when out of memory) and the pool refuses
+        # all work; replace it once, whichever thread notices first
+        with self.lock:
+            if self.pool is not broken:
+                return
+            print("A scoring worker died; restarting the process pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.pool = self.start_pool()
+
+    def submit(self, path, sigma, sample=None, upload=False, digest=None):
+        job_id = uuid.uuid4().hex[:12]
+        job = {"job": job_id, "sample": sample or sample_name(path), "completeness": sigma,
+               "status": "queued", "submitted": time.time(), "error": None, "modules": None,
+               "path": None if upload else os.path.abspath(path), "_done": threading.Event()}
+        with self.lock:
+            self.jobs[job_id] = job
+        for attempt in (1, 2):
+            pool = self.pool
+            try:
+                future = pool.submit(_run_served_sample, (path, sigma, self.args, digest))
+                break
+            except BrokenProcessPool:
+                if attempt == 2:
+                    with self.lock:
+                        job.update(status="failed", error="Scoring workers unavailable", finished=time.time())
+                    raise
+                self.restart_pool(pool)
+        job["_future"] = future
+        future.add_done_callback(lambda f: self._finish(job, f, path if upload else None, pool))
+        return job_id
+
+    def _finish(self, job, future, upload, pool):
+        with self.lock:
+            try:
+                job["modules"] = future.result()
+                job["status"] = "done"
+            except BrokenProcessPool:
+                job["error"] = "The scoring worker died (out of memory?); submit the job again"
+                job["status"] = "failed"
+                # not in this callback: it runs on the broken pool's own thread
+                threading.Thread(target=self.restart_pool, args=(pool,), daemon=True).start()
+            except Exception as e:
+                job["error"] = f"{type(e).__name__}: {e}"
+                job["status"] = "failed"
+            job["finished"] = time.time()
+            job["_done"].set()
+            done = [j for j in self.jobs.values() if j["status"] in ("done", "failed")]
+            for old in sorted(done, key=lambda j: j["finished"])[:max(0, len(done) - self.max_jobs)]:
+                del self.jobs[old["job"]]
+        if upload:
+            try:
+                os.remove(upload)
+            except OSError:
+                pass
+        print(f"Job {job['job']} ({job['sample']}) {job['status']}" + (f": {job['error']}" if job["error"] else ""))
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def delete(self, job_id):
+        with self.lock:
+            return self.jobs.pop(job_id, None) is not None
+
+    def describe(self, job, best_paths=False):
+        info = {k: v for k, v in job.items() if k != "modules" and not k.startswith("_")}
+        future = job.get("_future")    # not yet set while submit hands the job to the pool
+        if info["status"] == "queued" and future is not None and future.running():
+            info["status"] = "running"
+        if best_paths and job["modules"] is not None:
+            info["best_paths"] = {m: entry["best_path"] for m, entry in job["modules"].items()}
+        return info
+
+    def status(self):
+        with self.lock:
+            counts = pd.Series([j["status"] for j in self.jobs.values()], dtype=object).value_counts()
+        return {"modules": len(as_module_store(self.reference.modules).modules("nodes")),
+                "workers": self.workers, "jobs": {k: int(v) for k, v in counts.items()}}
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """JSON API of the scoring server.
+
+    Every request but the viewer files needs the token printed by serve,
+    as an X-BLIMMP-Token header or a token= parameter.
+
+        GET    /viewer/<file>               the viewer (Graph_Model_Diagrams), same origin
+        GET    /status                      reference and job counts
+        POST   /jobs?completeness=&sample=  body: domtblout (plain or gzip), or
+                                            JSON {"path", "completeness", "sample"}
+                                            (not from browsers); add wait=1 to
+                                            answer when scored (202 after
+                                            SERVE_WAIT_S)
+        GET    /jobs                        all jobs
+        GET    /jobs/<id>                   job status and best path per module
+        GET    /jobs/<id>/modules           full module representation
+        GET    /jobs/<id>/modules/<module>  one module: nodes, best_path
+        DELETE /jobs/<id>
+    """
+    service = None
+    max_upload = SERVE_UPLOAD_MB * 2**20
+    max_wait = SERVE_WAIT_S
+    allow_origins = SERVE_ORIGINS
+    token = None
+    viewer_dir = VIEWER_DIR
+
+    def log_message(self, fmt, *args):
+        message = fmt % args
+        if self.token:
+            message = message.replace(self.token, "<token>")
+        print(f"{self.address_string()} {message}")
+
+    def send_json(self, obj, code=200):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, code, message):
+        self.send_json({"error": message}, code)
+
+    def send_cors_headers(self):
+        # only the viewer's origins may read responses in a browser; other
+        # web pages get no CORS headers and the browser withholds the answer
+        origin = self.headers.get("Origin")
+        if origin is None or (origin not in self.allow_origins and "*" not in self.allow_origins):
+            return
+        self.send_header("Access-Control-Allow-Origin", origin)
+        self.send_header("Vary", "Origin")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", f"Content-Type, {SERVE_TOKEN_HEADER}")
+
+    def route(self):
+        url = urlsplit(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        return parts, query
+
+    def authorized(self):
+        # other web pages and local programs do not know the token; a wrong
+        # or missing one gets 401 on every endpoint
+        if self.token is None:
+            return True
+        _, query = self.route()
+        given = self.headers.get(SERVE_TOKEN_HEADER) or query.get("token") or ""
+        if hmac.compare_digest(given.encode(), self.token.encode()):
+            return True
+        self.send_error_json(401, f"Missing or wrong token; send the one printed by serve as {SERVE_TOKEN_HEADER}")
+        return False
+
+    def send_viewer_file(self, parts):
+        # static viewer files: no sample data, so no token needed
+        name = parts[0] if len(parts) == 1 else "module.html" if not parts else None
+        try:
+            files = os.listdir(self.viewer_dir)
+        except OSError:
+            files = []
+        if name is None or name.startswith(".") or name not in files:
+            return self.send_error_json(404, f"No such viewer file: {self.path}")
+        with open(os.path.join(self.viewer_dir, name), "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.end_headers()
+
+    def do_GET(self):
+        parts, _ = self.route()
+        if parts[:1] == ["viewer"]:
+            return self.send_viewer_file(parts[1:])
+        if not self.authorized():
+            return
+        service = self.service
+        if parts in ([], ["status"]):
+            return self.send_json(service.status())
+        if parts == ["jobs"]:
+            with service.lock:
+                jobs = list(service.jobs.values())
+            return self.send_json([service.describe(j) for j in jobs])
+        if len(parts) < 2 or parts[0] != "jobs" or len(parts) > 4 or (len(parts) > 2 and parts[2] != "modules"):
+            return self.send_error_json(404, f"No such endpoint: {self.path}")
+        job = service.get(parts[1])
+        if job is None:
+            return self.send_error_json(404, f"No job {parts[1]}")
+        if len(parts) == 2:
+            return self.send_json(service.describe(job, best_paths=True))
+        if job["status"] != "done":
+            return self.send_json(service.describe(job), 409 if job["status"] == "failed" else 202)
+        if len(parts) == 3:
+            return self.send_json(job["modules"])
+        module = job["modules"].get(parts[3])
+        if module is None:
+            return self.send_error_json(404, f"No module {parts[3]}")
+        return self.send_json(module)
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+        parts, _ = self.route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self.send_error_json(404, f"No such endpoint: {self.path}")
+        if not self.service.delete(parts[1]):
+            return self.send_error_json(404, f"No job {parts[1]}")
+        return self.send_json({"deleted": parts[1]})
+
+    def receive_upload(self, length):
+        # stream the body to disk, hashing it on the way (the result cache key
+        # of the upload); gzip uploads keep a .gz suffix for the reader
+        head = self.rfile.read(min(length, 2))
+        suffix = ".domtblout.gz" if head == b"\x1f\x8b" else ".domtblout"
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.service.upload_dir)
+        h = hashlib.sha256(head)
+        with os.fdopen(fd, "wb") as f:
+            f.write(head)
+            remaining = length - len(head)
+            while remaining > 0:
+                block = self.rfile.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                f.write(block)
+                h.update(block)
+                remaining -= len(block)
+        if remaining > 0:
+            os.remove(path)
+            raise ValueError("Upload ended early")
+        return path, h.hexdigest()
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        parts, query = self.route()
+        if parts != ["jobs"]:
+            return self.send_error_json(404, f"No such endpoint: {self.path}")
+        length = int(self.headers.get("Content-Length") or 0)
+        if length <= 0:
+            return self.send_error_json(411, "Send a domtblout body or JSON with a path")
+        if length > self.max_upload:
+            return self.send_error_json(413, f"Upload larger than {self.max_upload // 2**20} MB")
+
+        upload = not self.headers.get("Content-Type", "").startswith("application/json")
+        if not upload and self.headers.get("Origin") is not None:
+            # a web page must never make the server read local files
+            return self.send_error_json(403, "Jobs by path are not accepted from browsers; upload the file")
+        digest = None
+        try:
+            if not upload:
+                query = {**query, **json.loads(self.rfile.read(length))}
+                path = query.get("path")
+                if not isinstance(path, str) or not os.path.isfile(path):
+                    raise ValueError(f"No input file {path}")
+            sigma = completeness_float(query.get("completeness", 1.0))
+            if upload:
+                path, digest = self.receive_upload(length)
+        except (ValueError, argparse.ArgumentTypeError) as e:
+            return self.send_error_json(400, str(e))
+        sample = query.get("sample") or (None if not upload else "upload")
+        try:
+            job_id = self.service.submit(path, sigma, sample, upload=upload, digest=digest)
+        except BrokenProcessPool:
+            if upload:
+                os.remove(path)
+            return self.send_error_json(503, "Scoring workers are unavailable; try again")
+
+        job = self.service.get(job_id)
+        if query.get("wait") in ("1", "true", True) and job["_done"].wait(self.max_wait):
+            # set by the done callback once the result is stored
+            return self.send_json(self.service.describe(job, best_paths=True), 200 if job["status"] == "done" else 500)
+        return self.send_json(self.service.describe(job), 202)
+
+def serve_main(argv=None):
+    parser = argparse.ArgumentParser(prog='module_detection.py serve',
+                                     description='Score domtblout files over HTTP with the reference data kept in memory')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=SERVE_PORT, help=f'Port (default {SERVE_PORT})')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='Number of scoring processes (default 1)')
+    parser.add_argument('--max-jobs', type=int, default=SERVE_MAX_JOBS,
+                        help=f'Finished jobs kept in memory (default {SERVE_MAX_JOBS})')
+    parser.add_argument('--max-upload-mb', type=int, default=SERVE_UPLOAD_MB,
+                        help=f'Largest accepted upload (default {SERVE_UPLOAD_MB} MB)')
+    parser.add_argument('--allow-origin', action='append', default=None, metavar='ORIGIN',
+                        help='Browser origin besides the server itself allowed to read results, e.g. '
+                             'http://localhost:8000 for a viewer hosted elsewhere; repeatable')
+    parser.add_argument('--token', default=None,
+                        help=f'Token every request must carry, as {SERVE_TOKEN_HEADER} header or token= parameter '
+                             '(default: a random one, printed at start)')
+    add_analysis_arguments(parser)
+    args = parser.parse_args(argv)
+    check_analysis_arguments(parser, args)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    reference = ReferenceData.load(args.cache_dir, with_path_index=args.path_search == 'index',
+                                   use_cache=not args.no_reference_cache, module_graphs=args.module_graphs,
+                                   reference_data=args.reference_data)
+    token = args.token or secrets.token_urlsafe(16)
+    service = ScoringService(reference, args, args.workers, args.tmp_dir, args.max_jobs)
+    handler = type("Handler", (ScoringRequestHandler,), {"service": service,
+                                                         "max_upload": args.max_upload_mb * 2**20,
+                                                         "allow_origins": SERVE_ORIGINS + tuple(args.allow_origin or ()),
+                                                         "token": token})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    # stop cleanly on SIGTERM too; shutdown() must come from another thread
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    url = f"http://{args.host}:{server.server_port}"
+    print(f"Serving on {url} with {args.workers} worker(s); token {token}")
+    print(f"Open {url}/viewer/module.html?server={url}&token={token}&job=<job id>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'batch':
+        return batch_main(argv[1:])
+    if argv and argv[0] == 'cache':
+        return cache_main(argv[1:])
+    if argv and argv[0] == 'serve':
+        return serve_main(argv[1:])
+    if argv and argv[0] == 'merge-shards':
+        return merge_shards_main(argv[1:])
+
     parser = argparse.ArgumentParser(description='Process BATH/HMMER output (tbl or domtblout)')
     #parser.add_argument('file', help='Path to the .tblout or .domtblout file')
     parser.add_argument('file',type=existing_nonempty_tbl,help='Path to the .tblout or .domtblout file (must exist, be non-empty, and have correct extension)')
@@ -454,7 +3270,9 @@ def main():
     parser.add_argument('-c','--completeness', type=completeness_float,default=1.0,help='Completeness of sample obtained via CHECKM or BUSCO (0.0–1.0). Defaults to 1.0.')
     parser.add_argument('-o', '--output', required=True,
                         help='Output prefix or directory for CSV reports')
-    args = parser.parse_args()
+    add_analysis_arguments(parser)
+    args = parser.parse_args(argv)
+    check_analysis_arguments(parser, args)
 
     sample = os.path.basename(args.file).split('.')[0]
     sigma = args.completeness
@@ -462,51 +3280,9 @@ def main():
         parser.error(f"--sigma must be between 0 and 1, but you passed {sigma}")
     print(f"Processing sample {sample} with sigma={sigma}")
 
-    #"KEGG_Graphs_Generated"
-    #Check if module files unzipped
-    HERE = os.path.dirname(__file__)
-    GD = os.path.join(HERE, "Graph_Dependencies")
-    MODULE_PARENT_DIR = os.path.join(GD, "KEGG_Graphs_Generated")
-
-    # 1) Ensure the target folder exists
-    os.makedirs(MODULE_PARENT_DIR, exist_ok=True)
-
-    # 2) Recursively locate any .zip files under Graph_Dependencies
-    zip_paths = []
-    for root, _, files in os.walk(GD):
-        for fname in files:
-            if fname.lower().endswith('.zip'):
-                zip_paths.append(os.path.join(root, fname))
-
-    # 3) Extract them into MODULE_PARENT_DIR and delete zips
-    if zip_paths:
-        print(f"Found {len(zip_paths)} zip file(s) under {GD}, extracting to {MODULE_PARENT_DIR}…")
-        for zp in zip_paths:
-            try:
-                with zipfile.ZipFile(zp, 'r') as archive:
-                    archive.extractall(MODULE_PARENT_DIR)
-                rel = os.path.relpath(zp, GD)
-                print(f"  • Extracted {rel}")
-                # Delete the original zip
-                os.remove(zp)
-                print(f"  • Deleted zip: {rel}")
-            except zipfile.BadZipFile:
-                print(f"  ! Skipped invalid zip: {os.path.basename(zp)}")
-    else:
-        print(f"No zip files found under {GD}")
-
-    UNZIP_SUBDIR = os.path.join(MODULE_PARENT_DIR, "KEGG_Module_Graphs")
-    node_count = len(glob.glob(os.path.join(UNZIP_SUBDIR, "module_*_nodes.json")))
-    path_count = len(glob.glob(os.path.join(UNZIP_SUBDIR, "module_*_paths.json")))
-    print(f"Module JSON discovery in {UNZIP_SUBDIR}: {node_count} node files, {path_count} path files")
-
-    MODULE_JSON_DIR = os.path.join(HERE, "Graph_Dependencies", "KEGG_Graphs_Generated/KEGG_Module_Graphs/")
-
-    ko_to_modules_str=modules_to_kos(MODULE_JSON_DIR)
-    ko_occ_path     = os.path.join(HERE, "Data_Dependencies", "ko_occurrences.txt")
-    ko_occ = read_ko_occurence_txt(ko_occ_path)
-    adj_path   = os.path.join(HERE, "Data_Dependencies", "ko_neighbors.txt")
-    adj = make_neighbor_dictionary(adj_path)
+    reference = ReferenceData.load(args.cache_dir, with_path_index=args.path_search == 'index',
+                                   use_cache=not args.no_reference_cache, module_graphs=args.module_graphs,
+                                   reference_data=args.reference_data)
 
     # Parse input
     if args.format == 'tbl':
@@ -552,54 +3328,7 @@ def main():
         # print(f"Diagram reports written to {out_pref}_nodes_enriched.csv")
         # print(f"Open HTML file index.html in a local browser. Upload {out_pref}_nodes_enriched.json when prompted.")
     else:
-        hmm_hits = process_domtblout(args.file)
-        hmm_groups = assign_overlap_groups(hmm_hits)
-        hmm_groups = hmm_groups.drop(columns=["grp_id"])
-        hmm_hits_1 = calculate_hit_confidence_log(hmm_groups.reset_index(), e_threshold=1e-5)
-        print("Number of rows after hit confidence calculation: ",len(hmm_hits_1))
-        hmm_hits_1 = hmm_hits_1.sort_values('score', ascending=False)
-        hmm_hits_1 = hmm_hits_1.drop_duplicates(subset='KO id', keep='first')
-        print("Number of rows after duplicates dropped: ",len(hmm_hits_1))
-        all_kos_hmm = sorted(ko_to_modules_str.keys())
-        df_master_hmm = pd.DataFrame({'KO id': all_kos_hmm})
-
-        hmm_hits_all_kos = (df_master_hmm.merge(hmm_hits_1, on='KO id', how='left'))
-        hmm_hits_all_kos['hit_conf'] = hmm_hits_all_kos['hit_conf'].fillna(0)
-        print("Number of rows after adding all available KO information: ",len(hmm_hits_all_kos))
-
-        hmm_df_dk = calculate_dk_per_ko(ko_occ, hmm_hits_all_kos, sigma)
-        hmm_dk_dict = dict(zip(hmm_df_dk['KO id'], hmm_df_dk['Dk']))
-        hmm_dk_spring_all = spring_update_probabilities(hmm_dk_dict, adj, alpha=0.6)
-        hmm_df_dk_new = hmm_df_dk.merge(hmm_dk_spring_all, on="KO id", how="left")
-
-        hmm_df_dk_new["Modules"] = hmm_df_dk_new["KO id"].map(ko_to_modules_str)
-        hmm_df_dk_new = hmm_df_dk_new.dropna(subset=['Modules'])
-        series = hmm_df_dk_new.set_index("KO id")["Dk_Neighbors"]
-        new_dk_dict = series.to_dict()
-
-        hmm_df_dk_new[['adjacency_list','adjacency_weight_list','neighbor_Dk_list']] = (hmm_df_dk_new['KO id'].apply(lambda k: pd.Series(format_adjacency(k, adj, new_dk_dict),index=['adjacency_list','adjacency_weight_list','neighbor_Dk_list'])))    
-
-
-        hmm_paths = path_probabilities(MODULE_JSON_DIR, hmm_dk_dict, new_dk_dict)
-
-        out_pref = args.output
-        out_dir = os.path.dirname(out_pref) or "."
-        os.makedirs(out_dir, exist_ok=True)
-        hmm_df_dk_new.to_csv(f"{out_pref}_dk.csv", index=False)
-        hmm_paths.to_csv(f"{out_pref}_paths.csv", index=False)
-        print(f"Reports written to {out_pref}_dk.csv and {out_pref}_paths.csv")
-        export_module_data_with_best_path(
-        module_json_dir=MODULE_JSON_DIR,
-        ko_occ_df=ko_occ,
-        dk_before=hmm_dk_dict,
-        evalue=dict(zip(hmm_hits_all_kos['KO id'], hmm_hits_all_kos['E-value'].replace(np.nan,100.0))),
-        dk_after=new_dk_dict,
-        df_best_paths=hmm_paths,
-        output_path=f"{out_pref}_sample_modules_representation.json"
-        )
-            
-        print(f"Diagram reports written to {out_pref}_nodes_enriched.csv")
-        print(f"Open HTML file index.html in a local browser. Upload {out_pref}_nodes_enriched.json when prompted.")
+        run_sample(reference, args.file, sigma, args.output, args)
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
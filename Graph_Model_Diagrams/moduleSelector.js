@@ -31,6 +31,43 @@ async function fetchJSON(url) {
   return resp.json();
 }
 
+// Sample data from a running scoring server (module_detection.py serve):
+// index.html?server=http://127.0.0.1:8765&token=<token>&job=<id>&module=M00001
+const pageParams = new URLSearchParams(window.location.search);
+const serverURL  = pageParams.get('server')?.replace(/\/+$/, '');
+const serverJob  = pageParams.get('job');
+const serverToken = pageParams.get('token');
+// Per-module gzip shards written with --module-shards, served over http(s):
+// index.html?shards=https://host/sample_modules&module=M00001
+const shardsURL  = pageParams.get('shards')?.replace(/\/+$/, '');
+
+// Sample JSON may carry NaN/Infinity, which JSON.parse rejects
+function parseSampleJSON(rawText) {
+  return JSON.parse(rawText.replace(/\bNaN\b/g, "null").replace(/\bInfinity\b/g, "null"));
+}
+
+// Fetch one module of the server job
+async function fetchServerModule(moduleId) {
+  const resp = await fetch(`${serverURL}/jobs/${encodeURIComponent(serverJob)}/modules/${encodeURIComponent(moduleId)}`,
+                           { headers: serverToken ? { 'X-BLIMMP-Token': serverToken } : {} });
+  if (resp.status === 202) throw new Error(`Job ${serverJob} is still running`);
+  if (!resp.ok) throw new Error(`Error fetching ${moduleId} from ${serverURL}: ${resp.statusText}`);
+  return parseSampleJSON(await resp.text());
+}
+
+// Fetch and unzip the shard of one module
+async function fetchModuleShard(moduleId) {
+  const resp = await fetch(`${shardsURL}/${encodeURIComponent(moduleId)}.json.gz`);
+  if (!resp.ok) throw new Error(`Error fetching ${moduleId} from ${shardsURL}: ${resp.statusText}`);
+  let bytes = new Uint8Array(await resp.arrayBuffer());
+  // servers sending Content-Encoding: gzip have already unzipped it
+  if (bytes[0] === 0x1f && bytes[1] === 0x8b) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip"));
+    bytes = new Uint8Array(await new Response(stream).arrayBuffer());
+  }
+  return parseSampleJSON(new TextDecoder().decode(bytes));
+}
+
 let moduleDataCache = null;
 async function loadAllModules() {
   if (!moduleDataCache) {
@@ -90,6 +127,14 @@ window.addEventListener("DOMContentLoaded", () => {
     localStorage.setItem('moduleThreshold', threshold);
     // fetch modules
     const { nodesData: allNodesData, adjData: allAdjData } = await loadAllModules();
+    const fetchModule = (serverURL && serverJob) ? fetchServerModule : (shardsURL ? fetchModuleShard : null);
+    if (fetchModule) {
+      try {
+        uploadedNodesData = { ...uploadedNodesData, [moduleId]: await fetchModule(moduleId) };
+      } catch (err) {
+        return alert(err.message);
+      }
+    }
     let moduleNodes = (uploadedNodesData?.[moduleId]?.nodes) || allNodesData[moduleId]?.nodes;
     if (!Array.isArray(moduleNodes)) moduleNodes = allNodesData[moduleId]?.nodes;
     if (!moduleNodes) return alert(`Module ${moduleId} not found`);
@@ -104,8 +149,7 @@ window.addEventListener("DOMContentLoaded", () => {
   });
 
   // Auto-search if URL has module param
-  const params = new URLSearchParams(window.location.search);
-  const m = params.get('module');
+  const m = pageParams.get('module');
   if (m) {
     moduleInput.value = m;
     // trigger upload and threshold if stored, then click
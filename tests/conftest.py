@@ -0,0 +1,53 @@
+"""Shared fixtures: a small synthetic reference and sample, built once per session.
+
+Module graphs and domtblout files come from the generators in
+benchmarks.py; KO occurrences and neighbors are the shipped
+Data_Dependencies tables.
+"""
+import os, sys
+import pytest
+
+SCRIPTS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "BLIMMP_Scripts")
+DATA_DIR = os.path.join(SCRIPTS, "Data_Dependencies")
+sys.path.insert(0, SCRIPTS)
+
+import module_detection as md
+import benchmarks
+
+
+@pytest.fixture(scope="session")
+def cache_dir(tmp_path_factory):
+    # keep compiled reference data and cached results out of ~/.cache
+    path = str(tmp_path_factory.mktemp("cache"))
+    old = os.environ.get("BLIMMP_CACHE_DIR")
+    os.environ["BLIMMP_CACHE_DIR"] = path
+    yield path
+    if old is None:
+        os.environ.pop("BLIMMP_CACHE_DIR", None)
+    else:
+        os.environ["BLIMMP_CACHE_DIR"] = old
+
+
+@pytest.fixture(scope="session")
+def module_graphs(tmp_path_factory):
+    return benchmarks.make_module_graphs(str(tmp_path_factory.mktemp("graphs")), n_modules=40, max_paths=200)
+
+
+@pytest.fixture(scope="session")
+def reference(cache_dir, module_graphs):
+    return md.ReferenceData.load(cache_dir, module_graphs=module_graphs, reference_data=DATA_DIR)
+
+
+@pytest.fixture(scope="session")
+def domtblout(tmp_path_factory):
+    return benchmarks.make_domtblout(str(tmp_path_factory.mktemp("sample") / "sample.domtblout"), 4000, seed=3)
+
+
+@pytest.fixture
+def options(cache_dir, module_graphs):
+    # analysis options of a plain command line run on the synthetic reference
+    def make(**overrides):
+        overrides = {"cache_dir": cache_dir, "module_graphs": module_graphs, "reference_data": DATA_DIR,
+                     "no_result_cache": True, **overrides}
+        return md.analysis_options(**overrides)
+    return make
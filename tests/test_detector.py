@@ -0,0 +1,71 @@
+import filecmp
+import pandas as pd
+import pytest
+
+from conftest import DATA_DIR, md
+
+OUTPUTS = ("_dk.csv", "_paths.csv", "_sample_modules_representation.json")
+
+
+def parsed_hits(path):
+    # the hit table of a domtblout as plain (not categorical) columns
+    hits = md.process_domtblout(path)
+    return hits.astype({'target name': str, 'KO id': str}).reset_index(drop=True)
+
+
+def assert_same_result(a, b, ignore=()):
+    pd.testing.assert_frame_equal(a.dk.drop(columns=list(ignore)).reset_index(drop=True),
+                                  b.dk.drop(columns=list(ignore)).reset_index(drop=True))
+    pd.testing.assert_frame_equal(a.paths.reset_index(drop=True), b.paths.reset_index(drop=True))
+    assert a.modules == b.modules
+
+
+def test_command_line_run_matches_detect(tmp_path, reference, domtblout, cache_dir, module_graphs):
+    md.main([domtblout, "-f", "domtblout", "-c", "0.8", "-o", str(tmp_path / "cli" / "s"),
+             "--cache-dir", cache_dir, "--module-graphs", module_graphs, "--reference-data", DATA_DIR,
+             "--no-result-cache"])
+    detector = md.ModuleDetector(reference, cache_dir=cache_dir, no_result_cache=True)
+    detector.detect(domtblout, completeness=0.8).write(str(tmp_path / "api" / "s"))
+    for suffix in OUTPUTS:
+        assert filecmp.cmp(tmp_path / "cli" / f"s{suffix}", tmp_path / "api" / f"s{suffix}", shallow=False)
+
+
+def test_dataframe_input_matches_the_file(reference, domtblout, cache_dir):
+    detector = md.ModuleDetector(reference, cache_dir=cache_dir, no_result_cache=True)
+    hits = parsed_hits(domtblout)
+    named = hits.set_index(pd.Index(range(len(hits)), name="hit").astype(str))
+    from_file = detector.detect(domtblout, 0.8)
+    # 'index' is the hit's row: its data line in the file, its position in a table
+    assert_same_result(from_file, detector.detect(hits, 0.8), ignore=['index'])
+    assert_same_result(detector.detect(hits, 0.8), detector.detect(named, 0.8))
+
+
+def test_zero_length_hits_in_a_dataframe_are_dropped(reference, cache_dir):
+    kos = list(reference.ko_to_modules)[:3]
+    hits = pd.DataFrame({
+        'target name': ["contig_1"] * 4,
+        'KO id': [kos[0], kos[1], kos[2], kos[2]],
+        'E-value': [1e-30, 1e-20, 1e-10, 1e-25],
+        'score': [90.0, 60.0, 30.0, 70.0],
+        'hmm from': [1, 1, 5, 5],
+        'hmm to': [100, 90, 5, 60],       # third hit: zero-length HMM alignment
+        'ali from': [100, 150, 300, 200],
+        'ali to': [400, 420, 600, 200],   # fourth hit: zero-length alignment inside the first
+    })
+    detector = md.ModuleDetector(reference, cache_dir=cache_dir, no_result_cache=True)
+    result = detector.detect(hits, 1.0)
+    assert_same_result(result, detector.detect(hits.iloc[:2], 1.0))
+    assert kos[2] not in set(result.ko_hits.dropna(subset=['target name'])['KO id'])
+
+
+def test_sweep_overlap_groups_matches_cluster_strand(domtblout):
+    hits = md.process_domtblout(domtblout)
+    sweep = md.assign_overlap_groups(hits)
+    loop = md.assign_overlap_groups(hits, engine="iterrows")
+    pd.testing.assert_series_equal(sweep['grp_id'], loop['grp_id'], check_dtype=False)
+    pd.testing.assert_series_equal(sweep['overlap_group'], loop['overlap_group'])
+
+
+def test_unknown_options_are_rejected():
+    with pytest.raises(TypeError):
+        md.ModuleDetector(reference=object(), top_pahts=3)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR, md
+
+
+def spring_update_dicts(dk_dict, adjacency, alpha=0.6):
+    # the original per-KO loop over the nested neighbor dict
+    new_dk = {}
+    for i, p_i in dk_dict.items():
+        nbrs = adjacency.get(i, {})
+        if not nbrs:
+            new_dk[i] = p_i; continue
+        sum_e = sum(nbrs.values())
+        X = alpha ** (1.0 / sum_e)
+        shift = sum((1.0 - p_i) * (w / sum_e) * X * dk_dict.get(j, 0.0) for j, w in nbrs.items())
+        new_dk[i] = min(p_i + shift, 1.0)
+    return new_dk
+
+
+@pytest.fixture(scope="module")
+def adjacency():
+    return md.make_neighbor_dictionary(f"{DATA_DIR}/ko_neighbors.txt")
+
+
+def test_csr_matrix_matches_the_neighbor_dict(adjacency):
+    nm = md.NeighborMatrix.from_adjacency(adjacency)
+    for ko in list(adjacency)[:200]:
+        i = nm.index[ko]
+        row = nm.indices[nm.indptr[i]:nm.indptr[i + 1]]
+        assert dict(zip(nm.ko_ids[row], nm.weights[nm.indptr[i]:nm.indptr[i + 1]])) == adjacency[ko]
+
+
+def test_one_step_matches_the_dict_update(adjacency):
+    rng = np.random.default_rng(0)
+    kos = list(adjacency)[::3]
+    dk = dict(zip(kos, rng.random(len(kos))))
+    expected = spring_update_dicts(dk, adjacency)
+    got = md.spring_update_probabilities(dk, md.NeighborMatrix.from_adjacency(adjacency))
+    got = dict(zip(got['KO id'], got['Dk_Neighbors']))
+    assert got.keys() == expected.keys()
+    np.testing.assert_allclose([got[k] for k in kos], [expected[k] for k in kos], rtol=1e-12)
+
+
+def test_dict_and_matrix_inputs_agree(adjacency):
+    kos = list(adjacency)[:500]
+    dk = {ko: 0.5 for ko in kos}
+    a = md.spring_update_probabilities(dk, adjacency, iterations=3)
+    b = md.spring_update_probabilities(dk, md.NeighborMatrix.from_adjacency(adjacency), iterations=3)
+    np.testing.assert_array_equal(a['Dk_Neighbors'].to_numpy(), b['Dk_Neighbors'].to_numpy())
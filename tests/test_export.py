@@ -0,0 +1,64 @@
+import glob, gzip, json, os
+import pytest
+
+from conftest import md
+
+
+def aggregated_modules(module_json_dir, ko_occ_df, dk_before, evalue, dk_after, df_best_paths):
+    # the dict the original export_module_data_with_best_path dumped
+    ko_freq = ko_occ_df.set_index('KO id')['KO_freq'].to_dict()
+    raw_map = df_best_paths.set_index('module')[
+        ['path_id', 'path_str', 'raw_before', 'geo_before', 'raw_after', 'geo_after']].to_dict(orient='index')
+    best_path_map = {m: {'path_id': int(bp['path_id']), 'path_str': bp['path_str'],
+                         **{k: float(bp[k]) for k in ('raw_before', 'geo_before', 'raw_after', 'geo_after')}}
+                     for m, bp in raw_map.items()}
+    aggregated = {}
+    for node_file in glob.glob(os.path.join(module_json_dir, "module_*_nodes.json")):
+        module_id = os.path.basename(node_file).split("_")[1]
+        with open(node_file) as f:
+            nodes_dict = json.load(f)
+        nodes_list = []
+        for node, group in nodes_dict.items():
+            ko = node.split("_")[0]
+            nodes_list.append({
+                "id": node,
+                "group": int(group),
+                "KO_Occurrence": float(ko_freq.get(ko, 0.0)),
+                "Dk_before": float(dk_before.get(ko, 0.0)),
+                "E-value": float(evalue.get(ko, 100.0)),
+                "Dk_after": float(dk_after.get(ko, 0.0)),
+            })
+        nodes_list.sort(key=lambda x: x["group"])
+        aggregated[module_id] = {"nodes": nodes_list, "best_path": best_path_map.get(module_id)}
+    return aggregated
+
+
+@pytest.fixture(scope="module")
+def result(reference, domtblout, cache_dir):
+    return md.detect_sample(reference, domtblout, 0.8, md.analysis_options(cache_dir=cache_dir, no_result_cache=True))
+
+
+def test_module_representation_matches_the_original_export(result, reference, module_graphs):
+    dk = result.dk
+    expected = aggregated_modules(
+        module_graphs, reference.ko_occ, dict(zip(dk['KO id'], dk['Dk'])),
+        dict(zip(result.ko_hits['KO id'], result.ko_hits['E-value'].fillna(100.0))),
+        dict(zip(dk['KO id'], dk['Dk_Neighbors'])), result.paths)
+    assert result.modules == expected
+
+
+def test_streamed_json_and_shards_hold_the_same_modules(result, tmp_path):
+    result.write(str(tmp_path / "one" / "s"))
+    result.write(str(tmp_path / "sharded" / "s"), shards=True)
+    with open(tmp_path / "one" / "s_sample_modules_representation.json") as f:
+        single = json.load(f)
+    assert single == json.loads(json.dumps(result.modules))
+
+    shard_dir = tmp_path / "sharded" / "s_modules"
+    with open(shard_dir / "index.json") as f:
+        index = json.load(f)
+    assert index.keys() == single.keys()
+    for module_id, entry in index.items():
+        assert entry["best_path"] == single[module_id]["best_path"]
+        with gzip.open(shard_dir / entry["file"], "rt") as f:
+            assert json.load(f) == single[module_id]
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import md
+
+
+@pytest.fixture(scope="module")
+def module_kos(module_graphs):
+    return sorted(md.modules_to_kos(module_graphs))
+
+
+def dk_maps(kos, seed, ones=0.0):
+    # random Dk before/after; a fraction of KOs at exactly 1.0 makes many paths tie
+    rng = np.random.default_rng(seed)
+    before = dict(zip(kos, rng.random(len(kos))))
+    after = dict(zip(kos, np.where(rng.random(len(kos)) < ones, 1.0, rng.random(len(kos)))))
+    return before, after
+
+
+def assert_same_best_paths(got, expected):
+    got = got.set_index('module').loc[expected['module']].reset_index()
+    assert got['path_id'].tolist() == expected['path_id'].tolist()
+    assert got['path_str'].tolist() == expected['path_str'].tolist()
+    for col in ('geo_before', 'geo_after'):
+        np.testing.assert_allclose(got[col].astype(float), expected[col].astype(float), rtol=1e-9)
+
+
+@pytest.mark.parametrize("seed,ones", [(0, 0.0), (1, 0.5), (2, 0.9), (3, 1.0)])
+def test_path_index_matches_enumeration(module_graphs, reference, module_kos, seed, ones):
+    before, after = dk_maps(module_kos, seed, ones)
+    expected = md.path_probabilities(module_graphs, before, after)
+    assert_same_best_paths(md.indexed_path_probabilities(reference.path_index, before, after), expected)
+
+
+@pytest.mark.parametrize("seed,ones", [(0, 0.0), (1, 0.5), (2, 0.9), (3, 1.0)])
+def test_dp_matches_enumeration_including_ties(module_graphs, module_kos, cache_dir, seed, ones):
+    before, after = dk_maps(module_kos, seed, ones)
+    expected = md.path_probabilities(module_graphs, before, after)
+    graphs = md.load_module_graphs(module_graphs, cache_dir)
+    assert_same_best_paths(md.dp_path_probabilities(graphs, before, after), expected)
+
+
+def test_dp_tie_goes_to_the_path_listed_first():
+    # two equally good paths; the file lists the lower branch first
+    edges = {"start_0": ["K1_1", "K2_1"], "K1_1": ["end_0"], "K2_1": ["end_0"], "end_0": []}
+    listed = {"start_0 -> K2_1 -> end_0": (0, 7), "start_0 -> K1_1 -> end_0": (1, 3)}
+    dk = {"K1": 0.5, "K2": 0.5}
+    assert md.best_path_dp(edges, ["start_0"], ["end_0"], dk, listed=listed) == ["start_0", "K2_1", "end_0"]
+    dk["K1"] = 0.6
+    assert md.best_path_dp(edges, ["start_0"], ["end_0"], dk, listed=listed) == ["start_0", "K1_1", "end_0"]
+
+
+def test_top_paths_are_ranked(reference, module_kos):
+    before, after = dk_maps(module_kos, 4)
+    top = md.indexed_path_probabilities(reference.path_index, before, after, top_k=3)
+    best = md.indexed_path_probabilities(reference.path_index, before, after)
+    assert (top.groupby('module').size() <= 3).all()
+    pd.testing.assert_frame_equal(top[top['rank'] == 1].drop(columns='rank').reset_index(drop=True),
+                                  best.drop(columns='rank', errors='ignore').reset_index(drop=True))
+    assert (top.groupby('module')['geo_after'].apply(lambda g: g.is_monotonic_decreasing)).all()
@@ -0,0 +1,50 @@
+import os, shutil
+import numpy as np
+import pandas as pd
+
+from conftest import DATA_DIR, md
+
+
+def copy_reference(tmp_path):
+    data = tmp_path / "data"
+    shutil.copytree(DATA_DIR, data)
+    return str(data / "ko_occurrences.txt"), str(data / "ko_neighbors.txt")
+
+
+def assert_same_tables(a, b):
+    pd.testing.assert_frame_equal(a[0], b[0])
+    for name in ("ko_ids",) + md.NEIGHBOR_ARRAYS:
+        np.testing.assert_array_equal(getattr(a[1], name), getattr(b[1], name))
+    assert a[2] == b[2]
+    pd.testing.assert_frame_equal(a[3], b[3])
+
+
+def test_cached_tables_match_a_fresh_build(tmp_path, module_graphs, capsys):
+    occ, nbr = copy_reference(tmp_path)
+    built = md.build_reference_tables(occ, nbr, module_graphs)
+    first = md.load_reference_tables(occ, nbr, module_graphs, str(tmp_path / "cache"))
+    assert "Reference cache written" in capsys.readouterr().out
+    again = md.load_reference_tables(occ, nbr, module_graphs, str(tmp_path / "cache"))
+    assert "Reference cache written" not in capsys.readouterr().out
+    assert_same_tables(built, first)
+    assert_same_tables(built, again)
+
+
+def test_touched_source_is_reused_and_edited_source_rebuilds(tmp_path, module_graphs, capsys):
+    occ, nbr = copy_reference(tmp_path)
+    cache = str(tmp_path / "cache")
+    md.load_reference_tables(occ, nbr, module_graphs, cache)
+    capsys.readouterr()
+
+    os.utime(occ, ns=(0, 0))    # same content, new mtime: checksum matches, cache kept
+    md.load_reference_tables(occ, nbr, module_graphs, cache)
+    assert "Reference cache written" not in capsys.readouterr().out
+
+    with open(occ) as f:
+        text = f.read()
+    ko, count = text.split("\n", 1)[0].split()
+    with open(occ, "w") as f:    # same size, other content: rebuilt
+        f.write(text.replace(f"{ko}\t{count}", f"{ko}\t{int(count) + 1}", 1))
+    tables = md.load_reference_tables(occ, nbr, module_graphs, cache)
+    assert "Reference cache written" in capsys.readouterr().out
+    assert_same_tables(tables, md.build_reference_tables(occ, nbr, module_graphs))
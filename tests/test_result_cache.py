@@ -0,0 +1,80 @@
+import os, shutil
+import pandas as pd
+import pytest
+
+from conftest import md
+
+
+@pytest.fixture
+def cached_options(options, tmp_path):
+    return options(no_result_cache=False, cache_dir=str(tmp_path / "cache"))
+
+
+def detect(reference, path, args, capsys):
+    result = md.detect_sample(reference, path, 0.8, args)
+    return result, capsys.readouterr().out
+
+
+def test_cached_result_matches_a_fresh_run(reference, domtblout, cached_options, options, capsys):
+    first, out = detect(reference, domtblout, cached_options, capsys)
+    assert "Reusing cached" not in out
+    again, out = detect(reference, domtblout, cached_options, capsys)
+    assert "Reusing cached hits" in out
+    fresh = md.detect_sample(reference, domtblout, 0.8, options())
+    for result in (first, again):
+        pd.testing.assert_frame_equal(result.dk, fresh.dk)
+        pd.testing.assert_frame_equal(result.paths, fresh.paths)
+
+
+def test_unchanged_input_is_not_hashed_again(domtblout, tmp_path, monkeypatch):
+    cache = md.ResultCache(str(tmp_path))
+    digest = cache.input_digest(domtblout)
+    assert digest == f"sha256:{md.file_sha256(domtblout)}"
+    monkeypatch.setattr(md, "file_sha256", lambda path: pytest.fail("hashed twice"))
+    assert md.ResultCache(str(tmp_path)).input_digest(domtblout) == digest
+
+
+def test_a_copy_of_the_input_hits_the_cache(reference, domtblout, cached_options, tmp_path, capsys):
+    detect(reference, domtblout, cached_options, capsys)
+    copy = str(tmp_path / "copy.domtblout")
+    shutil.copyfile(domtblout, copy)
+    assert "Reusing cached hits" in detect(reference, copy, cached_options, capsys)[1]
+
+
+def test_same_size_rewrite_with_the_same_mtime_misses(reference, domtblout, cached_options, options, tmp_path,
+                                                     capsys):
+    path = tmp_path / "sample.domtblout"
+    shutil.copyfile(domtblout, path)
+    detect(reference, str(path), cached_options, capsys)
+    st = os.stat(path)
+    lines = path.read_text().splitlines(keepends=True)
+    data = [i for i, l in enumerate(lines) if not l.startswith("#")]
+    lines[data[0]], lines[data[-1]] = lines[data[-1]], lines[data[0]]    # same bytes, other hit order
+    path.write_text("".join(lines))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert os.path.getsize(path) == st.st_size
+    after, out = detect(reference, str(path), cached_options, capsys)
+    assert "Reusing cached hits" not in out
+    pd.testing.assert_frame_equal(after.dk, md.detect_sample(reference, str(path), 0.8, options()).dk)
+
+
+def test_put_evicts_least_recently_used_down_to_the_low_water_mark(tmp_path):
+    cache = md.ResultCache(str(tmp_path), max_mb=1)
+    blob = b"x" * 300_000
+    for i in range(3):
+        cache.put("hits", f"k{i}", blob)
+        os.utime(os.path.join(cache.root, "hits", f"k{i}.pkl"), (i, i))
+    assert cache.get("hits", "k0") == blob    # k0 used last now
+    cache.put("hits", "k3", blob)
+    keys = {e["key"] for e in cache.entries()}
+    assert keys == {"k0", "k2", "k3"}
+    assert cache.stored_bytes() <= cache.max_bytes * md.RESULT_CACHE_LOW_WATER
+
+
+def test_entries_are_served_when_the_lru_touch_fails(tmp_path, monkeypatch):
+    cache = md.ResultCache(str(tmp_path))
+    cache.put("dk", "key", {"a": 1})
+    def read_only(*args, **kwargs):
+        raise PermissionError("read-only file system")
+    monkeypatch.setattr(md.os, "utime", read_only)
+    assert cache.get("dk", "key") == {"a": 1}
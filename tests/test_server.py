@@ -0,0 +1,137 @@
+import json, os, signal, threading, time
+import http.client
+import pytest
+
+from conftest import md
+
+TOKEN = "test-token"
+
+
+def start_server(reference, cache_dir):
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True)
+    service = md.ScoringService(reference, args, workers=1)
+    handler = type("Handler", (md.ScoringRequestHandler,), {"service": service, "token": TOKEN})
+    httpd = md.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def stop_server(httpd):
+    httpd.shutdown()
+    httpd.server_close()
+    httpd.RequestHandlerClass.service.close()
+
+
+@pytest.fixture(scope="module")
+def server(reference, cache_dir):
+    httpd = start_server(reference, cache_dir)
+    yield httpd
+    stop_server(httpd)
+
+
+def request(server, method, path, body=None, headers=None, token=TOKEN):
+    conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=60)
+    headers = dict(headers or {})
+    if token is not None:
+        headers[md.SERVE_TOKEN_HEADER] = token
+    conn.request(method, path, body=body, headers=headers)
+    resp = conn.getresponse()
+    data = resp.read()
+    conn.close()
+    return resp, data
+
+
+def test_requests_without_the_token_are_refused(server):
+    assert request(server, "GET", "/status", token=None)[0].status == 401
+    assert request(server, "GET", "/jobs", token="guess")[0].status == 401
+    assert request(server, "POST", "/jobs", body=b"x", token=None)[0].status == 401
+    assert request(server, "GET", "/status")[0].status == 200
+    assert request(server, "GET", f"/status?token={TOKEN}", token=None)[0].status == 200
+
+
+def test_null_and_foreign_origins_get_no_cors_headers(server):
+    for origin in ("null", "https://example.org"):
+        resp, _ = request(server, "GET", "/jobs", headers={"Origin": origin})
+        assert resp.getheader("Access-Control-Allow-Origin") is None
+
+
+def test_viewer_is_served_from_the_same_origin(server):
+    resp, body = request(server, "GET", "/viewer/module.html", token=None)
+    assert resp.status == 200 and resp.getheader("Content-Type") == "text/html"
+    assert b"X-BLIMMP-Token" in body
+    assert request(server, "GET", "/viewer/..", token=None)[0].status == 404
+    assert request(server, "GET", "/viewer/nothing.js", token=None)[0].status == 404
+
+
+def test_path_jobs_from_browsers_are_refused(server, domtblout):
+    body = json.dumps({"path": domtblout}).encode()
+    resp, _ = request(server, "POST", "/jobs", body=body,
+                      headers={"Content-Type": "application/json", "Origin": "null"})
+    assert resp.status == 403
+
+
+def test_uploaded_job_matches_detect(server, reference, domtblout, cache_dir):
+    with open(domtblout, "rb") as f:
+        resp, data = request(server, "POST", "/jobs?completeness=0.8&wait=1", body=f.read())
+    assert resp.status == 200
+    job = json.loads(data)
+    expected = md.detect_sample(reference, domtblout, 0.8, md.analysis_options(cache_dir=cache_dir,
+                                                                                no_result_cache=True))
+    assert job["status"] == "done"
+    assert job["best_paths"] == {m: entry["best_path"] for m, entry in expected.modules.items()}
+    resp, data = request(server, "GET", f"/jobs/{job['job']}/modules")
+    assert json.loads(data) == json.loads(json.dumps(expected.modules))
+
+
+def test_wait_gives_up_with_202(server, domtblout, monkeypatch):
+    monkeypatch.setattr(server.RequestHandlerClass, "max_wait", 0)
+    with open(domtblout, "rb") as f:
+        resp, data = request(server, "POST", "/jobs?completeness=0.8&wait=1", body=f.read())
+    assert resp.status == 202
+    job_id = json.loads(data)["job"]
+    deadline = time.time() + 60
+    while json.loads(request(server, "GET", f"/jobs/{job_id}")[1])["status"] != "done":
+        assert time.time() < deadline
+        time.sleep(0.1)
+
+
+def kill_workers(service):
+    # what the OOM killer does to a worker scoring a large upload
+    pool = service.pool
+    for pid in list(pool._processes):
+        os.kill(pid, signal.SIGKILL)
+    return pool
+
+
+def submit(server, path):
+    with open(path, "rb") as f:
+        resp, data = request(server, "POST", "/jobs?completeness=0.8&wait=1", body=f.read())
+    return resp.status, json.loads(data)
+
+
+def test_service_recovers_when_a_worker_dies(reference, cache_dir, domtblout):
+    httpd = start_server(reference, cache_dir)
+    service = httpd.RequestHandlerClass.service
+    try:
+        broken = kill_workers(service)
+        deadline = time.time() + 30
+        while not broken._broken and time.time() < deadline:
+            time.sleep(0.05)
+        for _ in range(2):
+            status, job = submit(httpd, domtblout)
+            assert (status, job["status"]) == (200, "done")
+        assert service.pool is not broken
+
+        # killed while the next job may already be queued: that job fails,
+        # the ones after it are scored again
+        kill_workers(service)
+        status, job = submit(httpd, domtblout)
+        assert job["status"] == "done" or "worker died" in job["error"]
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            status, job = submit(httpd, domtblout)
+            if job["status"] == "done":
+                break
+        assert (status, job["status"]) == (200, "done")
+    finally:
+        stop_server(httpd)
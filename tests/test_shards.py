@@ -0,0 +1,66 @@
+import os
+import pandas as pd
+import pytest
+
+from conftest import DATA_DIR, md
+import benchmarks
+
+SAMPLES = 5
+SHARDS = 3
+
+
+@pytest.fixture(scope="module")
+def samples(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("cohort")
+    return [benchmarks.make_domtblout(str(folder / f"s{i}.domtblout"), 1500, seed=10 + i) for i in range(SAMPLES)]
+
+
+def common_arguments(module_graphs, cache_dir):
+    return ['--module-graphs', module_graphs, '--reference-data', DATA_DIR, '--cache-dir', cache_dir,
+            '--no-result-cache']
+
+
+def run_shards(samples, out_dir, module_graphs, cache_dir, shards=range(SHARDS)):
+    for index in shards:
+        argv = ['batch', *samples, '-o', str(out_dir), '-c', '0.8', '--shard-index', str(index),
+                '--shard-count', str(SHARDS), *common_arguments(module_graphs, cache_dir)]
+        assert md.main(argv) == 0
+
+
+def read_matrix(prefix, name):
+    return pd.read_csv(f"{prefix}_{name}.csv", index_col=0, dtype={0: str}, float_precision="round_trip")
+
+
+def test_merged_shards_match_in_memory(samples, module_graphs, reference, cache_dir, tmp_path):
+    run_shards(samples, tmp_path / "shards", module_graphs, cache_dir)
+    assert not [f for f in os.listdir(tmp_path / "shards") if f.endswith(".pkl")]
+    prefix = str(tmp_path / "cohort")
+    assert md.main(['merge-shards', str(tmp_path / "shards"), '-o', prefix]) == 0
+
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True)
+    expected = {md.sample_name(p): md.detect_sample(reference, p, 0.8, args) for p in samples}
+    for name, (table, key, value) in md.COHORT_MATRICES.items():
+        matrix = read_matrix(prefix, name)
+        assert sorted(matrix.index) == sorted(expected)
+        for sample, result in expected.items():
+            source = result.dk if table == "dk" else result.paths
+            want = source.set_index(key)[value].astype(float)
+            got = matrix.loc[sample].dropna()
+            assert sorted(got.index) == sorted(want.index.astype(str))
+            assert (got.loc[want.index.astype(str)].to_numpy() == want.to_numpy()).all(), name
+
+
+def test_missing_shard_is_reported(samples, module_graphs, cache_dir, tmp_path, capsys):
+    run_shards(samples, tmp_path / "shards", module_graphs, cache_dir, shards=[0, 2])
+    with pytest.raises(SystemExit):
+        md.main(['merge-shards', str(tmp_path / "shards"), '-o', str(tmp_path / "cohort")])
+    assert "1 of 3 shard(s) have no partials: [1]" in capsys.readouterr().err
+
+
+def test_pickle_partials_are_not_loaded(samples, module_graphs, cache_dir, tmp_path, monkeypatch, capsys):
+    run_shards(samples, tmp_path / "shards", module_graphs, cache_dir)
+    pd.DataFrame({'sample': ['x']}).to_pickle(tmp_path / "shards" / "shard-00001-of-00003_dk.pkl")
+    monkeypatch.setattr(pd, "read_pickle", lambda *a, **k: pytest.fail("pickle loaded"))
+    with pytest.raises(SystemExit):
+        md.main(['merge-shards', str(tmp_path / "shards"), '-o', str(tmp_path / "cohort")])
+    assert "no longer loads" in capsys.readouterr().err
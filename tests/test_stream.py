@@ -0,0 +1,66 @@
+import pandas as pd
+import pytest
+
+from conftest import md
+
+# numbered per block of targets when streaming, per file in memory
+BLOCK_LOCAL = ['overlap_group']
+
+
+@pytest.fixture(scope="module")
+def grouped_domtblout(domtblout, tmp_path_factory):
+    # same hits with the lines of each target consecutive, as --stream sorted needs
+    with open(domtblout) as f:
+        lines = f.readlines()
+    data = sorted((l for l in lines if not l.startswith("#")), key=lambda l: l.split(None, 1)[0])
+    path = tmp_path_factory.mktemp("grouped") / "grouped.domtblout"
+    path.write_text("".join([l for l in lines if l.startswith("#")][:3] + data))
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def in_memory(reference, cache_dir):
+    # default (in-memory) result per input file
+    results = {}
+    def result(path):
+        if path not in results:
+            args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True)
+            results[path] = md.detect_sample(reference, path, 0.8, args)
+        return results[path]
+    return result
+
+
+def assert_same_as_in_memory(result, expected):
+    pd.testing.assert_frame_equal(result.dk.drop(columns=BLOCK_LOCAL), expected.dk.drop(columns=BLOCK_LOCAL))
+    pd.testing.assert_frame_equal(result.paths, expected.paths)
+    assert result.modules == expected.modules
+
+
+@pytest.mark.parametrize("mode", ["spill", "sorted"])
+def test_stream_matches_in_memory(reference, domtblout, grouped_domtblout, in_memory, cache_dir, tmp_path, mode):
+    path = grouped_domtblout if mode == "sorted" else domtblout
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True, stream=mode, stream_chunksize=500,
+                               tmp_dir=str(tmp_path))
+    assert_same_as_in_memory(md.detect_sample(reference, path, 0.8, args), in_memory(path))
+    assert list(tmp_path.iterdir()) == []    # spill files removed
+
+
+def test_sorted_stream_rejects_ungrouped_input(reference, domtblout, cache_dir):
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True, stream="sorted", stream_chunksize=500)
+    with pytest.raises(ValueError, match="contig_"):
+        md.detect_sample(reference, domtblout, 0.8, args)
+
+
+def test_spill_stays_within_the_open_file_limit(reference, domtblout, in_memory, cache_dir, monkeypatch):
+    monkeypatch.setattr(md, "STREAM_OPEN_FILES", 4)
+    monkeypatch.setattr(md, "STREAM_PARTITION_BYTES", 2**10)    # ~hundreds of partitions
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True, stream="spill", stream_chunksize=500)
+    assert_same_as_in_memory(md.detect_sample(reference, domtblout, 0.8, args), in_memory(domtblout))
+
+
+@pytest.mark.parametrize("mode", ["spill", "sorted"])
+def test_ingest_workers_match_in_memory(reference, domtblout, grouped_domtblout, in_memory, cache_dir, mode):
+    path = grouped_domtblout if mode == "sorted" else domtblout
+    args = md.analysis_options(cache_dir=cache_dir, no_result_cache=True, stream=mode, ingest_workers=3,
+                               stream_chunksize=500)
+    assert_same_as_in_memory(md.detect_sample(reference, path, 0.8, args), in_memory(path))